@@ -1,21 +1,45 @@
-from flask import Flask, request, jsonify, send_file, render_template, make_response, send_from_directory, Response
+from flask import Flask, request, jsonify, send_file, render_template, make_response, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, time as dt_time
 from apscheduler.schedulers.background import BackgroundScheduler
+from dateutil import parser as date_parser
 
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 import io
-import base64
+import binascii
 import twilio
+from twilio.rest import Client as TwilioClient
+from twilio.twiml.voice_response import VoiceResponse, Gather
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
+from pywebpush import WebPusher, WebPushException
+from py_vapid import Vapid
+import requests
 import qrcode
 import logging
 import os
+import re
+import hmac
+import hashlib
+import threading
+import queue
+import smtplib
+from email.mime.text import MIMEText
+import time
+import functools
+import itertools
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, wait
+from cachetools import TTLCache
 import google.generativeai as genai
-import json
+import orjson
+from urllib.parse import urlencode, urlparse
+from psycopg2.extras import execute_values
 from config import Config
 from db_manager import DatabaseManager
 from rag_pipeline import RAGPipeline
-from encryption import encrypt_data, decrypt_data, generate_patient_code, hash_patient_code
+from rag_cache import SmartRAGCache, FAQIndex, QueryCtx, normalize_query, question_terms
+from encryption import encrypt_data, encrypt_batch, decrypt_data, decrypt_batch, generate_patient_code, hash_patient_code, hash_medication_name
 from pii_filter import PIIFilter
 
 # Initialize Flask app
@@ -27,9 +51,20 @@ CORS(app, supports_credentials=True)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def ojson(payload, status=200):
+    """JSON response serialized with orjson (handles date/datetime natively)"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 # Initialize database and RAG
 db_manager = DatabaseManager()
 rag_pipeline = RAGPipeline(db_manager)
+rag_cache = SmartRAGCache()
+
+# One pooled connection per request, handed back when the request ends
+app.teardown_request(db_manager.release_request_connection)
+
+# Tables the alarm / push endpoints rely on (once at startup, not per request)
+db_manager.ensure_schema()
 
 # Create analytics tables on startup
 def init_analytics_tables():
@@ -48,6 +83,7 @@ def init_analytics_tables():
                     UNIQUE(code_hash, survey_day)
                 );
                 CREATE INDEX IF NOT EXISTS idx_survey_completion_date ON survey_responses(completion_date);
+                CREATE INDEX IF NOT EXISTS idx_survey_day_bucket ON survey_responses(survey_day, result_bucket);
                 
                 CREATE TABLE IF NOT EXISTS daily_active_users (
                     id SERIAL PRIMARY KEY,
@@ -59,6 +95,11 @@ def init_analytics_tables():
                 );
                 CREATE INDEX IF NOT EXISTS idx_dau_event_date ON daily_active_users(event_date);
                 
+                -- Bounded 24-value hour bucket so hourly averages plan as HashAggregate
+                ALTER TABLE daily_active_users
+                    ADD COLUMN IF NOT EXISTS event_date_hour SMALLINT GENERATED ALWAYS AS (event_hour) STORED;
+                CREATE INDEX IF NOT EXISTS idx_dau_event_date_brin ON daily_active_users USING BRIN (event_date);
+                
                 CREATE TABLE IF NOT EXISTS daily_launch_tracker (
                     id SERIAL PRIMARY KEY,
                     code_hash VARCHAR(64) NOT NULL,
@@ -75,6 +116,111 @@ def init_analytics_tables():
 
 init_analytics_tables()
 
+def init_active_users_hll():
+    """
+    Create the rolling HyperLogLog sketch of daily launches (postgresql-hll).
+    Returns True if the extension is available, False to fall back to
+    COUNT(DISTINCT) over daily_launch_tracker.
+    """
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE EXTENSION IF NOT EXISTS hll;
+                
+                CREATE TABLE IF NOT EXISTS daily_active_hll (
+                    launch_date DATE PRIMARY KEY,
+                    codes hll NOT NULL DEFAULT hll_empty()
+                );
+            """)
+            conn.commit()
+            logger.info("✓ HLL active-user sketch initialized")
+            return True
+    except Exception as e:
+        logger.warning(f"HLL extension unavailable, using exact active-user count: {e}")
+        return False
+
+HLL_ENABLED = init_active_users_hll()
+
+# Active users (launched in last 7 days): approximate HLL union when
+# available, otherwise exact distinct count over the launch tracker
+if HLL_ENABLED:
+    ACTIVE_USERS_7D_SQL = """
+        SELECT COALESCE(ROUND(hll_cardinality(hll_union_agg(codes)))::bigint, 0)
+        FROM daily_active_hll
+        WHERE launch_date >= CURRENT_DATE - INTERVAL '7 days'
+    """
+else:
+    ACTIVE_USERS_7D_SQL = """
+        SELECT COUNT(DISTINCT code_hash)
+        FROM daily_launch_tracker
+        WHERE launch_date >= CURRENT_DATE - INTERVAL '7 days'
+    """
+
+def init_chat_summaries_schema():
+    """Add the JSONB summaries array to chat_summaries if missing"""
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                ALTER TABLE chat_summaries
+                    ADD COLUMN IF NOT EXISTS summaries JSONB NOT NULL DEFAULT '[]'::jsonb;
+            """)
+            conn.commit()
+            logger.info("✓ chat_summaries schema initialized")
+    except Exception as e:
+        logger.warning(f"chat_summaries schema error: {e}")
+
+init_chat_summaries_schema()
+
+def init_safety_alerts_schema():
+    """Sortable severity rank + partial index for the unresolved-alerts dashboard"""
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                ALTER TABLE safety_alerts
+                    ADD COLUMN IF NOT EXISTS severity_rank SMALLINT GENERATED ALWAYS AS (
+                        CASE severity WHEN 'critical' THEN 1 WHEN 'high' THEN 2 ELSE 3 END
+                    ) STORED;
+                CREATE INDEX IF NOT EXISTS idx_safety_unresolved
+                    ON safety_alerts (severity_rank, timestamp DESC)
+                    WHERE resolved = false;
+            """)
+            conn.commit()
+            logger.info("✓ safety_alerts schema initialized")
+    except Exception as e:
+        logger.warning(f"safety_alerts schema error: {e}")
+
+init_safety_alerts_schema()
+
+# Curated caregiving FAQs answered without RAG (rows managed directly in the DB)
+coach_faq = FAQIndex()
+FAQ_RELOAD_SECONDS = 600
+
+def load_coach_faq():
+    """Create the coach_faq table if needed and (re)load active entries"""
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS coach_faq (
+                    id SERIAL PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    active BOOLEAN NOT NULL DEFAULT TRUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            cur.execute("SELECT question, answer FROM coach_faq WHERE active = TRUE")
+            count = coach_faq.load(cur.fetchall())
+            logger.info(f"✓ Coach FAQ loaded ({count} entries)")
+    except Exception as e:
+        coach_faq.loaded_at = time.monotonic()  # don't retry on every request
+        logger.warning(f"Coach FAQ load error: {e}")
+
+load_coach_faq()
+
 
 # ============================================
 # ADD TO app.py - COMPLETE SAFETY & SUMMARY SYSTEM
@@ -83,15 +229,64 @@ init_analytics_tables()
 # Copy this entire section and paste it AFTER your rag_pipeline initialization
 # (around line 50-60, after: rag_pipeline = RAGPipeline(db_manager))
 
-import json
-from datetime import datetime
-import google.generativeai as genai
 
 # ============================================
 # SAFETY FUNCTIONS
 # ============================================
 
-def check_safety_and_alert(user_message, code_hash, db_manager):
+# Crisis keyword patterns, checked on every coach message
+_CRISIS_PATTERNS = {
+    'suicide': [
+        'kill myself', 'suicide', 'end my life', 'want to die', 'better off dead',
+        'no reason to live', 'take my own life', 'suicidal', 'end it all'
+    ],
+    'self_harm': [
+        'cut myself', 'hurt myself', 'self harm', 'self-harm', 'burn myself',
+        'harm myself', 'cutting', 'burning myself'
+    ],
+    'harm_others': [
+        'kill him', 'kill her', 'kill them', 'harm the patient', 'hurt him', 'hurt her',
+        'going to hurt', 'want to kill', 'strangle', 'suffocate'
+    ],
+    'abuse': [
+        'hitting him', 'hitting her', 'beating them', 'locked them in',
+        'withholding food', 'leaving them alone for days', 'neglecting',
+        'hitting the patient', 'slapping'
+    ],
+    # NEW: immediate physical danger / violence (caregiver or patient)
+    'violence_immediate': [
+        'he attacked me', 'she attacked me', 'violent', 'violence', 'weapon',
+        'knife', 'choking', 'choke', 'i am in danger', 'im in danger', 'threatening me'
+    ],
+    # NEW: high distress / panic / desperate (not necessarily self-harm)
+    'high_distress': [
+        "i can't cope", "cant cope", "can't do this", "cant do this",
+        "i'm desperate", "im desperate", "i am desperate",
+        "i'm panicking", "im panicking", "panic attack", "panic",
+        "overwhelmed", "breaking down", "i'm losing it", "im losing it",
+        "can't breathe", "cant breathe", "i feel unsafe", "i don't feel safe", "dont feel safe"
+    ]
+}
+
+# Decide severity order (if multiple match, pick the most severe)
+_SEVERITY_RANK = {
+    'violence_immediate': 1,
+    'harm_others': 1,
+    'suicide': 1,
+    'self_harm': 1,
+    'abuse': 1,
+    'high_distress': 2
+}
+
+# One compiled alternation over every keyword: a single scan clears the
+# (common) safe message; only on a hit do we work out which categories matched
+_CRISIS_RE = re.compile('|'.join(
+    re.escape(kw)
+    for kw in sorted({kw for kws in _CRISIS_PATTERNS.values() for kw in kws}, key=len, reverse=True)
+))
+
+
+def check_safety_and_alert(user_message, code_hash, db_manager, message_lower=None):
     """
     Check message safety and create admin alert if needed.
     Returns: (is_safe: bool, crisis_response: str or None)
@@ -106,57 +301,16 @@ def check_safety_and_alert(user_message, code_hash, db_manager):
         if not message:
             return (True, None)
 
-        message_lower = message.lower()
-
-        # ---- Patterns ----
-        crisis_patterns = {
-            'suicide': [
-                'kill myself', 'suicide', 'end my life', 'want to die', 'better off dead',
-                'no reason to live', 'take my own life', 'suicidal', 'end it all'
-            ],
-            'self_harm': [
-                'cut myself', 'hurt myself', 'self harm', 'self-harm', 'burn myself',
-                'harm myself', 'cutting', 'burning myself'
-            ],
-            'harm_others': [
-                'kill him', 'kill her', 'kill them', 'harm the patient', 'hurt him', 'hurt her',
-                'going to hurt', 'want to kill', 'strangle', 'suffocate'
-            ],
-            'abuse': [
-                'hitting him', 'hitting her', 'beating them', 'locked them in',
-                'withholding food', 'leaving them alone for days', 'neglecting',
-                'hitting the patient', 'slapping'
-            ],
-            # NEW: immediate physical danger / violence (caregiver or patient)
-            'violence_immediate': [
-                'he attacked me', 'she attacked me', 'violent', 'violence', 'weapon',
-                'knife', 'choking', 'choke', 'i am in danger', 'im in danger', 'threatening me'
-            ],
-            # NEW: high distress / panic / desperate (not necessarily self-harm)
-            'high_distress': [
-                "i can't cope", "cant cope", "can't do this", "cant do this",
-                "i'm desperate", "im desperate", "i am desperate",
-                "i'm panicking", "im panicking", "panic attack", "panic",
-                "overwhelmed", "breaking down", "i'm losing it", "im losing it",
-                "can't breathe", "cant breathe", "i feel unsafe", "i don't feel safe", "dont feel safe"
-            ]
-        }
+        message_lower = message_lower or message.lower()
 
-        # Decide severity order (if multiple match, pick the most severe)
-        severity_rank = {
-            'violence_immediate': 1,
-            'harm_others': 1,
-            'suicide': 1,
-            'self_harm': 1,
-            'abuse': 1,
-            'high_distress': 2
-        }
+        if not _CRISIS_RE.search(message_lower):
+            return (True, None)
 
         matched = []
-        for alert_type, keywords in crisis_patterns.items():
+        for alert_type, keywords in _CRISIS_PATTERNS.items():
             hits = [kw for kw in keywords if kw in message_lower]
             if hits:
-                matched.append((severity_rank.get(alert_type, 99), alert_type, hits))
+                matched.append((_SEVERITY_RANK.get(alert_type, 99), alert_type, hits))
 
         if not matched:
             return (True, None)
@@ -192,19 +346,15 @@ def check_safety_and_alert(user_message, code_hash, db_manager):
         return (False, crisis_response)
 
     except Exception as e:
-        logger.error(f"Safety check failed: {e}", exc_info=True)
+        logger.error("Safety check failed: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
         # Fail-open so you don't accidentally block everything
         return (True, None)
 
 
 
-def get_crisis_response(alert_type):
-    """
-    Return appropriate crisis response based on alert type.
-    NOTE: You said UK — keeping UK numbers.
-    """
-    responses = {
-        'violence_immediate': """**If there is immediate physical danger right now, please act immediately.**
+# Crisis responses by alert type (UK numbers)
+_CRISIS_RESPONSES = {
+    'violence_immediate': """**If there is immediate physical danger right now, please act immediately.**
 
 🚨 **Call 999 now** if anyone is at risk of being harmed.
 
@@ -217,7 +367,7 @@ If it’s not immediate danger but you’re worried it could escalate:
 
 This chat can’t keep you safe in a real-time emergency — please use 999 if there’s any immediate threat.""",
 
-        'suicide': """**I'm very concerned about what you've shared.**
+    'suicide': """**I'm very concerned about what you've shared.**
 
 🚨 **Please get immediate help:**
 
@@ -231,7 +381,7 @@ If you feel you might act on these thoughts, **call 999 now**.
 
 I'm not able to provide crisis support — please reach one of the services above immediately.""",
 
-        'self_harm': """**I'm concerned about what you've shared.**
+    'self_harm': """**I'm concerned about what you've shared.**
 
 🚨 **Please get support now:**
 
@@ -243,7 +393,7 @@ I'm not able to provide crisis support — please reach one of the services abov
 
 This chat isn’t designed to support self-harm. Please contact a trained professional right now.""",
 
-        'harm_others': """**I need to be direct with you.**
+    'harm_others': """**I need to be direct with you.**
 
 If you feel you might harm someone:
 
@@ -255,7 +405,7 @@ If the person you care for is in danger, call 999 immediately.
 
 I can’t continue with this conversation — please contact professional help now.""",
 
-        'abuse': """**What you're describing sounds very serious.**
+    'abuse': """**What you're describing sounds very serious.**
 
 If someone is being harmed or neglected:
 
@@ -265,7 +415,7 @@ If someone is being harmed or neglected:
 
 This is beyond what this chat can manage. Please report it so professionals can protect the vulnerable adult.""",
 
-        'high_distress': """**It sounds like you’re at your limit right now. Let’s treat this as urgent.**
+    'high_distress': """**It sounds like you’re at your limit right now. Let’s treat this as urgent.**
 
 If you feel unsafe, out of control, or like you might do something you’ll regret:
 - **Call 999** (immediate danger)
@@ -281,9 +431,29 @@ To get through the next 60 seconds:
 3) Name 5 things you can see, 4 you can touch, 3 you can hear.
 
 When you’ve done that, reach out to one of the services above. You don’t have to carry this alone."""
-    }
+}
+
+_DEFAULT_CRISIS_RESPONSE = "If you’re in immediate danger, call 999. Otherwise contact NHS 111 or Samaritans 116 123."
+
+
+def get_crisis_response(alert_type):
+    """
+    Return appropriate crisis response based on alert type.
+    NOTE: You said UK — keeping UK numbers.
+    """
+    return _CRISIS_RESPONSES.get(alert_type, _DEFAULT_CRISIS_RESPONSE)
 
-    return responses.get(alert_type, "If you’re in immediate danger, call 999. Otherwise contact NHS 111 or Samaritans 116 123.")
+
+# Coach endpoint JSON bodies for each crisis response, serialized once at startup
+_CRISIS_RESPONSE_BODIES = {
+    text: orjson.dumps({
+        'success': True,
+        'answer': text,
+        'sources': [],
+        'safety_alert': True
+    })
+    for text in (*_CRISIS_RESPONSES.values(), _DEFAULT_CRISIS_RESPONSE)
+}
 
 
 
@@ -291,11 +461,48 @@ When you’ve done that, reach out to one of the services above. You don’t hav
 # DAILY SUMMARY FUNCTIONS
 # ============================================
 
-def save_daily_summary(code_hash, query, response, db_manager):
+# Last 7 days of chat_summaries for one code_hash (placeholder: code_hash),
+# with the newest 3 items per day picked from the JSONB `summaries` array.
+# `encrypted_summary` is always returned: on pre-JSONB rows it holds the
+# day's earlier items, which appending to `summaries` must not hide
+RECENT_SUMMARIES_SQL = """
+    SELECT
+        date,
+        ARRAY(
+            SELECT item
+            FROM jsonb_array_elements_text(summaries) WITH ORDINALITY AS s(item, idx)
+            ORDER BY idx DESC
+            LIMIT 3
+        ) as recent_summaries,
+        encrypted_summary
+    FROM chat_summaries
+    WHERE code_hash = %s
+      AND date >= CURRENT_DATE - INTERVAL '7 days'
+    ORDER BY date DESC
+    LIMIT 7
+"""
+
+# Append one encrypted item to today's JSONB `summaries` array (keep last 30/day).
+# Placeholders: code_hash, encrypted_summary, item
+SUMMARY_UPSERT_SQL = """
+    INSERT INTO chat_summaries (code_hash, encrypted_summary, summaries, conversation_count)
+    VALUES (%s, %s, jsonb_build_array(%s::text), 1)
+    ON CONFLICT (code_hash, date)
+    DO UPDATE SET
+        summaries = CASE
+            WHEN jsonb_array_length(chat_summaries.summaries) >= 30
+            THEN (chat_summaries.summaries - 0) || EXCLUDED.summaries
+            ELSE chat_summaries.summaries || EXCLUDED.summaries
+        END,
+        conversation_count = chat_summaries.conversation_count + 1
+"""
+
+
+def build_summary_item(query, response):
     """
-    Save conversation summary for context continuity.
-    FIX: Do NOT concatenate ciphertext with ' | '.
-    Instead: decrypt existing -> append -> re-encrypt.
+    Ask Gemini for a short memory note about one turn, for context continuity.
+    Returns the encrypted {"t", "s"} item (appended to the day's JSONB
+    `summaries` array via SUMMARY_UPSERT_SQL), or None if nothing was produced.
 
     Also: summary prompt updated to reflect your "multi-hat" assistant requirement:
     - if down: listen + encourage
@@ -304,7 +511,7 @@ def save_daily_summary(code_hash, query, response, db_manager):
     - if danger: direct emergency guidance
     """
     try:
-        # ---------------- 1) Build robust summary prompt ----------------
+        # ---------------- Build robust summary prompt ----------------
         q = (query or "").strip()
         a = (response or "").strip()
 
@@ -340,152 +547,98 @@ Assistant reply (for context):
         summary_response = model.generate_content(summary_prompt)
         summary_text = (summary_response.text or "").strip()
         if not summary_text:
-            return
+            return None
 
         new_item = {
             "t": datetime.now(timezone.utc).isoformat(),
             "s": summary_text
         }
 
-        # ---------------- 2) Fetch existing row for today ----------------
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT encrypted_summary
-                FROM chat_summaries
-                WHERE code_hash = %s AND date = CURRENT_DATE
-                LIMIT 1
-            """, (code_hash,))
-            row = cur.fetchone()
+        return encrypt_data(new_item)
 
-            existing_items = []
+    except Exception as e:
+        logger.warning("Summary generation failed: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return None
 
-            if row and row.get('encrypted_summary'):
-                enc_blob = row['encrypted_summary']
 
-                # ---- Backward compatibility ----
-                # Old (broken) approach stored "ciphertext | ciphertext".
-                # So we split FIRST, decrypt each chunk individually if needed.
-                try:
-                    if isinstance(enc_blob, str) and " | " in enc_blob:
-                        parts = [p.strip() for p in enc_blob.split(" | ") if p.strip()]
-                        for p in parts:
-                            try:
-                                d = decrypt_data(p)
-                                # legacy dict shape {'summary':..., 'timestamp':...}
-                                if isinstance(d, dict) and 'summary' in d:
-                                    existing_items.append({"t": d.get("timestamp"), "s": d.get("summary")})
-                                elif isinstance(d, dict) and 'items' in d:
-                                    # new shape
-                                    for it in d.get('items', []):
-                                        if isinstance(it, dict) and it.get('s'):
-                                            existing_items.append(it)
-                            except Exception:
-                                continue
-                    else:
-                        d = decrypt_data(enc_blob)
-                        if isinstance(d, dict) and 'items' in d and isinstance(d['items'], list):
-                            existing_items = d['items']
-                        elif isinstance(d, dict) and 'summary' in d:
-                            existing_items = [{"t": d.get("timestamp"), "s": d.get("summary")}]
-                        elif isinstance(d, list):
-                            existing_items = [{"t": None, "s": str(x)} for x in d if x]
-                except Exception:
-                    existing_items = []
-
-            # Append and trim
-            existing_items.append(new_item)
-            existing_items = existing_items[-30:]  # keep last 30/day
-
-            encrypted_summary = encrypt_data({
-                "items": existing_items
-            })
-
-            # ---------------- 3) Upsert safely ----------------
-            cur.execute("""
-                INSERT INTO chat_summaries (code_hash, encrypted_summary, conversation_count)
-                VALUES (%s, %s, 1)
-                ON CONFLICT (code_hash, date)
-                DO UPDATE SET
-                    encrypted_summary = EXCLUDED.encrypted_summary,
-                    conversation_count = chat_summaries.conversation_count + 1
-            """, (code_hash, encrypted_summary))
 
-            conn.commit()
+def _legacy_summary_items(enc_blob):
+    """
+    Decode a pre-JSONB `encrypted_summary` blob into a list of summary strings.
 
-        logger.info(f"✓ Summary saved for {code_hash[:8]}...")
+    Supports:
+    - encrypt_data({"items":[{"t":..., "s":...}, ...]})
+    - encrypt_data({"summary":..., "timestamp":...})
+    - Broken legacy: "ciphertext | ciphertext" (split then decrypt each part)
+    """
+    day_items = []
 
-    except Exception as e:
-        logger.error(f"Summary save failed: {e}", exc_info=True)
-        return
+    if isinstance(enc_blob, str) and " | " in enc_blob:
+        parts = [p.strip() for p in enc_blob.split(" | ") if p.strip()]
+        for p in parts:
+            try:
+                d = decrypt_data(p)
+                if isinstance(d, dict) and 'summary' in d:
+                    day_items.append(d.get('summary', ''))
+                elif isinstance(d, dict) and 'items' in d:
+                    for it in d.get('items', []):
+                        if isinstance(it, dict) and it.get('s'):
+                            day_items.append(it['s'])
+            except Exception:
+                continue
+    else:
+        try:
+            d = decrypt_data(enc_blob)
+        except Exception:
+            return day_items
+
+        if isinstance(d, dict) and isinstance(d.get('items'), list):
+            for it in d['items'][-3:]:  # max 3 per day
+                if isinstance(it, dict) and it.get('s'):
+                    day_items.append(it['s'])
+        elif isinstance(d, dict) and 'summary' in d:
+            day_items.append(d.get('summary', ''))
+        elif isinstance(d, dict) and d.get('s'):  # first JSONB item, also stored here
+            day_items.append(d['s'])
+        elif isinstance(d, list):
+            day_items.extend([str(x) for x in d if x])
+
+    return day_items
 
 
+CONTEXT_MAX_ITEMS = 3
 
-def get_conversation_context(code_hash, db_manager):
+
+def decode_context_notes(rows):
     """
-    Get last 7 days of conversation summaries.
-    Returns formatted context string or None.
+    Decrypt chat_summaries rows (newest day first) into prompt-ready notes:
+    a list of (line, terms) tuples, at most 8.
 
-    Supports:
-    - New format: encrypt_data({"items":[{"t":..., "s":...}, ...]})
-    - Legacy format: encrypt_data({"summary":..., "timestamp":...})
-    - Broken legacy: "ciphertext | ciphertext" (split then decrypt each part)
+    The last 3 summaries per day are picked server-side from the JSONB
+    `summaries` array. They come after the items decoded from
+    `encrypted_summary` (the whole day on pre-JSONB rows), with duplicates
+    dropped, and the newest 3 of the combined list are kept.
     """
     try:
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT encrypted_summary, date
-                FROM chat_summaries
-                WHERE code_hash = %s
-                  AND date >= CURRENT_DATE - INTERVAL '7 days'
-                ORDER BY date DESC
-                LIMIT 7
-            """, (code_hash,))
-            rows = cur.fetchall()
-
         if not rows:
-            return None
+            return []
 
         context_lines = []
 
+        # Decrypt every day's items in one batch, then hand them back out per row
+        decrypted = iter(decrypt_batch([
+            enc_item for row in rows for enc_item in (row.get('recent_summaries') or [])
+        ]))
+
         for row in rows:
-            enc_blob = row.get('encrypted_summary')
             day = row.get('date')
+            recent = [next(decrypted) for _ in (row.get('recent_summaries') or [])]
 
-            if not enc_blob:
-                continue
-
-            day_items = []
-
-            # Handle broken legacy concat first
-            if isinstance(enc_blob, str) and " | " in enc_blob:
-                parts = [p.strip() for p in enc_blob.split(" | ") if p.strip()]
-                for p in parts:
-                    try:
-                        d = decrypt_data(p)
-                        if isinstance(d, dict) and 'summary' in d:
-                            day_items.append(d.get('summary', ''))
-                        elif isinstance(d, dict) and 'items' in d:
-                            for it in d.get('items', []):
-                                if isinstance(it, dict) and it.get('s'):
-                                    day_items.append(it['s'])
-                    except Exception:
-                        continue
-            else:
-                try:
-                    d = decrypt_data(enc_blob)
-                except Exception:
-                    continue
-
-                if isinstance(d, dict) and isinstance(d.get('items'), list):
-                    for it in d['items'][-3:]:  # max 3 per day
-                        if isinstance(it, dict) and it.get('s'):
-                            day_items.append(it['s'])
-                elif isinstance(d, dict) and 'summary' in d:
-                    day_items.append(d.get('summary', ''))
-                elif isinstance(d, list):
-                    day_items.extend([str(x) for x in d if x])
+            day_items = _legacy_summary_items(row['encrypted_summary']) if row.get('encrypted_summary') else []
+            for it in reversed(recent):  # oldest first
+                if isinstance(it, dict) and it.get('s'):
+                    day_items.append(it['s'])
+            day_items = list(dict.fromkeys(day_items))  # legacy + JSONB may repeat an item
 
             # Add to context output
             for s in day_items[-3:]:
@@ -493,23 +646,199 @@ def get_conversation_context(code_hash, db_manager):
                 if s:
                     context_lines.append(f"- {day}: {s}")
 
-        if not context_lines:
-            return None
-
         # Keep prompt compact
-        context_lines = context_lines[:8]
-        return "**Recent conversations:**\n" + "\n".join(context_lines)
+        return [(line, question_terms(normalize_query(line))) for line in context_lines[:8]]
 
     except Exception as e:
-        logger.error(f"Context fetch failed: {e}", exc_info=True)
+        logger.error("Context decode failed: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return []
+
+
+def format_conversation_context(patient, query_ctx=None):
+    """
+    Prompt context from a (cached) turn-context row.
+    Notes are decrypted once per cached row and reused across turns.
+
+    With a `query_ctx`, only the (at most CONTEXT_MAX_ITEMS) notes sharing
+    words with it are kept; if none do, just the most recent note is.
+    """
+    notes = patient.get('context_notes')
+    if notes is None:
+        notes = patient['context_notes'] = decode_context_notes(patient['turn_context'])
+    if not notes:
         return None
 
+    if query_ctx:
+        scored = [(len(query_ctx.terms & terms), i) for i, (_, terms) in enumerate(notes)]
+        relevant = sorted(i for score, i in sorted(scored, key=lambda x: (-x[0], x[1]))[:CONTEXT_MAX_ITEMS] if score > 0)
+        notes = [notes[i] for i in relevant] or notes[:1]
+
+    return "**Recent conversations:**\n" + "\n".join(line for line, _ in notes)
+
 
 
 # ============================================
 # UPDATED /api/dementia/query ENDPOINT
 # ============================================
 
+# Conversation writes (summary + full turn) run after the response is sent
+_writer_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='turn-writer')
+
+# Research retrieval started speculatively while the patient/safety checks run
+_retrieval_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='rag-retrieve')
+
+# Patient row + 7-day summaries per code_hash; dropped whenever a turn is written
+turn_context_cache = TTLCache(maxsize=10_000, ttl=60)
+_turn_context_lock = threading.Lock()
+
+
+def get_turn_context(code_hash):
+    """Cached db_manager.load_turn_context (None for unknown codes is not cached)"""
+    with _turn_context_lock:
+        cached = turn_context_cache.get(code_hash)
+    if cached is not None:
+        return cached
+    
+    patient = db_manager.load_turn_context(code_hash, RECENT_SUMMARIES_SQL)
+    if patient:
+        with _turn_context_lock:
+            turn_context_cache[code_hash] = patient
+    return patient
+
+
+CONVERSATION_INSERT_SQL = """
+    INSERT INTO conversations (code_hash, encrypted_query, encrypted_response, sources, created_at)
+    VALUES (%s, %s, %s, %s, NOW())
+"""
+
+# Written on every coach turn - parsed/planned once per connection
+db_manager.register_prepared('conversation_insert', CONVERSATION_INSERT_SQL)
+db_manager.register_prepared('conversation_insert_with_summary', f"""
+    WITH conv AS ({CONVERSATION_INSERT_SQL} RETURNING id)
+    {SUMMARY_UPSERT_SQL}
+""")
+
+
+@functools.lru_cache(maxsize=1024)
+def _sources_json_cached(key):
+    return orjson.dumps([dict(items) for items in key]).decode()
+
+
+def sources_json(sources):
+    """JSON text for a sources list; repeated top-k results (and []) are serialized once"""
+    if not sources:
+        return '[]'
+    try:
+        return _sources_json_cached(tuple(tuple(s.items()) for s in sources))
+    except TypeError:  # unhashable value in a source
+        return orjson.dumps(sources).decode()
+
+
+def _persist_turn(code_hash, query, answer, encrypted_query, encrypted_response, sources):
+    """Store the full encrypted turn and today's summary in one round-trip"""
+    # Summary needs its own Gemini call - run it before opening a transaction
+    encrypted_item = build_summary_item(query, answer)
+    conversation_params = (code_hash, encrypted_query, encrypted_response, sources_json(sources))
+    
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            if encrypted_item:
+                db_manager.execute_prepared(
+                    cur, 'conversation_insert_with_summary',
+                    conversation_params + (code_hash, encrypted_item, encrypted_item)
+                )
+            else:
+                db_manager.execute_prepared(cur, 'conversation_insert', conversation_params)
+    except Exception as e:
+        logger.error("Conversation save failed for %s...: %s", code_hash[:8], e, exc_info=logger.isEnabledFor(logging.DEBUG))
+    finally:
+        with _turn_context_lock:
+            turn_context_cache.pop(code_hash, None)
+
+
+COACH_DISCLAIMER = 'This is caregiving support only. Always consult healthcare professionals for medical decisions.'
+
+
+def _start_coach_turn(data):
+    """
+    Shared front half of the coach endpoints: validation, cache/FAQ,
+    patient lookup, speculative retrieval and safety check.
+    Returns (early_response, turn) - exactly one of them is None.
+    """
+    code_hash = data.get('codeHash')
+    query = data.get('query')
+    
+    if not code_hash or not query:
+        return ojson({'error': 'Missing required fields'}, 400), None
+    
+    # Lowercase / normalize the question once for safety check, cache and context
+    query_ctx = QueryCtx.build(query)
+    
+    # Recent answer to the same question, else a curated FAQ answer
+    rag_response = rag_cache.get(code_hash, query_ctx)
+    faq_answer = None
+    if rag_response is None:
+        if time.monotonic() - coach_faq.loaded_at > FAQ_RELOAD_SECONDS:
+            load_coach_faq()
+        faq_answer = coach_faq.match(query_ctx)
+    
+    # Verify patient exists (same round-trip also brings the 7-day summaries)
+    patient = get_turn_context(code_hash)
+    if not patient:
+        return ojson({'error': 'Invalid patient code'}, 404), None
+    
+    # Speculative: start research search for a known patient, overlapping the
+    # safety check (>99% of messages are safe; result is dropped otherwise)
+    retrieval = None
+    if rag_response is None and not faq_answer:
+        retrieval = _retrieval_pool.submit(rag_pipeline.retrieve, query)
+    
+    # ✅ STEP 1: SAFETY CHECK FIRST (before any AI processing)
+    is_safe, crisis_response = check_safety_and_alert(
+        query_ctx.raw, code_hash, db_manager, message_lower=query_ctx.lower
+    )
+    
+    if not is_safe:
+        if retrieval:
+            retrieval.cancel()
+        # CRITICAL ALERT - Return crisis response, NO AI processing
+        body = _CRISIS_RESPONSE_BODIES.get(crisis_response) or orjson.dumps({
+            'success': True,
+            'answer': crisis_response,
+            'sources': [],
+            'safety_alert': True
+        })
+        return Response(body, status=200, mimetype='application/json'), None
+    
+    # ✅ STEP 2: Cached answer skips context + RAG
+    if rag_response is not None:
+        logger.info("♻️ RAG cache hit for %s...", code_hash[:8])
+    elif faq_answer:
+        # ✅ STEP 3: Curated FAQ answer, no retrieval or generation
+        rag_response = {'answer': faq_answer, 'sources': []}
+        rag_cache.put(code_hash, query_ctx, rag_response)
+    
+    return None, {
+        'code_hash': code_hash,
+        'query': query,
+        'query_ctx': query_ctx,
+        'patient': patient,
+        'retrieval': retrieval,
+        'rag_response': rag_response
+    }
+
+
+def _finish_coach_turn(turn, rag_response):
+    """Encrypt the turn inline (keeps write order = request order), store it in the background"""
+    encrypted_query, encrypted_response = encrypt_batch([turn['query'], rag_response['answer']])
+    
+    _writer_pool.submit(
+        _persist_turn, turn['code_hash'], turn['query'], rag_response['answer'],
+        encrypted_query, encrypted_response, rag_response.get('sources', [])
+    )
+
+
 # FIND your existing @app.route('/api/dementia/query', methods=['POST'])
 # and REPLACE it with this:
 
@@ -517,89 +846,128 @@ def get_conversation_context(code_hash, db_manager):
 def dementia_query():
     """CBT coach endpoint with safety guardrails and context"""
     try:
-        data = request.json
-        code_hash = data.get('codeHash')
-        query = data.get('query')
-        
-        if not code_hash or not query:
-            return jsonify({'error': 'Missing required fields'}), 400
-        
-        # Verify patient exists
-        patient = db_manager.get_patient_data(code_hash)
-        if not patient:
-            return jsonify({'error': 'Invalid patient code'}), 404
-        
-        # ✅ STEP 1: SAFETY CHECK FIRST (before any AI processing)
-        is_safe, crisis_response = check_safety_and_alert(query, code_hash, db_manager)
-        
-        if not is_safe:
-            # CRITICAL ALERT - Return crisis response, NO AI processing
-            return jsonify({
-                'success': True,
-                'answer': crisis_response,
-                'sources': [],
-                'safety_alert': True
-            }), 200
-        
-        # ✅ STEP 2: Get conversation context (last 7 days)
-        conversation_context = get_conversation_context(code_hash, db_manager)
-        
-        # ✅ STEP 3: Enhance query with context for RAG
-        if conversation_context:
-            enhanced_query = f"{conversation_context}\n\n**Today's question:** {query}"
-        else:
-            enhanced_query = query
-        
-        # ✅ STEP 4: Get RAG response
-        rag_response = rag_pipeline.get_response(enhanced_query)
-        
-        # ✅ STEP 5: Save conversation summary (async - don't block)
-        try:
-            save_daily_summary(code_hash, query, rag_response['answer'], db_manager)
-        except Exception as e:
-            logger.error(f"Summary save error: {e}")
-            pass  # Don't fail request if summary fails
+        early_response, turn = _start_coach_turn(request.json)
+        if early_response:
+            return early_response
+        
+        rag_response = turn['rag_response']
+        if rag_response is None:
+            # ✅ STEP 3: Pick the recent notes relevant to this question as the prompt prefix
+            conversation_context = format_conversation_context(turn['patient'], turn['query_ctx'])
+            
+            # ✅ STEP 4: RAG response (search on today's question only, already in flight)
+            rag_response = rag_pipeline.get_response(
+                turn['query'], prefix=conversation_context, retrieved=turn['retrieval'].result()
+            )
+            if not rag_response.get('error'):
+                rag_cache.put(turn['code_hash'], turn['query_ctx'], rag_response)
         
-        # ✅ STEP 6: Encrypt and store full conversation
-        from encryption import encrypt_data
-        encrypted_query = encrypt_data(query)
-        encrypted_response = encrypt_data(rag_response['answer'])
+        # ✅ STEP 5 + 6: Encrypt, then store conversation + summary in the background
+        _finish_coach_turn(turn, rag_response)
         
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO conversations (code_hash, encrypted_query, encrypted_response, sources, created_at)
-                VALUES (%s, %s, %s, %s, NOW())
-            """, (code_hash, encrypted_query, encrypted_response, json.dumps(rag_response.get('sources', []))))
-            conn.commit()
-        
-        return jsonify({
+        return ojson({
             'success': True,
             'answer': rag_response['answer'],
             'sources': rag_response.get('sources', []),
-            'disclaimer': 'This is caregiving support only. Always consult healthcare professionals for medical decisions.'
-        }), 200
+            'disclaimer': COACH_DISCLAIMER
+        })
     
     except Exception as e:
-        logger.error(f"Query error: {e}", exc_info=True)
-        return jsonify({'error': 'Query processing failed'}), 500
+        logger.error("Query error: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return ojson({'error': 'Query processing failed'}, 500)
+
+
+# Appended to an answer stored after the client dropped the stream
+PARTIAL_ANSWER_MARK = ' [response interrupted]'
+
+
+def _sse(payload):
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+@app.route('/api/dementia/query/stream', methods=['POST'])
+def dementia_query_stream():
+    """
+    Streaming CBT coach endpoint (Server-Sent Events).
+    Events: {"delta": text}... then {"done": true, "sources": [...], "disclaimer": ...}.
+    Errors before streaming starts are returned as normal JSON responses.
+    """
+    try:
+        early_response, turn = _start_coach_turn(request.json)
+        if early_response:
+            return early_response
+    except Exception as e:
+        logger.error("Query stream error: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return ojson({'error': 'Query processing failed'}, 500)
+    
+    # stream_with_context keeps the request alive for the whole Gemini stream;
+    # don't hold a pooled connection that long
+    db_manager.release_request_connection()
+    
+    def generate():
+        rag_response = turn['rag_response']
+        if rag_response is not None:
+            yield _sse({'delta': rag_response['answer']})
+        else:
+            conversation_context = format_conversation_context(turn['patient'], turn['query_ctx'])
+            sources, chunks = rag_pipeline.stream_response(
+                turn['query'], prefix=conversation_context, retrieved=turn['retrieval'].result()
+            )
+            parts = []
+            try:
+                for text in chunks:
+                    parts.append(text)
+                    yield _sse({'delta': text})
+            except GeneratorExit:
+                # Client disconnected mid-stream: keep the turn in history, marked
+                # partial, but never cache a truncated answer
+                answer = ''.join(parts).strip()
+                if answer and not chunks.error:
+                    _finish_coach_turn(turn, {'answer': answer + PARTIAL_ANSWER_MARK, 'sources': sources})
+                raise
+            
+            answer = ''.join(parts).strip()
+            rag_response = {'answer': answer, 'sources': sources}
+            if chunks.error:
+                # Generation failed and the fallback text was streamed: not a coach turn
+                logger.warning("Streamed answer failed for %s..., not cached or stored", turn['code_hash'][:8])
+            elif answer:
+                rag_cache.put(turn['code_hash'], turn['query_ctx'], rag_response)
+                _finish_coach_turn(turn, rag_response)
+        
+        yield _sse({'done': True, 'sources': rag_response.get('sources', []), 'disclaimer': COACH_DISCLAIMER})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 # ============================================
 # ADMIN DASHBOARD ENDPOINTS
 # ============================================
 
+# Expected Authorization header, built once (add env var: ADMIN_PASSWORD)
+_ADMIN_BEARER = f"Bearer {os.environ.get('ADMIN_PASSWORD', 'changeme123')}".encode()
+
+
+def require_admin(view):
+    """Reject requests without the admin bearer token (constant-time compare)"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        auth_header = request.headers.get('Authorization') or ''
+        if not hmac.compare_digest(auth_header.encode(), _ADMIN_BEARER):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
 @app.route('/api/admin/safety-alerts', methods=['GET'])
+@require_admin
 def get_safety_alerts():
     """Get unresolved safety alerts for admin dashboard"""
     try:
-        # Simple password check (add env var: ADMIN_PASSWORD)
-        auth_header = request.headers.get('Authorization')
-        admin_password = os.environ.get('ADMIN_PASSWORD', 'changeme123')
-        
-        if auth_header != f"Bearer {admin_password}":
-            return jsonify({'error': 'Unauthorized'}), 401
-        
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
@@ -617,24 +985,17 @@ def get_safety_alerts():
                     admin_notes
                 FROM safety_alerts
                 WHERE resolved = false
-                ORDER BY 
-                    CASE severity 
-                        WHEN 'critical' THEN 1 
-                        WHEN 'high' THEN 2 
-                        ELSE 3 
-                    END,
-                    timestamp DESC
+                ORDER BY severity_rank, timestamp DESC
                 LIMIT 100
             """)
             
-            columns = [desc[0] for desc in cur.description]
-            alerts = [dict(zip(columns, row)) for row in cur.fetchall()]
+            alerts = cur.fetchall()
         
-        return jsonify({
+        return ojson({
             'success': True,
             'alerts': alerts,
             'count': len(alerts)
-        }), 200
+        })
         
     except Exception as e:
         logger.error(f"Safety alerts error: {e}")
@@ -642,16 +1003,10 @@ def get_safety_alerts():
 
 
 @app.route('/api/admin/safety-alerts/<int:alert_id>/resolve', methods=['POST'])
+@require_admin
 def resolve_safety_alert(alert_id):
     """Mark alert as resolved with admin notes"""
     try:
-        # Auth check
-        auth_header = request.headers.get('Authorization')
-        admin_password = os.environ.get('ADMIN_PASSWORD', 'changeme123')
-        
-        if auth_header != f"Bearer {admin_password}":
-            return jsonify({'error': 'Unauthorized'}), 401
-        
         data = request.json
         admin_notes = data.get('notes', '')
         
@@ -667,6 +1022,9 @@ def resolve_safety_alert(alert_id):
             """, (admin_notes, alert_id))
             conn.commit()
         
+        with _safety_stats_lock:
+            safety_stats_cache.clear()
+        
         logger.info(f"✓ Alert {alert_id} resolved by admin")
         return jsonify({'success': True}), 200
         
@@ -675,41 +1033,39 @@ def resolve_safety_alert(alert_id):
         return jsonify({'error': str(e)}), 500
 
 
+safety_stats_cache = TTLCache(maxsize=1, ttl=30)
+_safety_stats_lock = threading.Lock()
+
+
 @app.route('/api/admin/safety-alerts/stats', methods=['GET'])
+@require_admin
 def get_safety_stats():
     """Get safety alert statistics"""
     try:
-        # Auth check
-        auth_header = request.headers.get('Authorization')
-        admin_password = os.environ.get('ADMIN_PASSWORD', 'changeme123')
+        # Dashboard polls; counts only need to be ~30s fresh (?refresh=1 bypasses)
+        with _safety_stats_lock:
+            stats = None if request.args.get('refresh') == '1' else safety_stats_cache.get('stats')
         
-        if auth_header != f"Bearer {admin_password}":
-            return jsonify({'error': 'Unauthorized'}), 401
-        
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            
-            # Get stats
-            cur.execute("""
-                SELECT 
-                    COUNT(*) as total_alerts,
-                    COUNT(*) FILTER (WHERE resolved = false) as unresolved,
-                    COUNT(*) FILTER (WHERE severity = 'critical') as critical_count,
-                    COUNT(*) FILTER (WHERE alert_type = 'suicide') as suicide_count,
-                    COUNT(*) FILTER (WHERE alert_type = 'harm_others') as harm_others_count,
-                    COUNT(*) FILTER (WHERE timestamp >= NOW() - INTERVAL '24 hours') as last_24h
-                FROM safety_alerts
-            """)
+        if stats is None:
+            with db_manager.get_connection() as conn:
+                cur = conn.cursor()
+                
+                # Get stats
+                cur.execute("""
+                    SELECT 
+                        COUNT(*) as total_alerts,
+                        COUNT(*) FILTER (WHERE resolved = false) as unresolved,
+                        COUNT(*) FILTER (WHERE severity = 'critical') as critical_count,
+                        COUNT(*) FILTER (WHERE alert_type = 'suicide') as suicide_count,
+                        COUNT(*) FILTER (WHERE alert_type = 'harm_others') as harm_others_count,
+                        COUNT(*) FILTER (WHERE timestamp >= NOW() - INTERVAL '24 hours') as last_24h
+                    FROM safety_alerts
+                """)
+                
+                stats = dict(cur.fetchone())
             
-            row = cur.fetchone()
-            stats = {
-                'total_alerts': row[0],
-                'unresolved': row[1],
-                'critical_count': row[2],
-                'suicide_count': row[3],
-                'harm_others_count': row[4],
-                'last_24h': row[5]
-            }
+            with _safety_stats_lock:
+                safety_stats_cache['stats'] = stats
         
         return jsonify({
             'success': True,
@@ -750,50 +1106,99 @@ pii_filter = PIIFilter()
 def alarm_page():
     return render_template('ALARM.html')
 
+ALARMS_PAGE_MAX = 500
+# ?after_time= as returned in `time` ('HH:MM:SS'); 'HH:MM' also accepted
+_ALARM_AFTER_TIME_RE = re.compile(r'\d{2}:\d{2}(?::[0-5]\d)?')
+
+
 @app.route('/api/alarms', methods=['GET'])
 def get_alarms():
+    """
+    Alarms for one patient (?code_hash=...), or all alarms.
+    All-alarms mode is unbounded (streamed) unless paging is asked for: keyset
+    on (time, id) with ?limit= (max 500) and, for the next page,
+    ?after_time=&after_id= taken from the last item returned.
+    A page shorter than `limit` is the last one.
+    """
     try:
         code_hash = request.args.get('code_hash')
+        limit = max(1, min(request.args.get('limit', ALARMS_PAGE_MAX, type=int), ALARMS_PAGE_MAX))
+        after_time = request.args.get('after_time')
+        after_id = request.args.get('after_id', type=int)
+        paged = 'limit' in request.args or after_time is not None or after_id is not None
         
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS medication_reminders (
-                    id SERIAL PRIMARY KEY,
-                    code_hash VARCHAR(64),
-                    medication_name VARCHAR(200) NOT NULL,
-                    time TIME NOT NULL,
-                    followup_time TIME,
-                    active BOOLEAN DEFAULT true,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    phone_number VARCHAR(20),
-                    last_called TIMESTAMP,
-                    daily_status VARCHAR(10) NOT NULL DEFAULT 'PENDING'
-                )
-            """)
-            conn.commit()
-            
-            if code_hash:
-                cur.execute("""
-                    SELECT id, medication_name, time::text as time, active, code_hash, daily_status
-                    FROM medication_reminders 
-                    WHERE code_hash = %s
-                    ORDER BY time
-                """, (code_hash,))
-            else:
-                cur.execute("""
-                    SELECT id, medication_name, time::text as time, active, code_hash, daily_status
-                    FROM medication_reminders 
-                    ORDER BY time
-                """)
-            
-            alarms = cur.fetchall()
-            return jsonify([dict(alarm) for alarm in alarms]), 200
+        # Validate before streaming: once '[' is sent, an error can't become a 400
+        if after_time is not None and (not _ALARM_AFTER_TIME_RE.fullmatch(after_time)
+                                       or hhmm_to_minutes(after_time) is None):
+            return jsonify({'error': 'after_time must be HH:MM or HH:MM:SS'}), 400
+        
+        def generate():
+            with db_manager.get_connection() as conn:
+                # Server-side cursor: rows arrive in batches of 500, never all at once
+                cur = conn.cursor(name='alarms_cur')
+                cur.itersize = 500
+                
+                if code_hash:
+                    cur.execute("""
+                        SELECT id, medication_name, time::text as time, active, code_hash, daily_status
+                        FROM medication_reminders 
+                        WHERE code_hash = %s
+                        ORDER BY time
+                    """, (code_hash,))
+                elif after_time and after_id is not None:
+                    cur.execute("""
+                        SELECT id, medication_name, time::text as time, active, code_hash, daily_status
+                        FROM medication_reminders 
+                        WHERE (time, id) > (%s::time, %s)
+                        ORDER BY time, id
+                        LIMIT %s
+                    """, (after_time, after_id, limit))
+                elif not paged:
+                    # Existing clients (loveuad-alarm.html) fetch everything in one call
+                    cur.execute("""
+                        SELECT id, medication_name, time::text as time, active, code_hash, daily_status
+                        FROM medication_reminders 
+                        ORDER BY time, id
+                    """)
+                else:
+                    cur.execute("""
+                        SELECT id, medication_name, time::text as time, active, code_hash, daily_status
+                        FROM medication_reminders 
+                        ORDER BY time, id
+                        LIMIT %s
+                    """, (limit,))
+                
+                yield b'['
+                for i, alarm in enumerate(cur):
+                    yield (b',' if i else b'') + orjson.dumps(alarm)
+                yield b']'
+                cur.close()
+        
+        # Run the query before committing to a 200 so DB errors still return 500
+        body = generate()
+        first_chunk = next(body)
+        return Response(
+            stream_with_context(itertools.chain([first_chunk], body)),
+            mimetype='application/json'
+        )
     except Exception as e:
         logger.error(f"Get alarms error: {e}")
         return jsonify({'error': str(e)}), 500
 
+MINUTES_PER_DAY = 24 * 60
+
+
+def hhmm_to_minutes(hhmm):
+    """'HH:MM' (seconds ignored) -> minutes since midnight, or None if malformed"""
+    hours, sep, minutes = (hhmm or '')[:5].partition(':')
+    if not (sep and hours.isdigit() and minutes.isdigit()):
+        return None
+    hours, minutes = int(hours), int(minutes)
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+
+
 @app.route('/api/alarms/check', methods=['POST'])
 def check_alarms():
     try:
@@ -801,27 +1206,32 @@ def check_alarms():
         current_time = data.get('time')
         code_hash = data.get('code_hash')
         
+        # "HH:MM" -> [HH:MM:00, HH:MM+1) range on the TIME column (index-friendly)
+        start = hhmm_to_minutes(current_time)
+        if start is None:
+            return jsonify({'error': 'time must be HH:MM'}), 400
+        end = start + 1
+        
+        conditions = ["active = true", "time >= %s"]
+        params = [dt_time(start // 60, start % 60)]
+        if end < MINUTES_PER_DAY:  # 23:59 has no upper bound within the day
+            conditions.append("time < %s")
+            params.append(dt_time(end // 60, end % 60))
+        if code_hash:
+            conditions.append("code_hash = %s")
+            params.append(code_hash)
+        
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            if code_hash:
-                cur.execute("""
-                    SELECT id, medication_name, time::text as time, code_hash, daily_status
-                    FROM medication_reminders 
-                    WHERE time::text LIKE %s || '%%' 
-                    AND active = true
-                    AND code_hash = %s
-                """, (current_time, code_hash))
-            else:
-                cur.execute("""
-                    SELECT id, medication_name, time::text as time, code_hash, daily_status
-                    FROM medication_reminders 
-                    WHERE time::text LIKE %s || '%%' 
-                    AND active = true
-                """, (current_time,))
+            cur.execute(f"""
+                SELECT id, medication_name, time::text as time, code_hash, daily_status
+                FROM medication_reminders 
+                WHERE {' AND '.join(conditions)}
+            """, params)
             
             alarms = cur.fetchall()
-            return jsonify([dict(alarm) for alarm in alarms]), 200
+            return ojson(alarms)
     except Exception as e:
         logger.error(f"Check alarms error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -837,26 +1247,18 @@ def add_alarm():
         if not medication_name or not time:
             return jsonify({'error': 'medication_name and time required'}), 400
         
-        # Calculate followup time (time + 10 minutes)
-        from datetime import datetime, timedelta
-        time_obj = datetime.strptime(time, '%H:%M')
-        followup_obj = time_obj + timedelta(minutes=10)
-        followup_time = followup_obj.strftime('%H:%M')
-        
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            # Get phone
-            cur.execute("SELECT encrypted_data FROM patients WHERE code_hash = %s", (code_hash,))
-            patient = cur.fetchone()
-            patient_data = decrypt_data(patient['encrypted_data'])
-            phone_number = patient_data.get('phoneNumber', '')
-            
+            # Phone comes from the patients.phone_number column (no decrypt);
+            # followup time (time + 10 minutes) is computed by Postgres
             cur.execute("""
                 INSERT INTO medication_reminders (code_hash, medication_name, time, followup_time, phone_number, active, daily_status)
-                VALUES (%s, %s, %s, %s, %s, true, 'PENDING')
+                VALUES (%s, %s, %s::time, %s::time + INTERVAL '10 minutes',
+                        COALESCE((SELECT phone_number FROM patients WHERE code_hash = %s), ''),
+                        true, 'PENDING')
                 RETURNING id
-            """, (code_hash, medication_name, time, followup_time, phone_number))
+            """, (code_hash, medication_name, time, time, code_hash))
             
             conn.commit()
             return jsonify({'success': True}), 201
@@ -880,25 +1282,14 @@ def push_subscribe():
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            # Create table if not exists
+            # Insert or update subscription (keyed on the hash of its canonical JSON)
+            subscription_json = orjson.dumps(subscription).decode()
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS push_subscriptions (
-                    id SERIAL PRIMARY KEY,
-                    code_hash VARCHAR(64) NOT NULL,
-                    subscription_data TEXT NOT NULL,
-                    active BOOLEAN DEFAULT true,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(code_hash, subscription_data)
-                )
-            """)
-            
-            # Insert or update subscription
-            cur.execute("""
-                INSERT INTO push_subscriptions (code_hash, subscription_data)
-                VALUES (%s, %s)
-                ON CONFLICT (code_hash, subscription_data) 
+                INSERT INTO push_subscriptions (code_hash, subscription_data, sub_hash)
+                VALUES (%s, %s, sha256(convert_to(%s::jsonb::text, 'UTF8')))
+                ON CONFLICT (code_hash, sub_hash) 
                 DO UPDATE SET active = true
-            """, (code_hash, json.dumps(subscription)))
+            """, (code_hash, subscription_json, subscription_json))
             
             conn.commit()
         
@@ -909,13 +1300,31 @@ def push_subscribe():
         logger.error(f"Push subscribe error: {e}")
         return jsonify({'error': str(e)}), 500
 
+VAPID_PUBLIC_KEY = os.environ.get('VAPID_PUBLIC_KEY', '')
+VAPID_PRIVATE_KEY = os.environ.get('VAPID_PRIVATE_KEY')
+VAPID_SUBJECT = 'mailto:admin@loveuad.com'
+
+# Private key parsed once (webpush() re-derived it for every message)
+VAPID = Vapid.from_string(VAPID_PRIVATE_KEY) if VAPID_PRIVATE_KEY else None
+
 @app.route('/api/push/vapid-public-key', methods=['GET'])
 def get_vapid_public_key():
     """Get VAPID public key for push notifications"""
     return jsonify({
-        'publicKey': os.environ.get('VAPID_PUBLIC_KEY', '')
+        'publicKey': VAPID_PUBLIC_KEY
     }), 200
 
+# One fixed statement for every partial update; followup_time tracks a new time
+db_manager.register_prepared('alarm_update', """
+    UPDATE medication_reminders SET
+        medication_name = COALESCE(%s, medication_name),
+        time = COALESCE(%s::time, time),
+        followup_time = COALESCE(%s::time + INTERVAL '10 minutes', followup_time),
+        active = COALESCE(%s, active)
+    WHERE id = %s
+    RETURNING id
+""")
+
 @app.route('/api/alarms/<int:alarm_id>', methods=['PUT'])
 def update_alarm(alarm_id):
     try:
@@ -924,28 +1333,14 @@ def update_alarm(alarm_id):
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            updates = []
-            values = []
-            
-            if 'medication_name' in data:
-                updates.append("medication_name = %s")
-                values.append(data['medication_name'])
-            
-            if 'time' in data:
-                updates.append("time = %s")
-                values.append(data['time'])
-            
-            if 'active' in data:
-                updates.append("active = %s")
-                values.append(data['active'])
-            
-            if not updates:
+            if not any(field in data for field in ('medication_name', 'time', 'active')):
                 return jsonify({'error': 'No fields to update'}), 400
             
-            values.append(alarm_id)
-            query = f"UPDATE medication_reminders SET {', '.join(updates)} WHERE id = %s RETURNING id"
-            
-            cur.execute(query, values)
+            # Fields left out (or null) keep their current value
+            time = data.get('time')
+            db_manager.execute_prepared(cur, 'alarm_update', (
+                data.get('medication_name'), time, time, data.get('active'), alarm_id
+            ))
             result = cur.fetchone()
             
             if not result:
@@ -1023,6 +1418,10 @@ def register_patient():
 def register_patient_noapi():
     return register_patient()
 
+# Cheap checks applied to login codes before any hashing or DB work
+_DASH_TABLE = str.maketrans('', '', '-')
+_PATIENT_CODE_RE = re.compile(r'[A-Z0-9]{17}')
+
 @app.route('/api/patient/login', methods=['POST', 'GET'])
 def login_patient():
     """Login with patient code (17-character format: XXXX-XXXX-XXXX-XXXX-X)"""
@@ -1047,8 +1446,8 @@ def login_patient():
             # Final fallback: try to load JSON manually from raw data (for bad content types)
             if not data and request.data:
                 try:
-                    data = json.loads(request.data)
-                except (TypeError, json.JSONDecodeError):
+                    data = orjson.loads(request.data)
+                except (TypeError, orjson.JSONDecodeError):
                     # Data is unusable or not JSON/form, proceed with empty dict
                     data = {}
     
@@ -1069,18 +1468,23 @@ def login_patient():
     patient_code = data.get('patientCode')
     
     try:
-        if not patient_code:
+        if not patient_code or not isinstance(patient_code, str):
             return jsonify({'error': 'Patient code required'}), 400
         
         # Clean and validate code format
         # NOTE: This uses the code sent over the network, which may be unformatted or formatted.
-        clean_code = patient_code.replace('-', '').strip().upper()
+        clean_code = patient_code.translate(_DASH_TABLE).strip().upper()
         
         # Only accept 17-char format (XXXX-XXXX-XXXX-XXXX-X)
         if len(clean_code) != 17:
             logger.warning(f"Invalid code length: {len(clean_code)} chars (expected 17)")
             return jsonify({'error': f'Invalid code format. Expected 17 characters (XXXX-XXXX-XXXX-XXXX-X), got {len(clean_code)}'}), 400
         
+        # Codes are generated from A-Z0-9 only: anything else cannot exist, skip hash + DB
+        if not _PATIENT_CODE_RE.fullmatch(clean_code):
+            logger.warning("Invalid code characters")
+            return jsonify({'error': 'Invalid code format. Codes contain only letters and digits (XXXX-XXXX-XXXX-XXXX-X)'}), 400
+        
         # NOTE: You should hash the CLEANED code, not the raw code, to ensure consistency.
         # Assuming hash_patient_code is designed to handle the 17-char code:
         code_hash = hash_patient_code(clean_code) 
@@ -1124,21 +1528,27 @@ def login_patient():
         
         return jsonify({'error': f'Login failed: {str(e)}'}), 500
 
+@functools.lru_cache(maxsize=4096)
+def render_qr_png(code):
+    """PNG bytes of the QR code for a patient code (codes never change)"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(code)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    
+    img_io = io.BytesIO()
+    img.save(img_io, 'PNG')
+    return img_io.getvalue()
+
 @app.route('/api/patient/qr/<code>', methods=['GET'])
 def generate_qr(code):
     """Generate QR code for patient code"""
     try:
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(code)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        img_io = io.BytesIO()
-        img.save(img_io, 'PNG')
-        img_io.seek(0)
-        
-        return send_file(img_io, mimetype='image/png')
+        response = send_file(io.BytesIO(render_qr_png(code)), mimetype='image/png')
+        # The image encodes a patient's login code: browser cache only, never shared caches
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        return response
     
     except Exception as e:
         logger.error(f"QR generation error: {e}")
@@ -1167,7 +1577,7 @@ def add_medication():
         
         # Encrypt and store
         encrypted_data = encrypt_data(medication)
-        db_manager.insert_medication(code_hash, encrypted_data)
+        db_manager.insert_medication(code_hash, encrypted_data, hash_medication_name(medication.get('name')))
         
         return jsonify({'success': True, 'message': 'Medication added'}), 201
     
@@ -1191,11 +1601,20 @@ def get_random_paper():
     try:
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT MAX(id) FROM research_papers;")
-            max_id = cur.fetchone()['max']
+            # Random point in the id range, then the first existing id at or after it:
+            # one round-trip on the primary key, never lands on a deleted id
+            cur.execute("""
+                SELECT id FROM research_papers
+                WHERE id >= (SELECT floor(random() * MAX(id))::int + 1 FROM research_papers)
+                ORDER BY id
+                LIMIT 1;
+            """)
+            paper = cur.fetchone()
+        
+        if not paper:
+            return jsonify({'error': 'No papers available'}), 404
         
-        import random
-        return jsonify({'success': True, 'paperId': random.randint(1, max_id)}), 200
+        return jsonify({'success': True, 'paperId': paper['id']}), 200
     except Exception as e:
         logger.error(f"Random error: {e}")
         return jsonify({'error': 'Failed'}), 500
@@ -1236,6 +1655,23 @@ def get_paper(paper_id):
         logger.error(f"Get paper error: {e}")
         return jsonify({'error': 'Failed to fetch paper'}), 500
 
+# Adherence entries the (now read-only) patient blob was capped at when it was
+# still written: 3 meds * 3 times * 30 days. The only definition - writers
+# append to medication_adherence instead.
+ADHERENCE_BLOB_MAX = 270
+
+def load_adherence(code_hash, patient_data, since_date=None):
+    """
+    A patient's adherence records, oldest first: rows of the medication_adherence
+    table plus entries still kept in the patient blob ('medicationAdherence').
+    """
+    legacy = (patient_data or {}).get('medicationAdherence', [])
+    if since_date:
+        legacy = [a for a in legacy if (a.get('date') or '') >= since_date]
+    records = legacy + db_manager.get_adherence(code_hash, since_date)
+    records.sort(key=lambda a: a.get('takenAt') or '')
+    return records
+
 @app.route('/api/medications/<code_hash>', methods=['GET'])
 def get_medications(code_hash):
     """Get all active medications for patient with today's adherence status"""
@@ -1248,36 +1684,35 @@ def get_medications(code_hash):
         patient = db_manager.get_patient_data(code_hash)
         if patient:
             patient_data = decrypt_data(patient['encrypted_data'])
-            adherence_history = patient_data.get('medicationAdherence', [])
             
             # Get today's date
             today = datetime.now().strftime('%Y-%m-%d')
-            today_adherence = [a for a in adherence_history if a.get('date') == today]
+            taken_set = {
+                (a.get('medication'), a.get('scheduledTime'))
+                for a in load_adherence(code_hash, patient_data, since_date=today)
+                if a.get('date') == today
+            }
             
             # Add adherence status to each medication time
             for med in decrypted_meds:
-                if 'times' in med:
-                    for i, time in enumerate(med['times']):
-                        # Check if this medication at this time was taken today
-                        taken = any(
-                            a.get('medication') == med['name'] and 
-                            a.get('scheduledTime') == time 
-                            for a in today_adherence
-                        )
-                        # Add taken status to each time slot
-                        if 'takenStatus' not in med:
-                            med['takenStatus'] = {}
-                        med['takenStatus'][time] = taken
+                if med.get('times'):
+                    taken_status = med.setdefault('takenStatus', {})
+                    for slot in med['times']:
+                        taken_status[slot] = (med['name'], slot) in taken_set
         
-        return jsonify({
+        return ojson({
             'success': True,
             'medications': decrypted_meds
-        }), 200
+        })
     
     except Exception as e:
         logger.error(f"Get medications error: {e}")
         return jsonify({'error': 'Failed to fetch medications'}), 500
 
+# execute_values row for medication_reminders; the time is passed twice so
+# Postgres can derive followup_time (time + 10 minutes)
+REMINDER_ROW_TEMPLATE = "(%s, %s, %s::time, %s::time + INTERVAL '10 minutes', %s, true, 'PENDING')"
+
 @app.route('/api/medications/update', methods=['POST'])
 def update_medication():
     """Update medication in medications table AND medication_reminders table"""
@@ -1297,34 +1732,43 @@ def update_medication():
             patient = cur.fetchone()
             phone_number = patient['phone_number'] if patient else ''
             
-            # Get ALL medication rows (same as get_medications does)
-            cur.execute("SELECT id, encrypted_data FROM medications WHERE code_hash = %s", (code_hash,))
-            all_med_rows = cur.fetchall()
+            # Find the medication by name hash (index lookup, no decrypting)
+            name_hash = hash_medication_name(medication.get('name'))
+            cur.execute("""
+                SELECT id FROM medications
+                WHERE code_hash = %s AND name_hash = %s
+                LIMIT 1
+            """, (code_hash, name_hash))
+            row = cur.fetchone()
+            med_id = row['id'] if row else None
+            
+            # Rows saved before name_hash existed: decrypt only those, once
+            if med_id is None:
+                cur.execute("""
+                    SELECT id, encrypted_data FROM medications
+                    WHERE code_hash = %s AND name_hash IS NULL
+                """, (code_hash,))
+                for legacy in cur.fetchall():
+                    existing_med = decrypt_data(legacy['encrypted_data']) or {}
+                    if existing_med.get('name') == medication.get('name'):
+                        med_id = legacy['id']
+                        break
             
-            # Find the medication to update
             medication['updatedAt'] = datetime.utcnow().isoformat()
-            updated = False
+            encrypted_data = encrypt_data(medication)
             
-            for row in all_med_rows:
-                existing_med = decrypt_data(row['encrypted_data'])
-                if existing_med.get('name') == medication.get('name'):
-                    # Update this specific row
-                    encrypted_data = encrypt_data(medication)
-                    cur.execute("""
-                        UPDATE medications 
-                        SET encrypted_data = %s 
-                        WHERE id = %s
-                    """, (encrypted_data, row['id']))
-                    updated = True
-                    break
-            
-            # If medication not found, insert it
-            if not updated:
-                encrypted_data = encrypt_data(medication)
+            if med_id is not None:
+                cur.execute("""
+                    UPDATE medications 
+                    SET encrypted_data = %s, name_hash = %s
+                    WHERE id = %s
+                """, (encrypted_data, name_hash, med_id))
+            else:
+                # If medication not found, insert it
                 cur.execute("""
-                    INSERT INTO medications (code_hash, encrypted_data, active)
-                    VALUES (%s, %s, true)
-                """, (code_hash, encrypted_data))
+                    INSERT INTO medications (code_hash, encrypted_data, name_hash, active)
+                    VALUES (%s, %s, %s, true)
+                """, (code_hash, encrypted_data, name_hash))
             
             # Update medication_reminders table
             cur.execute("""
@@ -1332,16 +1776,16 @@ def update_medication():
                 WHERE code_hash = %s AND medication_name = %s
             """, (code_hash, medication['name']))
             
-            for time in medication.get('times', []):
-                time_obj = datetime.strptime(time, '%H:%M')
-                followup_obj = time_obj + timedelta(minutes=10)
-                followup_time = followup_obj.strftime('%H:%M')
-                
-                cur.execute("""
+            rows = [(code_hash, medication['name'], time, time, phone_number)
+                    for time in medication.get('times', [])]
+            
+            # All reminder rows in one statement, followup = time + 10 minutes
+            if rows:
+                execute_values(cur, """
                     INSERT INTO medication_reminders 
                     (code_hash, medication_name, time, followup_time, phone_number, active, daily_status)
-                    VALUES (%s, %s, %s, %s, %s, true, 'PENDING')
-                """, (code_hash, medication['name'], time, followup_time, phone_number))
+                    VALUES %s
+                """, rows, template=REMINDER_ROW_TEMPLATE, page_size=100)
             
             conn.commit()
         
@@ -1354,47 +1798,80 @@ def update_medication():
 
 # ==================== PRESCRIPTION SCANNING ====================
 
-@app.route('/api/scan/prescription', methods=['POST'])
-def scan_prescription():
-    """Scan prescription using Gemini Vision with PII filtering - NO DIAGNOSIS"""
-    try:
-        data = request.json
-        image_data = data.get('image')
-        code_hash = data.get('codeHash')
-        
-        if not image_data or not code_hash:
-            return jsonify({'error': 'Missing required fields'}), 400
-        
-        # Verify patient
-        patient = db_manager.get_patient_data(code_hash)
-        if not patient:
-            return jsonify({'error': 'Invalid patient code'}), 404
-        
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data.split(',')[1] if ',' in image_data else image_data)
-        
-        # OCR with Gemini Vision
-        prompt = """Extract medication information from this prescription image.
+def decode_image_data(image_data):
+    """Bytes of a base64 image, given bare or as a data URI ('data:...;base64,<b64>')"""
+    return binascii.a2b_base64(image_data.partition(',')[2] or image_data)
+
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
 
-Return ONLY the following information in this exact format:
+def parse_json_reply(text):
+    """JSON object from a model reply, tolerating ```json fences or surrounding prose; None if absent"""
+    match = _JSON_OBJECT_RE.search(text or '')
+    if not match:
+        return None
+    try:
+        parsed = orjson.loads(match.group(0))
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+# Long edge sent to Gemini Vision: it bills and slows by pixel area, and camera
+# photos are several times larger than OCR needs
+VISION_MAX_EDGE = 1568
+VISION_JPEG_QUALITY = 85
+
+
+def prepare_vision_image(image):
+    """Upright, downscaled RGB JPEG copy of a photo for Gemini Vision"""
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    image.convert('RGB').save(buf, 'JPEG', quality=VISION_JPEG_QUALITY, optimize=True)
+    buf.seek(0)
+    return Image.open(buf)
+
+# Parsed Vision replies by image content + prompt text (retried scans of the same
+# photo skip Gemini; editing a prompt changes its key, so nothing stale is served)
+vision_reply_cache = TTLCache(maxsize=1024, ttl=86400)
+_vision_reply_lock = threading.Lock()
+
+# Vision prompts ask for one JSON object; have the model emit JSON itself
+# (parse_json_reply still tolerates a stray fence or prose around it)
+VISION_GENERATION_CONFIG = {'response_mime_type': 'application/json'}
+
+
+def vision_reply(prompt, image_bytes):
+    """(parsed JSON dict or None, reply text) of one Gemini Vision call.
+    Only replies that parsed to a dict with non-empty "ocr_text" are cached, so
+    a garbled or empty read is retried on the next scan. The image is only
+    opened on a cache miss (UnidentifiedImageError if it isn't one)."""
+    key = (hashlib.blake2b(image_bytes, digest_size=16).hexdigest(),
+           hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).hexdigest())
+    with _vision_reply_lock:
+        cached = vision_reply_cache.get(key)
+    if cached is not None:
+        logger.info("♻️ Vision cache hit")
+        return cached
+    
+    image = prepare_vision_image(Image.open(io.BytesIO(image_bytes)))
+    text = vision_model.generate_content([prompt, image], generation_config=VISION_GENERATION_CONFIG).text
+    parsed = parse_json_reply(text)
+    reply = (parsed, text)
+    if isinstance(parsed, dict) and str(parsed.get('ocr_text') or '').strip():
+        with _vision_reply_lock:
+            vision_reply_cache[key] = reply
+    return reply
+
+# OCR and caregiving guidance in one Gemini Vision call
+PRESCRIPTION_SCAN_PROMPT = """Read this prescription image and return ONE JSON object with exactly two string fields:
+
+"ocr_text": the medication information, in this exact format:
 Medication Name: [name]
 Dosage: [dosage]
 Frequency: [frequency]
 Instructions: [instructions]
 
-Do not include any patient names, addresses, or personal information."""
-        
-        # Convert bytes to PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
-        response = vision_model.generate_content([prompt, image])
-        
-        ocr_text = response.text
-        
-        # Filter PII
-        filtered_text = pii_filter.remove_pii(ocr_text)
-        
-        # AI Analysis with Gemini - NO DIAGNOSIS VERSION
-        analysis_prompt = f"""Analyze this prescription and provide CAREGIVING GUIDANCE ONLY.
+"ai_analysis": CAREGIVING GUIDANCE ONLY for that medication.
 
 CRITICAL: You CANNOT diagnose conditions or interpret symptoms. You can ONLY provide:
 - Medication management tips
@@ -1402,9 +1879,6 @@ CRITICAL: You CANNOT diagnose conditions or interpret symptoms. You can ONLY pro
 - Storage guidance
 - What healthcare professionals typically advise
 
-Prescription Text:
-{filtered_text}
-
 Provide ONLY:
 1. Medication summary (what it is commonly prescribed for - general info only)
 2. Important safety warnings
@@ -1417,12 +1891,43 @@ DO NOT:
 - Interpret why this was prescribed for this specific patient
 - Make medical recommendations
 
-Always end with: "Consult the prescribing doctor for questions about this medication."
+Always end ai_analysis with: "Consult the prescribing doctor for questions about this medication."
 
-Be concise and practical."""
+Be concise and practical. Do not include any patient names, addresses, or personal information in either field.
+Return only the JSON object."""
+
+@app.route('/api/scan/prescription', methods=['POST'])
+def scan_prescription():
+    """Scan prescription using Gemini Vision with PII filtering - NO DIAGNOSIS"""
+    try:
+        data = request.json
+        image_data = data.get('image')
+        code_hash = data.get('codeHash')
         
-        analysis_response = vision_model.generate_content(analysis_prompt)
-        ai_analysis = analysis_response.text
+        if not image_data or not code_hash:
+            return jsonify({'error': 'Missing required fields'}), 400
+        
+        # Verify patient
+        patient = db_manager.get_patient_data(code_hash)
+        if not patient:
+            return jsonify({'error': 'Invalid patient code'}), 404
+        
+        # Decode base64 image
+        image_bytes = decode_image_data(image_data)
+        
+        # OCR + caregiving analysis with Gemini Vision - one call, NO DIAGNOSIS
+        parsed, reply_text = vision_reply(PRESCRIPTION_SCAN_PROMPT, image_bytes)
+        if parsed:
+            ocr_text = str(parsed.get('ocr_text') or '')
+            ai_analysis = str(parsed.get('ai_analysis') or '')
+        else:
+            logger.warning("Prescription scan: reply was not JSON, keeping it as OCR text")
+            ocr_text = reply_text
+            ai_analysis = 'Consult the prescribing doctor for questions about this medication.'
+        
+        # Filter PII (both fields come from the image)
+        filtered_text = pii_filter.remove_pii(ocr_text)
+        ai_analysis = pii_filter.remove_pii(ai_analysis)
         
         # Store as health record
         record_metadata = {
@@ -1454,14 +1959,18 @@ Be concise and practical."""
 def get_health_records(code_hash):
     """Get health records for patient"""
     try:
-        records = db_manager.get_health_records(code_hash)
+        # Verify patient + get records (one round-trip)
+        records = db_manager.get_records_if_patient(code_hash)
+        if records is None:
+            return jsonify({'error': 'Invalid patient code'}), 404
         
+        metadata = decrypt_batch([r['encrypted_metadata'] for r in records])
         decrypted_records = [{
             'id': r['id'],
             'recordType': r['record_type'],
-            'metadata': decrypt_data(r['encrypted_metadata']),
+            'metadata': meta,
             'createdAt': r['created_at']
-        } for r in records]
+        } for r, meta in zip(records, metadata)]
         
         return jsonify({
             'success': True,
@@ -1511,6 +2020,20 @@ def connect_caregiver():
 
 # ==================== DEMENTIA RAG ENDPOINTS ====================
 
+# Diagnosis phrases for the legacy endpoint, compiled once into one alternation
+# (plain substring semantics, same as the old `keyword in query_lower` loop)
+_QUERYOLD_DIAGNOSIS_RE = re.compile('|'.join(re.escape(kw) for kw in (
+    'diagnose', 'diagnosis', 'what does he have', 'what does she have',
+    'what condition', 'what disease', 'what is wrong', 'does he have',
+    'does she have', 'is this', 'is it', 'could this be'
+)))
+
+# get_response(query) has no per-patient input, so answers are shared across
+# patients, keyed on the whitespace-normalized question only; separate from
+# rag_cache (coach answers carry context)
+queryold_cache = TTLCache(maxsize=4096, ttl=86400)
+_queryold_lock = threading.Lock()
+
 @app.route('/api/dementia/queryold', methods=['POST', 'GET'])
 def dementia_queryold():
     """Get dementia guidance with research citations - NO DIAGNOSIS"""
@@ -1527,15 +2050,9 @@ def dementia_queryold():
         if not patient:
             return jsonify({'error': 'Invalid patient code'}), 404
         
-        # SAFETY CHECK: Detect diagnosis requests
-        diagnosis_keywords = [
-            'diagnose', 'diagnosis', 'what does he have', 'what does she have',
-            'what condition', 'what disease', 'what is wrong', 'does he have',
-            'does she have', 'is this', 'is it', 'could this be'
-        ]
-        
+        # SAFETY CHECK: Detect diagnosis requests (one compiled scan)
         query_lower = query.lower()
-        is_diagnosis_request = any(keyword in query_lower for keyword in diagnosis_keywords)
+        is_diagnosis_request = _QUERYOLD_DIAGNOSIS_RE.search(query_lower) is not None
         
         if is_diagnosis_request:
             # Return polite decline for diagnosis requests
@@ -1562,8 +2079,16 @@ Would you like practical caregiving advice instead?""",
                 'disclaimer': '⚠️ This system does not diagnose medical conditions. Always consult healthcare professionals for medical decisions.'
             }), 200
         
-        # Get RAG response with safety-enhanced prompt
-        rag_response = rag_pipeline.get_response(query)
+        # Get RAG response with safety-enhanced prompt (cached only past the safety gate)
+        query_normalized = re.sub(r'\s+', ' ', query_lower.strip())
+        cache_key = hashlib.blake2b(query_normalized.encode('utf-8'), digest_size=16).hexdigest()
+        with _queryold_lock:
+            rag_response = queryold_cache.get(cache_key)
+        if rag_response is None:
+            rag_response = rag_pipeline.get_response(query)
+            if not rag_response.get('error'):  # never cache the fallback answer
+                with _queryold_lock:
+                    queryold_cache[cache_key] = rag_response
         
         # Encrypt and store conversation
         encrypted_query = encrypt_data(query)
@@ -1573,7 +2098,7 @@ Would you like practical caregiving advice instead?""",
             code_hash,
             encrypted_query,
             encrypted_response,
-            json.dumps(rag_response['sources'])
+            sources_json(rag_response['sources'])
         )
         
         return jsonify({
@@ -1591,30 +2116,38 @@ Would you like practical caregiving advice instead?""",
 def dementia_query_noapi():
     return dementia_query()
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
 @app.route('/api/dementia/history/<code_hash>', methods=['GET'])
 def dementia_history(code_hash):
-    """Get conversation history"""
+    """Get conversation history (newest first, ?limit= and ?before_id= for older pages)"""
     try:
-        # Verify patient
-        patient = db_manager.get_patient_data(code_hash)
-        if not patient:
-            return jsonify({'error': 'Invalid patient code'}), 404
+        limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_MAX))
+        before_id = request.args.get('before_id', type=int)
         
-        # Get conversations
-        conversations = db_manager.get_conversations(code_hash)
+        # Verify patient + get one page of conversations (one round-trip)
+        conversations = db_manager.get_conversations_if_patient(code_hash, limit, before_id)
+        if conversations is None:
+            return jsonify({'error': 'Invalid patient code'}), 404
         
-        # Decrypt conversations
+        # Decrypt conversations (query, response pairs in one batch)
+        plaintexts = decrypt_batch([
+            enc for conv in conversations for enc in (conv['encrypted_query'], conv['encrypted_response'])
+        ])
         decrypted_conversations = [{
             'id': conv['id'],
-            'query': decrypt_data(conv['encrypted_query']),
-            'response': decrypt_data(conv['encrypted_response']),
+            'query': plaintexts[2 * i],
+            'response': plaintexts[2 * i + 1],
             'sources': conv['sources'],
             'createdAt': conv['created_at']
-        } for conv in conversations]
+        } for i, conv in enumerate(conversations)]
         
         return jsonify({
             'success': True,
-            'conversations': decrypted_conversations
+            'conversations': decrypted_conversations,
+            # id to pass as before_id for the next (older) page, None on the last page
+            'nextBeforeId': conversations[-1]['id'] if len(conversations) == limit else None
         }), 200
     
     except Exception as e:
@@ -1637,24 +2170,42 @@ def dementia_stats():
 
 # ==================== WEB PAGES ====================
 
+STATIC_PAGE_MAX_AGE = 300
+
+@functools.lru_cache(maxsize=None)
+def _rendered_page(template):
+    """Static marketing template rendered once -> (html bytes, etag)"""
+    html = render_template(template).encode('utf-8')
+    return html, hashlib.sha1(html).hexdigest()
+
+def _static_page(template):
+    """Serve a pre-rendered page with ETag / 304 support"""
+    html, etag = _rendered_page(template)
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = STATIC_PAGE_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route("/", methods=["GET"])
 def landing_page():
     """Serve landing page"""
-    return render_template("landing.html")
+    return _static_page("landing.html")
 
 @app.route("/index.html", methods=["GET"])
 def index_page():
     """Serve index page"""
-    return render_template("index.html")
+    return _static_page("index.html")
 
 @app.route("/privacy", methods=["GET"])
 def privacy_page():
     """Serve index page"""
-    return render_template("privacy.html")
+    return _static_page("privacy.html")
 
 @app.route('/.well-known/assetlinks.json')
 def assetlinks():
-    return send_from_directory('static/.well-known', 'assetlinks.json', mimetype='application/json')
+    return send_from_directory('static/.well-known', 'assetlinks.json', mimetype='application/json',
+                               conditional=True, max_age=86400)
 
 
 # ==================== HEALTH CHECK ====================
@@ -1707,96 +2258,142 @@ def twilio_call_medication():
 
 # app.py - REPLACE medication_twiml function (around line 1020)
 
+# Fixed call prompts (no medication name in them). If a pre-rendered MP3 of a
+# prompt is deployed at static/tts/<key>.mp3 it is played with <Play>, which
+# skips Twilio's per-call TTS; otherwise the SSML is spoken with <Say>.
+_FIXED_PROMPTS = {
+    'taken_thanks': (
+        "<speak><prosody rate='slow'>Thank you. "
+        "<break time='1s'/> "
+        "Your medication has been marked as taken. "
+        "<break time='1s'/> "
+        "Have a nice day. Goodbye.</prosody></speak>"
+    ),
+    'not_taken': (
+        "<speak><prosody rate='slow'>Okay. "
+        "<break time='1s'/> "
+        "Please remember to take your medication. "
+        "Goodbye.</prosody></speak>"
+    ),
+    'retry': (
+        "<speak><prosody rate='slow'>I'm sorry, I didn't understand. "
+        "<break time='1s'/> "
+        "Please say YES if you took your medicine. "
+        "<break time='2s'/> "
+        "Or say NO if you have not taken it yet. "
+        "<break time='3s'/> "
+        "</prosody></speak>"
+    ),
+}
+_TTS_DIR = os.path.join(app.static_folder, 'tts')
+_PROMPT_AUDIO = {
+    key: f"https://loveuad.com/static/tts/{key}.mp3"
+    for key in _FIXED_PROMPTS
+    if os.path.exists(os.path.join(_TTS_DIR, f"{key}.mp3"))
+}
+
+
+def _speak_prompt(target, key):
+    """Add a fixed prompt to a VoiceResponse/Gather: pre-rendered audio if deployed, else Polly"""
+    audio_url = _PROMPT_AUDIO.get(key)
+    if audio_url:
+        target.play(audio_url)
+    else:
+        target.say(_FIXED_PROMPTS[key], voice='Polly.Brian')
+
+
+# Follow-up answer classifier: word sets checked against the caller's words
+# (punctuation from speech recognition stripped), plus two-word yes phrases
+# matched as adjacent words, so "i didn't" / "i haven't" are not a yes
+_SPEECH_TOKEN_RE = re.compile(r"[\w']+")
+_YES_WORDS = frozenset({
+    'yes', 'yep', 'yeah', 'yah', 'correct', 'right', 'alright', 'sure', 'okay', 'ok',
+    'affirmative', 'absolutely', 'indeed', 'definitely', 'certainly',
+    'taken', 'done', 'finished', 'took'
+})
+_YES_PHRASES = frozenset({('i', 'did'), ('i', 'have')})
+_NO_WORDS = frozenset({'no', 'nope', 'not', "haven't", "didn't", 'forgot'})
+
+
+def _reminder_twiml_parts():
+    """The reminder TwiML rendered once by VoiceResponse, split around the medication name"""
+    marker = '__MEDICATION_NAME__'
+    response = VoiceResponse()
+    response.say(
+        f"<speak><prosody rate='slow'>Hello. This is your medication reminder. "
+        f"<break time='1s'/> "
+        f"It is time to take {marker}. "
+        f"<break time='1s'/> "
+        f"Please take your medicine now. "
+        f"<break time='1s'/> "
+        f"I will call back in 10 minutes to check if you took it. "
+        f"Goodbye.</prosody></speak>",
+        voice='Polly.Brian'
+    )
+    head, tail = str(response).split(marker)
+    return head, tail
+
+
+_REMINDER_TWIML_HEAD, _REMINDER_TWIML_TAIL = _reminder_twiml_parts()
+
+
 @app.route('/api/twilio/twiml/medication', methods=['GET', 'POST'])
 def medication_twiml():
-    from twilio.twiml.voice_response import VoiceResponse, Gather, Pause
-    
     med_name = request.args.get('medication')
     code_hash = request.args.get('codeHash')
     time = request.args.get('time')
     call_type = request.args.get('call_type', 'reminder')
     retry_count = int(request.args.get('retry', 0))
     
-    response = VoiceResponse()
-    
     if call_type == 'reminder':
-        response.say(
-            f"<speak><prosody rate='slow'>Hello. This is your medication reminder. "
-            f"<break time='1s'/> "
-            f"It is time to take {med_name}. "
-            f"<break time='1s'/> "
-            f"Please take your medicine now. "
-            f"<break time='1s'/> "
-            f"I will call back in 10 minutes to check if you took it. "
-            f"Goodbye.</prosody></speak>",
-            voice='Polly.Brian'
-        )
-        return str(response), 200, {'Content-Type': 'text/xml'}
+        # Pre-rendered document, only the (escaped) medication name is filled in
+        return _REMINDER_TWIML_HEAD + xml_escape(med_name or '') + _REMINDER_TWIML_TAIL, 200, {'Content-Type': 'text/xml'}
+    
+    response = VoiceResponse()
     
     if call_type == 'followup':
         if request.method == 'POST' and request.form.get('SpeechResult'):
             speech_result = request.form.get('SpeechResult', '').lower()
             logger.info(f"📞 SPEECH: '{speech_result}' for {med_name}")
             
-            yes_words = ['yes', 'yep', 'yeah', 'yah', 'correct', 'right', 'sure', 'okay', 'ok', 
-                         'affirmative', 'absolutely', 'indeed', 'definitely', 'certainly', 
-                         'i did', 'i have', 'taken', 'done', 'finished', 'took']
+            words = _SPEECH_TOKEN_RE.findall(speech_result)
+            tokens = set(words)
             
-            if any(word in speech_result for word in yes_words):
+            if tokens & _YES_WORDS or not _YES_PHRASES.isdisjoint(zip(words, words[1:])):
                 try:
                     with db_manager.get_connection() as conn:
                         cur = conn.cursor()
-                        cur.execute("SELECT encrypted_data FROM patients WHERE code_hash = %s", (code_hash,))
-                        patient = cur.fetchone()
                         
-                        if patient:
-                            patient_data = decrypt_data(patient['encrypted_data'])
-                            adherence = patient_data.get('medicationAdherence', [])
-                            
-                            # ✅ FIX: Match exact medication name format
-                            adherence.append({
-                                'medication': med_name,  # Use exact name from alarm
-                                'scheduledTime': time,
-                                'takenAt': datetime.now(timezone.utc).isoformat(),
-                                'date': datetime.now().strftime('%Y-%m-%d'),
-                                'status': 'taken',
-                                'method': 'phone_followup'
-                            })
-                            
-                            patient_data['medicationAdherence'] = adherence[-270:]
-                            encrypted = encrypt_data(patient_data)
-                            cur.execute("UPDATE patients SET encrypted_data = %s WHERE code_hash = %s", (encrypted, code_hash))
-                            
-                            # ✅ UPDATE STATUS TO TAKEN
-                            cur.execute("""
+                        # ✅ One adherence row (exact medication name from the alarm), if the patient
+                        # exists, and STATUS TO TAKEN - a single statement, no patients-row write
+                        cur.execute("""
+                            WITH saved AS (
+                                INSERT INTO medication_adherence
+                                    (code_hash, medication_name, scheduled_time, taken_at, taken_date, method)
+                                SELECT %s, %s, %s, %s::timestamptz, %s::date, 'phone_followup'
+                                WHERE EXISTS (SELECT 1 FROM patients WHERE code_hash = %s)
+                                RETURNING id
+                            ), taken AS (
                                 UPDATE medication_reminders 
                                 SET daily_status = 'TAKEN'
                                 WHERE code_hash = %s AND medication_name = %s
-                            """, (code_hash, med_name))
-                            
+                                AND EXISTS (SELECT 1 FROM saved)
+                            )
+                            SELECT EXISTS (SELECT 1 FROM saved) AS saved
+                        """, (code_hash, med_name, time, datetime.now(timezone.utc),
+                              datetime.now().strftime('%Y-%m-%d'), code_hash, code_hash, med_name))
+                        
+                        if cur.fetchone()['saved']:
                             conn.commit()
                             
                             logger.info(f"✅ SAVED: {med_name} at {time}, status=TAKEN")
                             
-                            response.say(
-                                "<speak><prosody rate='slow'>Thank you. "
-                                "<break time='1s'/> "
-                                "Your medication has been marked as taken. "
-                                "<break time='1s'/> "
-                                "Have a nice day. Goodbye.</prosody></speak>",
-                                voice='Polly.Brian'
-                            )
+                            _speak_prompt(response, 'taken_thanks')
                 except Exception as e:
                     logger.error(f"❌ Error: {e}", exc_info=True)
             
-            elif any(word in speech_result.split() for word in ['no', 'nope', 'not', 'haven\'t', 'didn\'t', 'forgot']):
-                response.say(
-                    "<speak><prosody rate='slow'>Okay. "
-                    "<break time='1s'/> "
-                    "Please remember to take your medication. "
-                    "Goodbye.</prosody></speak>",
-                    voice='Polly.Brian'
-                )
+            elif tokens & _NO_WORDS:
+                _speak_prompt(response, 'not_taken')
             
             else:
                 if retry_count < 2:
@@ -1808,16 +2405,7 @@ def medication_twiml():
                         timeout=10,
                         language='en-US'
                     )
-                    gather.say(
-                        "<speak><prosody rate='slow'>I'm sorry, I didn't understand. "
-                        "<break time='1s'/> "
-                        "Please say YES if you took your medicine. "
-                        "<break time='2s'/> "
-                        "Or say NO if you have not taken it yet. "
-                        "<break time='3s'/> "
-                        "</prosody></speak>",
-                        voice='Polly.Brian'
-                    )
+                    _speak_prompt(gather, 'retry')
                     response.append(gather)
         
         else:
@@ -1846,8 +2434,145 @@ def medication_twiml():
         return str(response), 200, {'Content-Type': 'text/xml'}
 
 
-from pywebpush import webpush, WebPushException
-from datetime import datetime, timedelta, timezone
+TWILIO_FROM = os.environ.get('TWILIO_PHONE_NUMBER')
+
+
+def _build_twilio_client():
+    """One REST client for all reminder calls: keeps its HTTPS connections alive"""
+    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+    if not (account_sid and auth_token and TWILIO_FROM):
+        logger.warning("⚠️ Twilio not configured - reminder calls disabled")
+        return None
+    http_client = TwilioHttpClient()
+    http_client.session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+    return TwilioClient(account_sid, auth_token, http_client=http_client)
+
+
+TWILIO_CLIENT = _build_twilio_client()
+
+# Calls and pushes of one cron tick go out in parallel (each is a blocking HTTPS request)
+_notify_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='alarm-notify')
+NOTIFY_TIMEOUT_SECONDS = 20
+
+
+def _place_alarm_call(alarm, current_time, call_type):
+    """Start a Twilio call for one alarm; returns the alarm id"""
+    med_name = alarm['medication_name']
+    twiml_url = f"https://loveuad.com/api/twilio/twiml/medication?medication={med_name}&codeHash={alarm['code_hash']}&time={current_time}&call_type={call_type}"
+    
+    call = TWILIO_CLIENT.calls.create(
+        to=alarm['phone_number'],
+        from_=TWILIO_FROM,
+        url=twiml_url,
+        method='GET'
+    )
+    
+    logger.info(f"📞 {call_type.upper()} CALL: {call.sid} to {alarm['phone_number']} for {med_name}")
+    return alarm['id']
+
+
+# Push services accept a VAPID token for up to 24h: sign one per origin per hour
+# (12h expiry) instead of once per message
+VAPID_TOKEN_TTL_SECONDS = 12 * 3600
+_vapid_headers_cache = TTLCache(maxsize=256, ttl=3600)
+_vapid_headers_lock = threading.Lock()
+
+# Keep-alive connections to the push services, shared by every send
+_push_session = requests.Session()
+_push_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+PUSH_TIMEOUT_SECONDS = 10
+
+
+def _vapid_headers(endpoint):
+    """Signed VAPID Authorization headers for the endpoint's origin"""
+    if VAPID is None:
+        raise WebPushException("VAPID private key not configured")
+    parsed = urlparse(endpoint)
+    origin = f"{parsed.scheme}://{parsed.netloc}"
+    hour = int(time.time()) // 3600
+    key = (origin, hour)
+    with _vapid_headers_lock:
+        headers = _vapid_headers_cache.get(key)
+    if headers is None:
+        headers = VAPID.sign({
+            'sub': VAPID_SUBJECT,
+            'aud': origin,
+            'exp': hour * 3600 + VAPID_TOKEN_TTL_SECONDS
+        })
+        with _vapid_headers_lock:
+            _vapid_headers_cache[key] = headers
+    return headers
+
+
+def send_push(subscription_info, payload):
+    """Encrypt and POST one push message over the shared session"""
+    response = WebPusher(subscription_info, requests_session=_push_session).send(
+        payload,
+        headers=dict(_vapid_headers(subscription_info['endpoint'])),  # send() adds to it
+        ttl=0,
+        content_encoding='aes128gcm',
+        timeout=PUSH_TIMEOUT_SECONDS
+    )
+    if response.status_code > 202:
+        raise WebPushException(f"Push failed: {response.status_code} {response.reason}", response=response)
+    return response
+
+
+def _send_alarm_push(subscription_data, payload):
+    send_push(orjson.loads(subscription_data), payload)
+
+
+def _alarm_call_done(call_type, called_at, future):
+    """
+    Done-callback of a _place_alarm_call future: advance that alarm's status
+    in its own short transaction, so calls that finish after the cron's
+    wait() timeout are still recorded
+    """
+    if future.exception() is not None:
+        logger.error(f"Twilio {call_type} call failed: {future.exception()}")
+        return
+    alarm_id = future.result()
+    try:
+        with db_manager.get_connection() as conn:
+            cur = conn.cursor()
+            if call_type == 'reminder':
+                cur.execute("""
+                    UPDATE medication_reminders 
+                    SET last_called = %s,
+                        daily_status = 'REMINDED'
+                    WHERE id = %s
+                """, (called_at, alarm_id))
+            else:
+                cur.execute("""
+                    UPDATE medication_reminders 
+                    SET daily_status = 'FOLLOWUP'
+                    WHERE id = %s
+                """, (alarm_id,))
+    except Exception as e:
+        logger.error(f"Alarm {alarm_id} status update failed after {call_type} call: {e}")
+
+
+# The two per-minute cron scans, prepared once per connection
+db_manager.register_prepared('alarms_due_reminder', """
+    SELECT id, code_hash, medication_name, time, phone_number
+    FROM medication_reminders
+    WHERE active = true
+    AND time BETWEEN %s::time AND %s::time + INTERVAL '59.999999 seconds'
+    AND phone_number IS NOT NULL
+    AND phone_number != ''
+    AND daily_status = 'PENDING'
+""")
+db_manager.register_prepared('alarms_due_followup', """
+    SELECT id, code_hash, medication_name, time, phone_number
+    FROM medication_reminders
+    WHERE active = true
+    AND followup_time BETWEEN %s::time AND %s::time + INTERVAL '59.999999 seconds'
+    AND phone_number IS NOT NULL
+    AND phone_number != ''
+    AND daily_status = 'REMINDED'
+""")
+
 
 @app.route('/api/alarms/check-and-call', methods=['GET', 'POST'])
 def check_and_call_alarms():
@@ -1858,141 +2583,69 @@ def check_and_call_alarms():
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
+            # Alarms due this minute: [HH:MM:00, HH:MM:59.999999] on the TIME columns,
+            # so the partial indexes apply (no wrap at 23:59, unlike + 1 minute)
+            
             # CHECK 1: Find FIRST CALL alarms (time column) - only PENDING status
-            cur.execute("""
-                SELECT id, code_hash, medication_name, time, phone_number
-                FROM medication_reminders
-                WHERE active = true
-                AND TO_CHAR(time, 'HH24:MI') = %s
-                AND phone_number IS NOT NULL
-                AND phone_number != ''
-                AND daily_status = 'PENDING'
-            """, (current_time,))
+            db_manager.execute_prepared(cur, 'alarms_due_reminder', (current_time, current_time))
             
             reminder_alarms = cur.fetchall()
             
             # CHECK 2: Find FOLLOWUP CALL alarms (followup_time column) - only REMINDED status
-            cur.execute("""
-                SELECT id, code_hash, medication_name, time, phone_number
-                FROM medication_reminders
-                WHERE active = true
-                AND TO_CHAR(followup_time, 'HH24:MI') = %s
-                AND phone_number IS NOT NULL
-                AND phone_number != ''
-                AND daily_status = 'REMINDED'
-            """, (current_time,))
+            db_manager.execute_prepared(cur, 'alarms_due_followup', (current_time, current_time))
             
             followup_alarms = cur.fetchall()
             
-            calls_made = 0
+            # ✅ START ALL CALLS (REMINDER + FOLLOWUP) AT ONCE
+            # (each call marks its own alarm when it completes, see _alarm_call_done)
+            call_futures = []
+            if TWILIO_CLIENT:
+                for call_type, alarms in (('reminder', reminder_alarms), ('followup', followup_alarms)):
+                    for alarm in alarms:
+                        future = _notify_pool.submit(_place_alarm_call, alarm, current_time, call_type)
+                        future.add_done_callback(functools.partial(_alarm_call_done, call_type, now))
+                        call_futures.append(future)
             
-            # PROCESS FIRST CALLS (REMINDER)
-            for alarm in reminder_alarms:
-                alarm_id = alarm['id']
-                phone = alarm['phone_number']
-                med_name = alarm['medication_name']
-                code_hash = alarm['code_hash']
-                
+            # ✅ SEND PUSH NOTIFICATIONS alongside the calls
+            # (subscriptions for every due patient in one query, bucketed by code_hash)
+            subs_by_hash = {}
+            if reminder_alarms:
                 try:
-                    from twilio.rest import Client
-                    
-                    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-                    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-                    twilio_phone = os.environ.get('TWILIO_PHONE_NUMBER')
-                    
-                    if account_sid and auth_token and twilio_phone:
-                        client = Client(account_sid, auth_token)
-                        
-                        twiml_url = f"https://loveuad.com/api/twilio/twiml/medication?medication={med_name}&codeHash={code_hash}&time={current_time}&call_type=reminder"
-                        
-                        call = client.calls.create(
-                            to=phone,
-                            from_=twilio_phone,
-                            url=twiml_url,
-                            method='GET'
-                        )
-                        
-                        logger.info(f"📞 REMINDER CALL: {call.sid} to {phone} for {med_name}")
-                        
-                        # ✅ SEND PUSH NOTIFICATION
-                        try:
-                            cur.execute("""
-                                SELECT subscription_data FROM push_subscriptions 
-                                WHERE code_hash = %s AND active = true
-                            """, (code_hash,))
-                            subs = cur.fetchall()
-                            
-                            for sub in subs:
-                                subscription_info = json.loads(sub['subscription_data'])
-                                webpush(
-                                    subscription_info=subscription_info,
-                                    data=json.dumps({
-                                        'title': '💊 Medication Reminder',
-                                        'body': f'{med_name} at {current_time}',
-                                        'medicationName': med_name,
-                                        'scheduledTime': current_time,
-                                        'tag': f'{med_name}-{current_time}'
-                                    }),
-                                    vapid_private_key=os.environ.get('VAPID_PRIVATE_KEY'),
-                                    vapid_claims={"sub": "mailto:admin@loveuad.com"}
-                                )
-                            logger.info(f"📱 PUSH SENT: {med_name}")
-                        except Exception as push_error:
-                            logger.warning(f"Push notification failed: {push_error}")
-                        
-                        calls_made += 1
-                        
-                        # ✅ UPDATE STATUS TO REMINDED
-                        cur.execute("""
-                            UPDATE medication_reminders 
-                            SET last_called = %s,
-                                daily_status = 'REMINDED'
-                            WHERE id = %s
-                        """, (now, alarm_id))
-                        
-                except Exception as call_error:
-                    logger.error(f"Twilio reminder call failed: {call_error}")
+                    cur.execute("""
+                        SELECT code_hash, subscription_data FROM push_subscriptions 
+                        WHERE code_hash = ANY(%s) AND active = true
+                    """, (list({alarm['code_hash'] for alarm in reminder_alarms}),))
+                    for sub in cur.fetchall():
+                        subs_by_hash.setdefault(sub['code_hash'], []).append(sub['subscription_data'])
+                except Exception as push_error:
+                    logger.warning(f"Push notification failed: {push_error}")
             
-            # PROCESS FOLLOWUP CALLS
-            for alarm in followup_alarms:
-                phone = alarm['phone_number']
+            push_futures = []
+            for alarm in reminder_alarms:
                 med_name = alarm['medication_name']
-                code_hash = alarm['code_hash']
-                alarm_id = alarm['id']
-                
-                try:
-                    from twilio.rest import Client
-                    
-                    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-                    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-                    twilio_phone = os.environ.get('TWILIO_PHONE_NUMBER')
-                    
-                    if account_sid and auth_token and twilio_phone:
-                        client = Client(account_sid, auth_token)
-                        
-                        twiml_url = f"https://loveuad.com/api/twilio/twiml/medication?medication={med_name}&codeHash={code_hash}&time={current_time}&call_type=followup"
-                        
-                        call = client.calls.create(
-                            to=phone,
-                            from_=twilio_phone,
-                            url=twiml_url,
-                            method='GET'
-                        )
-                        
-                        logger.info(f"📞 FOLLOWUP CALL: {call.sid} to {phone} for {med_name}")
-                        calls_made += 1
-                        
-                        # ✅ UPDATE STATUS TO FOLLOWUP
-                        cur.execute("""
-                            UPDATE medication_reminders 
-                            SET daily_status = 'FOLLOWUP'
-                            WHERE id = %s
-                        """, (alarm_id,))
-                        
-                except Exception as call_error:
-                    logger.error(f"Twilio followup call failed: {call_error}")
+                payload = orjson.dumps({
+                    'title': '💊 Medication Reminder',
+                    'body': f'{med_name} at {current_time}',
+                    'medicationName': med_name,
+                    'scheduledTime': current_time,
+                    'tag': f'{med_name}-{current_time}'
+                })
+                push_futures += [_notify_pool.submit(_send_alarm_push, subscription_data, payload)
+                                 for subscription_data in subs_by_hash.get(alarm['code_hash'], [])]
             
-            conn.commit()
+            done, _ = wait(call_futures + push_futures, timeout=NOTIFY_TIMEOUT_SECONDS)
+            
+            for future in push_futures:
+                if future not in done or future.exception() is not None:
+                    logger.warning(f"Push notification failed: {future.exception() if future in done else 'timed out'}")
+            if push_futures:
+                logger.info(f"📱 PUSH SENT: {len(push_futures)} notifications")
+            
+            # Status (REMINDED / FOLLOWUP) is written by each call's done-callback
+            calls_made = sum(1 for future in call_futures if future in done and future.exception() is None)
+            still_running = sum(1 for future in call_futures if future not in done)
+            if still_running:
+                logger.warning(f"{still_running} Twilio calls still running after {NOTIFY_TIMEOUT_SECONDS}s")
             
             logger.info(f"✓ Checked at {current_time}, made {calls_made} calls ({len(reminder_alarms)} reminders, {len(followup_alarms)} followups)")
             return jsonify({
@@ -2083,30 +2736,32 @@ def schedule_medications_noapi():
     with db_manager.get_connection() as conn:
         cur = conn.cursor()
         
-        # ✅ Save medications using encrypted_data column
-        for med in medications:
-            med['createdAt'] = datetime.utcnow().isoformat()
-            encrypted_data = encrypt_data(med)
-            
-            cur.execute("""
-                INSERT INTO medications (code_hash, encrypted_data, active)
-                VALUES (%s, %s, true)
-            """, (code_hash, encrypted_data))
-            logger.info(f"✓ Medication saved: {med['name']}")
-        
-        # ✅ Save alarms to medication_reminders
+        # ✅ Save medications using encrypted_data column (one statement)
+        created_at = datetime.utcnow().isoformat()
         for med in medications:
-            for time in med.get('times', []):
-                time_obj = datetime.strptime(time, '%H:%M')
-                followup_obj = time_obj + timedelta(minutes=10)
-                followup_time = followup_obj.strftime('%H:%M')
-                
-                cur.execute("""
-                    INSERT INTO medication_reminders (code_hash, medication_name, time, followup_time, phone_number, active, daily_status)
-                    VALUES (%s, %s, %s, %s, %s, true, 'PENDING')
-                    ON CONFLICT DO NOTHING
-                """, (code_hash, med['name'], time, followup_time, phone_number))
-                logger.info(f"✓ Alarm created: {med['name']} at {time}, followup at {followup_time}")
+            med['createdAt'] = created_at
+        med_rows = [
+            (code_hash, encrypted_data, hash_medication_name(med.get('name')))
+            for med, encrypted_data in zip(medications, encrypt_batch(medications))
+        ]
+        execute_values(cur, """
+            INSERT INTO medications (code_hash, encrypted_data, name_hash, active)
+            VALUES %s
+        """, med_rows, template="(%s, %s, %s, true)", page_size=100)
+        logger.info(f"✓ Medications saved: {len(med_rows)}")
+        
+        # ✅ Save alarms to medication_reminders (one statement)
+        reminder_rows = [
+            (code_hash, med['name'], time, time, phone_number)
+            for med in medications for time in med.get('times', [])
+        ]
+        if reminder_rows:
+            execute_values(cur, """
+                INSERT INTO medication_reminders (code_hash, medication_name, time, followup_time, phone_number, active, daily_status)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, reminder_rows, template=REMINDER_ROW_TEMPLATE, page_size=100)
+            logger.info(f"✓ Alarms created: {len(reminder_rows)}")
         
         conn.commit()
     
@@ -2118,8 +2773,6 @@ def scan_prescription_noapi():
 
 # app.py - Add push notification endpoint
 
-from pywebpush import webpush, WebPushException
-
 @app.route('/api/alarms/trigger-push', methods=['POST'])
 def trigger_push_alarm():
     try:
@@ -2136,26 +2789,24 @@ def trigger_push_alarm():
                 WHERE code_hash = %s AND active = true
             """, (code_hash,))
             subs = cur.fetchall()
-            
-            for sub in subs:
-                subscription_info = json.loads(sub['subscription_data'])
-                
-                webpush(
-                    subscription_info=subscription_info,
-                    data=json.dumps({
-                        'title': '💊 Medication Reminder',
-                        'body': f'{medication_name} - {time}',
-                        'icon': '/static/icon-192x192.png',
-                        'badge': '/static/badge-72x72.png',
-                        'vibrate': [500, 200, 500, 200, 500],
-                        'requireInteraction': True,
-                        'tag': f'{medication_name}-{time}'
-                    }),
-                    vapid_private_key=os.environ.get('VAPID_PRIVATE_KEY'),
-                    vapid_claims={
-                        "sub": "mailto:kanchan.g12@loveuad.com"
-                    }
-                )
+        
+        payload = orjson.dumps({
+            'title': '💊 Medication Reminder',
+            'body': f'{medication_name} - {time}',
+            'icon': '/static/icon-192x192.png',
+            'badge': '/static/badge-72x72.png',
+            'vibrate': [500, 200, 500, 200, 500],
+            'requireInteraction': True,
+            'tag': f'{medication_name}-{time}'
+        })
+        
+        # Fan out to every device at once (one payload, one signed VAPID header per origin)
+        futures = [_notify_pool.submit(_send_alarm_push, sub['subscription_data'], payload) for sub in subs]
+        done, _ = wait(futures, timeout=NOTIFY_TIMEOUT_SECONDS)
+        for future in futures:
+            if future not in done:
+                raise WebPushException("Push notification timed out")
+            future.result()
         
         return jsonify({'success': True}), 200
     except Exception as e:
@@ -2204,6 +2855,136 @@ def add_health_record_noapi():
 
         
 
+# First number in a FREQUENCY: value ("2 times daily" -> 2)
+_FREQ_NUM_RE = re.compile(r'\d+')
+
+# "LABEL: value" lines of the OCR text (any list marker / bullet before the label)
+_MED_LINE_RE = re.compile(
+    r'^[^A-Za-z\n]*(?P<field>MEDICATION|MEDICINE|DRUG|DOSAGE|DOSE|FREQUENCY|FREQ|TIMES|INSTRUCTIONS?|NOTES):'
+    r'[^\S\n]*(?P<val>[^\n]*?)[^\S\n]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+_MED_FIELDS = {
+    'MEDICATION': 'name', 'MEDICINE': 'name', 'DRUG': 'name',
+    'DOSAGE': 'dosage', 'DOSE': 'dosage',
+    'FREQUENCY': 'frequency', 'FREQ': 'frequency', 'TIMES': 'frequency',
+    'INSTRUCTIONS': 'instructions', 'INSTRUCTION': 'instructions', 'NOTES': 'instructions'
+}
+
+
+def parse_frequency(freq_text):
+    """Doses per day from a FREQUENCY: value (number, or once/twice/three times; default 1)"""
+    number = _FREQ_NUM_RE.search(freq_text)
+    if number:
+        return int(number.group())
+    freq_lower = freq_text.lower()
+    if 'once' in freq_lower:
+        return 1
+    if 'twice' in freq_lower:
+        return 2
+    if 'three' in freq_lower or 'thrice' in freq_lower:
+        return 3
+    return 1
+
+
+# Default dose times per daily frequency; anything else (0, 5+) gets the 4-dose schedule
+_TIMES_BY_FREQ = {
+    1: ('09:00',),
+    2: ('09:00', '21:00'),
+    3: ('09:00', '14:00', '21:00'),
+    4: ('09:00', '13:00', '17:00', '21:00')
+}
+
+
+# DD/MM/YYYY or MM/DD/YYYY (the formats the OCR prompt asks for); '-' and '.' also accepted
+_APPT_DATE_RE = re.compile(r'\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4}|\d{2})\b')
+
+
+def parse_appointment_date(date_str):
+    """Appointment datetime, day first (like dateutil dayfirst=True); dateutil only for other formats"""
+    match = _APPT_DATE_RE.search(date_str)
+    if match:
+        first, second, year = (int(part) for part in match.groups())
+        if year < 100:
+            year += 2000
+        try:
+            return datetime(year, second, first)  # DD/MM/YYYY
+        except ValueError:
+            try:
+                return datetime(year, first, second)  # MM/DD/YYYY, e.g. 05/13/2025
+            except ValueError:
+                pass
+    return date_parser.parse(date_str, dayfirst=True)
+
+
+def parse_medication_lines(text):
+    """Medication dicts from MEDICATION/DOSAGE/FREQUENCY/INSTRUCTIONS lines; a name line starts a new one"""
+    medications = []
+    current_med = None
+    for match in _MED_LINE_RE.finditer(text):
+        field = _MED_FIELDS[match['field'].upper()]
+        value = match['val']
+        if field == 'name':
+            current_med = {'name': value}
+            medications.append(current_med)
+        elif current_med is None:
+            continue  # details before any medication name
+        elif field == 'frequency':
+            current_med['frequency'] = parse_frequency(value)
+        else:
+            current_med[field] = value
+    return medications
+
+# Medication extraction, appointment date and caregiving guidance in one Gemini Vision call
+OCR_SCAN_PROMPT = """You are a medical prescription reader. Read this image and return ONE JSON object with exactly three fields:
+
+"ocr_text": a string listing ALL medications in the image.
+Look for drug names (in ANY font size or style - bold, regular, handwritten), dosages (mg, ml, tablets, etc.),
+frequency (how many times per day) and any instructions.
+CRITICAL: Extract EVERY medication you see, even if formatting is unclear.
+Use this EXACT format for EACH medication:
+MEDICATION: [full drug name]
+DOSAGE: [amount and unit]
+FREQUENCY: [times per day - use number only like 1, 2, 3]
+INSTRUCTIONS: [any special instructions or "As directed"]
+
+"appointment": the next appointment or follow-up date mentioned ("Next appointment", "Follow up", "Review date",
+"See you on", "Appointment on", any date for a future visit) as
+{{"date": "[DD/MM/YYYY or MM/DD/YYYY]", "type": "[brief description like Follow-up, Review, Consultation]"}},
+or null if there is none.
+
+"analysis": CAREGIVING GUIDANCE for these medications prescribed to a {patient_age} year old {patient_gender}.
+CRITICAL RULES:
+- DO NOT diagnose why these were prescribed
+- DO NOT interpret the patient's condition
+- ONLY provide general medication information and caregiving tips
+Provide ONLY:
+1. Brief summary (general use of these medications - not patient-specific diagnosis)
+2. Important safety considerations
+3. Common side effects healthcare professionals mention
+4. Potential interactions to discuss with doctor
+5. Practical caregiving tips for medication management
+Always remind: "Discuss all questions with the prescribing healthcare provider."
+Be concise and focus on practical caregiving support.
+
+Do not include any patient names, addresses, or personal information in any field.
+Return only the JSON object."""
+
+def _save_ocr_results(code_hash, medications, record_metadata):
+    """Store scanned medications + the scan record; True if saved"""
+    try:
+        # Encrypt everything first, then all rows in one transaction
+        *encrypted_meds, encrypted_metadata = encrypt_batch(medications + [record_metadata])
+        medication_rows = [(encrypted_data, hash_medication_name(med.get('name')))
+                           for med, encrypted_data in zip(medications, encrypted_meds)]
+        db_manager.save_scan(code_hash, medication_rows, 'ai_analysis', encrypted_metadata)
+        
+        logger.info(f"✓ OCR saved {len(medications)} meds")
+        return True
+    except Exception as e:
+        logger.error(f"OCR save error: {e}")
+        return False
+
 @app.route('/api/health/ocr', methods=['POST'])
 def process_ocr_api():
     return process_ocr_noapi()
@@ -2226,43 +3007,22 @@ def process_ocr_noapi():
         if not image_data:
             return jsonify({'error': 'Missing image'}), 400
         
-        # Decode base64 image
+        # Decode base64 image (the image itself is only parsed if Gemini has to see it)
         try:
-            image_bytes = base64.b64decode(image_data.split(',')[1] if ',' in image_data else image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-        except Exception as e:
+            image_bytes = decode_image_data(image_data)
+        except (binascii.Error, ValueError) as e:
             logger.error(f"Image decode error: {e}")
             return jsonify({'error': 'Invalid image data'}), 400
         
-        # OCR with Gemini Vision - IMPROVED PROMPT
-        prompt = """You are a medical prescription reader. Extract ALL medications from this image.
-
-Look for:
-- Drug names (in ANY font size or style - bold, regular, handwritten)
-- Dosages (mg, ml, tablets, etc.)
-- Frequency (how many times per day)
-- Any instructions
-
-CRITICAL: Extract EVERY medication you see, even if formatting is unclear.
-
-Return in this EXACT format for EACH medication:
-MEDICATION: [full drug name]
-DOSAGE: [amount and unit]
-FREQUENCY: [times per day - use number only like 1, 2, 3]
-INSTRUCTIONS: [any special instructions or "As directed"]
-
-Example:
-MEDICATION: Aspirin
-DOSAGE: 100mg
-FREQUENCY: 1
-INSTRUCTIONS: Take with food
-
-Extract all medications now:"""
-        
+        # OCR + appointment + caregiving guidance in ONE Gemini Vision call
         try:
-            response = vision_model.generate_content([prompt, image])
-            ocr_text = response.text
-            logger.info(f"OCR Raw Response: {ocr_text}")
+            parsed, reply_text = vision_reply(
+                OCR_SCAN_PROMPT.format(patient_age=patient_age, patient_gender=patient_gender), image_bytes
+            )
+            logger.info(f"OCR Raw Response: {reply_text}")
+        except UnidentifiedImageError as e:
+            logger.error(f"Image decode error: {e}")
+            return jsonify({'error': 'Invalid image data'}), 400
         except Exception as e:
             logger.error(f"Gemini Vision API error: {e}")
             return jsonify({
@@ -2270,229 +3030,74 @@ Extract all medications now:"""
                 'details': 'Vision API error - Check Gemini API key and quota'
             }), 500
         
-        filtered_text = pii_filter.remove_pii(ocr_text)
-        
-        # IMPROVED PARSING - more flexible
-        medications = []
-        lines = filtered_text.split('\n')
-        current_med = {}
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # More flexible keyword matching
-            line_upper = line.upper()
-            
-            if 'MEDICATION:' in line_upper or 'DRUG:' in line_upper or 'MEDICINE:' in line_upper:
-                if current_med and 'name' in current_med:
-                    medications.append(current_med)
-                # Extract name after colon
-                name = line.split(':', 1)[1].strip() if ':' in line else line
-                current_med = {'name': name}
-                
-            elif ('DOSAGE:' in line_upper or 'DOSE:' in line_upper) and current_med:
-                dosage = line.split(':', 1)[1].strip() if ':' in line else line
-                current_med['dosage'] = dosage
-                
-            elif ('FREQUENCY:' in line_upper or 'TIMES:' in line_upper or 'FREQ:' in line_upper) and current_med:
-                freq_text = line.split(':', 1)[1].strip() if ':' in line else line
-                # Extract number from text
-                import re
-                numbers = re.findall(r'\d+', freq_text)
-                if numbers:
-                    current_med['frequency'] = int(numbers[0])
-                elif 'once' in freq_text.lower():
-                    current_med['frequency'] = 1
-                elif 'twice' in freq_text.lower():
-                    current_med['frequency'] = 2
-                elif 'three' in freq_text.lower() or 'thrice' in freq_text.lower():
-                    current_med['frequency'] = 3
-                else:
-                    current_med['frequency'] = 1
-                    
-            elif ('INSTRUCTIONS:' in line_upper or 'INSTRUCTION:' in line_upper or 'NOTES:' in line_upper) and current_med:
-                instructions = line.split(':', 1)[1].strip() if ':' in line else line
-                current_med['instructions'] = instructions
+        if parsed:
+            ocr_text = str(parsed.get('ocr_text') or '')
+        else:
+            logger.warning("OCR scan: reply was not JSON, keeping it as OCR text")
+            ocr_text = reply_text
+            parsed = {}
         
-        # Add last medication
-        if current_med and 'name' in current_med:
-            medications.append(current_med)
+        filtered_text = pii_filter.remove_pii(ocr_text)
         
-        # If no medications found with structured format, try to extract from free text
-        if not medications:
-            logger.warning("No structured medications found, attempting free-text extraction")
-            # Ask Gemini to be more aggressive
-            retry_prompt = f"""The previous extraction failed. This is a prescription image.
-
-Your task: Find EVERY medication name visible in the image.
-
-Original text extracted:
-{ocr_text}
-
-Return ONLY a simple list:
-1. [Medication name] - [dosage if visible]
-2. [Medication name] - [dosage if visible]
-
-Be aggressive - extract anything that looks like a drug name."""
-            
-            try:
-                retry_response = vision_model.generate_content([retry_prompt, image])
-                retry_text = retry_response.text
-                logger.info(f"Retry extraction: {retry_text}")
-                
-                # Parse numbered list
-                import re
-                for line in retry_text.split('\n'):
-                    if line.strip() and any(c.isalpha() for c in line):
-                        # Remove numbering
-                        clean_line = re.sub(r'^\d+[\.\)]\s*', '', line.strip())
-                        if '-' in clean_line:
-                            parts = clean_line.split('-', 1)
-                            medications.append({
-                                'name': parts[0].strip(),
-                                'dosage': parts[1].strip() if len(parts) > 1 else 'As directed',
-                                'frequency': 1,
-                                'instructions': 'As directed'
-                            })
-                        elif clean_line:
-                            medications.append({
-                                'name': clean_line,
-                                'dosage': 'As directed',
-                                'frequency': 1,
-                                'instructions': 'As directed'
-                            })
-            except Exception as retry_error:
-                logger.error(f"Retry extraction failed: {retry_error}")
+        # IMPROVED PARSING - one regex scan over the labelled lines
+        medications = parse_medication_lines(filtered_text)
         
         for med in medications:
-            freq = med.get('frequency', 1)
-            if freq == 1:
-                med['times'] = ['09:00']
-            elif freq == 2:
-                med['times'] = ['09:00', '21:00']
-            elif freq == 3:
-                med['times'] = ['09:00', '14:00', '21:00']
-            else:
-                med['times'] = ['09:00', '13:00', '17:00', '21:00']
+            med['times'] = list(_TIMES_BY_FREQ.get(med.get('frequency', 1), _TIMES_BY_FREQ[4]))
         
-        # EXTRACT APPOINTMENT DATES from the scanned document
+        # Appointment / follow-up date read from the same reply
         appointment_info = None
-        try:
-            appointment_prompt = """Look at this medical document and extract ANY appointment or follow-up date mentioned.
-
-Search for phrases like:
-- "Next appointment"
-- "Follow up"
-- "Review date"
-- "See you on"
-- "Appointment on"
-- Any date mentioned for future visits
-
-If you find an appointment date, return ONLY:
-APPOINTMENT_DATE: [DD/MM/YYYY or MM/DD/YYYY format]
-APPOINTMENT_TYPE: [brief description like "Follow-up", "Review", "Consultation"]
-
-If NO appointment date is found, return:
-NO_APPOINTMENT_FOUND
-
-Scan the document now:"""
-            
-            appointment_response = vision_model.generate_content([appointment_prompt, image])
-            appointment_text = appointment_response.text.strip()
-            logger.info(f"Appointment extraction: {appointment_text}")
-            
-            if 'NO_APPOINTMENT_FOUND' not in appointment_text:
-                # Parse the appointment
-                import re
-                from dateutil import parser
-                
-                date_match = re.search(r'APPOINTMENT_DATE:\s*(.+)', appointment_text)
-                type_match = re.search(r'APPOINTMENT_TYPE:\s*(.+)', appointment_text)
-                
-                if date_match:
-                    date_str = date_match.group(1).strip()
-                    try:
-                        # Try to parse the date
-                        appointment_date = parser.parse(date_str, dayfirst=True)
-                        appointment_info = {
-                            'date': appointment_date.strftime('%Y-%m-%d'),
-                            'type': type_match.group(1).strip() if type_match else 'Appointment',
-                            'found': True
-                        }
-                        logger.info(f"Appointment found: {appointment_info}")
-                    except Exception as parse_error:
-                        logger.warning(f"Could not parse appointment date: {date_str} - {parse_error}")
-        except Exception as appt_error:
-            logger.warning(f"Appointment extraction failed: {appt_error}")
-            # Continue even if appointment extraction fails
-        
-        ai_insights = {'enabled': False}
-        try:
-            # NO DIAGNOSIS VERSION
-            analysis_prompt = f"""Provide CAREGIVING GUIDANCE for these medications prescribed to a {patient_age} year old {patient_gender}.
-
-CRITICAL RULES:
-- DO NOT diagnose why these were prescribed
-- DO NOT interpret the patient's condition
-- ONLY provide general medication information and caregiving tips
-
-Medications:
-{filtered_text}
-
-Provide ONLY:
-1. Brief summary (general use of these medications - not patient-specific diagnosis)
-2. Important safety considerations
-3. Common side effects healthcare professionals mention
-4. Potential interactions to discuss with doctor
-5. Practical caregiving tips for medication management
-
-Always remind: "Discuss all questions with the prescribing healthcare provider."
-
-Be concise and focus on practical caregiving support."""
-            
-            analysis_response = vision_model.generate_content(analysis_prompt)
+        appointment = parsed.get('appointment')
+        if isinstance(appointment, dict) and appointment.get('date'):
+            date_str = str(appointment['date']).strip()
+            try:
+                appointment_date = parse_appointment_date(date_str)
+                appointment_info = {
+                    'date': appointment_date.strftime('%Y-%m-%d'),
+                    'type': str(appointment.get('type') or '').strip() or 'Appointment',
+                    'found': True
+                }
+                logger.info(f"Appointment found: {appointment_info}")
+            except Exception as parse_error:
+                logger.warning(f"Could not parse appointment date: {date_str} - {parse_error}")
+        
+        # Caregiving guidance (NO DIAGNOSIS), also from the same reply
+        analysis = str(parsed.get('analysis') or '')
+        if analysis:
             ai_insights = {
                 'enabled': True,
-                'analysis': analysis_response.text,
+                'analysis': pii_filter.remove_pii(analysis),
                 'model': 'gemini-1.5-flash',
                 'age_group': f'{patient_age} years old',
                 'personalized': True,
                 'disclaimer': '⚠️ This is caregiving guidance only, NOT medical diagnosis. Consult healthcare providers for all medical decisions.'
             }
-        except Exception as e:
-            logger.error(f"AI analysis error: {e}")
-            # Continue even if AI analysis fails - medications are already extracted
+        else:
             ai_insights = {
                 'enabled': False,
                 'error': 'AI analysis unavailable'
             }
-        # SAVE OCR DATA TO DATABASE
-        try:
-            code_hash = data.get('codeHash')
-            if code_hash:
-                for med in medications:
-                    med['createdAt'] = datetime.utcnow().isoformat()
-                    encrypted_data = encrypt_data(med)
-                    db_manager.insert_medication(code_hash, encrypted_data)
-                
-                record_metadata = {
-                    'ocrText': filtered_text,
-                    'medications': medications,
-                    'appointment': appointment_info,
-                    'scannedAt': datetime.utcnow().isoformat()
-                }
-                encrypted_metadata = encrypt_data(record_metadata)
-                db_manager.insert_health_record(code_hash, 'ai_analysis', encrypted_metadata, None)
-                
-                logger.info(f"✓ OCR saved {len(medications)} meds")
-        except Exception as e:
-            logger.error(f"OCR save error: {e}")
+        # SAVE OCR DATA TO DATABASE - before replying, so the medications exist
+        # when the client reloads them and a failed save is reported
+        saved = False
+        code_hash = data.get('codeHash')
+        if code_hash:
+            created_at = datetime.utcnow().isoformat()
+            for med in medications:
+                med['createdAt'] = created_at
+            
+            record_metadata = {
+                'ocrText': filtered_text,
+                'medications': medications,
+                'appointment': appointment_info,
+                'scannedAt': created_at
+            }
+            saved = _save_ocr_results(code_hash, medications, record_metadata)
         
         
         return jsonify({
             'success': True,
+            'saved': saved,
             'ocrResult': {
                 'raw_text': filtered_text,
                 'extracted_data': {
@@ -2554,21 +3159,37 @@ def delete_medication():
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            # STEP 1: Delete all alarms for this medication
+            # Alarms + this medication's rows (by name_hash, not every medication
+            # of the patient) in one statement
             cur.execute("""
-                DELETE FROM medication_reminders 
-                WHERE code_hash = %s AND medication_name = %s
-            """, (code_hash, medication_name))
-            
-            alarms_deleted = cur.rowcount
+                WITH alarms AS (
+                    DELETE FROM medication_reminders 
+                    WHERE code_hash = %s AND medication_name = %s
+                    RETURNING 1
+                ), meds AS (
+                    DELETE FROM medications 
+                    WHERE code_hash = %s AND name_hash = %s
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM alarms) AS alarms_deleted,
+                       (SELECT COUNT(*) FROM meds) AS meds_deleted
+            """, (code_hash, medication_name, code_hash, hash_medication_name(medication_name)))
             
-            # STEP 2: Delete medication from medications table
-            cur.execute("""
-                DELETE FROM medications 
-                WHERE code_hash = %s
-            """, (code_hash,))
+            counts = cur.fetchone()
+            alarms_deleted = counts['alarms_deleted']
+            meds_deleted = counts['meds_deleted']
             
-            meds_deleted = cur.rowcount
+            # Rows saved before name_hash existed: decrypt only those
+            if not meds_deleted:
+                cur.execute("""
+                    SELECT id, encrypted_data FROM medications
+                    WHERE code_hash = %s AND name_hash IS NULL
+                """, (code_hash,))
+                legacy_ids = [legacy['id'] for legacy in cur.fetchall()
+                              if (decrypt_data(legacy['encrypted_data']) or {}).get('name') == medication_name]
+                if legacy_ids:
+                    cur.execute("DELETE FROM medications WHERE id = ANY(%s)", (legacy_ids,))
+                    meds_deleted = cur.rowcount
             
             conn.commit()
         
@@ -2598,37 +3219,14 @@ def record_medication_taken():
         if not all([code_hash, medication_name, time, taken_at]):
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Store in health records
-        patient = db_manager.get_patient_data(code_hash)
-        if not patient:
+        # One append-only row; the patient blob is not rewritten
+        taken_at_dt = datetime.fromisoformat(taken_at.replace('Z', '+00:00'))
+        record_id = db_manager.record_adherence(
+            code_hash, medication_name, time, taken_at_dt, taken_at_dt.strftime('%Y-%m-%d')
+        )
+        if record_id is None:
             return jsonify({'error': 'Patient not found'}), 404
         
-        adherence_record = {
-            'medication': medication_name,
-            'scheduledTime': time,
-            'takenAt': taken_at,
-            'date': datetime.fromisoformat(taken_at.replace('Z', '+00:00')).strftime('%Y-%m-%d'),
-            'status': 'taken'
-        }
-        
-        # Get existing medication adherence records
-        patient_data = decrypt_data(patient['encrypted_data'])
-        adherence_history = patient_data.get('medicationAdherence', [])
-        adherence_history.append(adherence_record)
-        
-        # Keep only last 90 days
-        patient_data['medicationAdherence'] = adherence_history[-270:]  # 3 meds * 3 times * 30 days
-        
-        # Save back to database
-        encrypted_data = encrypt_data(patient_data)
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE patients SET encrypted_data = %s WHERE code_hash = %s",
-                (encrypted_data, code_hash)
-            )
-            conn.commit()
-        
         logger.info(f"Medication adherence recorded for patient {code_hash[:8]}...")
         return jsonify({'success': True}), 200
         
@@ -2636,28 +3234,40 @@ def record_medication_taken():
         logger.error(f"Medication adherence tracking error: {e}")
         return jsonify({'error': str(e)}), 500
 
+ADHERENCE_HISTORY_LIMIT = 50
+
 @app.route('/api/health/medication-adherence/<code_hash>', methods=['GET'])
 def get_medication_adherence(code_hash):
     """Get medication adherence history for a patient"""
     try:
-        patient = db_manager.get_patient_data(code_hash)
-        if not patient:
+        # Calculate adherence statistics: patient check, counts and latest
+        # history in one aggregate query on medication_adherence
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        week_start = (now - timedelta(days=6)).strftime('%Y-%m-%d')
+        summary = db_manager.get_adherence_summary(code_hash, week_start, today, ADHERENCE_HISTORY_LIMIT)
+        if not summary:
             return jsonify({'error': 'Patient not found'}), 404
-        
-        patient_data = decrypt_data(patient['encrypted_data'])
-        adherence_history = patient_data.get('medicationAdherence', [])
-        
-        # Calculate adherence statistics
-        today = datetime.now().strftime('%Y-%m-%d')
-        last_7_days = [(datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
-        
-        recent_records = [r for r in adherence_history if r['date'] in last_7_days]
+        counts, history = summary, summary['history']
+        
+        # Entries still kept in the patient blob (bounded by ADHERENCE_BLOB_MAX):
+        # one pass, ISO dates compared as strings against the cutoff
+        legacy = decrypt_data(summary['encrypted_data']).get('medicationAdherence', [])
+        legacy_last7 = legacy_today = 0
+        for record in legacy:
+            date = record.get('date', '')
+            if week_start <= date <= today:
+                legacy_last7 += 1
+                if date == today:
+                    legacy_today += 1
+        if legacy:
+            history = sorted(legacy[-ADHERENCE_HISTORY_LIMIT:] + history, key=lambda r: r.get('takenAt') or '')
         
         stats = {
-            'totalRecords': len(adherence_history),
-            'last7Days': len(recent_records),
-            'todayRecords': len([r for r in adherence_history if r['date'] == today]),
-            'history': adherence_history[-50:]  # Last 50 records
+            'totalRecords': counts['total'] + len(legacy),
+            'last7Days': counts['last7'] + legacy_last7,
+            'todayRecords': counts['today'] + legacy_today,
+            'history': history[-ADHERENCE_HISTORY_LIMIT:]  # Last 50 records
         }
         
         return jsonify({'success': True, 'adherence': stats}), 200
@@ -2685,8 +3295,9 @@ def add_appointment():
         appointments = patient_data.get('appointments', [])
         
         # Add new appointment
-        appointment['id'] = 'appt-' + str(int(datetime.now().timestamp() * 1000))
-        appointment['createdAt'] = datetime.now().isoformat()
+        now = datetime.now()
+        appointment['id'] = 'appt-' + str(int(now.timestamp() * 1000))
+        appointment['createdAt'] = now.isoformat()
         appointments.append(appointment)
         
         patient_data['appointments'] = appointments
@@ -2695,10 +3306,7 @@ def add_appointment():
         encrypted_data = encrypt_data(patient_data)
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute(
-                "UPDATE patients SET encrypted_data = %s WHERE code_hash = %s",
-                (encrypted_data, code_hash)
-            )
+            db_manager.execute_prepared(cur, 'patient_update', (encrypted_data, code_hash))
             conn.commit()
         
         logger.info(f"Appointment added for patient {code_hash[:8]}...")
@@ -2780,6 +3388,47 @@ def check_survey_eligibility(code_hash):
 
 # app.py - Add endpoint (around line 1800)
 
+# Admin notification mail: one daemon thread keeps a logged-in SMTP connection
+# and drains this queue (one TLS handshake + login for many messages)
+_mail_queue = queue.Queue()
+
+
+def _smtp_connect():
+    server = smtplib.SMTP(
+        os.environ.get('SMTP_SERVER', 'smtp.gmail.com'),
+        int(os.environ.get('SMTP_PORT', '587')),
+        timeout=30
+    )
+    server.starttls()
+    server.login(os.environ.get('SMTP_USER'), os.environ.get('SMTP_PASS'))
+    return server
+
+
+def _mail_worker():
+    server = None
+    while True:
+        msg = _mail_queue.get()
+        # Idle connections get closed by the server: reconnect once and retry
+        for attempt in range(2):
+            try:
+                if server is None:
+                    server = _smtp_connect()
+                server.send_message(msg)
+                break
+            except Exception as e:
+                if server is not None:
+                    try:
+                        server.close()
+                    except Exception:
+                        pass
+                    server = None
+                if attempt:
+                    logger.warning(f"Admin mail failed: {e}")
+        _mail_queue.task_done()
+
+
+threading.Thread(target=_mail_worker, name='admin-mail', daemon=True).start()
+
 @app.route('/api/account/request-deletion', methods=['POST'])
 def request_account_deletion():
     """Record account deletion request"""
@@ -2795,18 +3444,7 @@ def request_account_deletion():
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
             
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS deletion_requests (
-                    id SERIAL PRIMARY KEY,
-                    code_hash VARCHAR(64) NOT NULL,
-                    patient_code VARCHAR(21) NOT NULL,
-                    requested_at TIMESTAMP NOT NULL,
-                    status VARCHAR(20) DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(code_hash)
-                )
-            """)
-            
+            # Table is created once at startup (db_manager.ensure_schema)
             cur.execute("""
                 INSERT INTO deletion_requests (code_hash, patient_code, requested_at)
                 VALUES (%s, %s, %s)
@@ -2815,25 +3453,12 @@ def request_account_deletion():
             
             conn.commit()
         
-        # Send admin notification
-        try:
-            import smtplib
-            from email.mime.text import MIMEText
-            
-            msg = MIMEText(f"Deletion Request\n\nCode: {patient_code}\nHash: {code_hash}\nTime: {requested_at}")
-            msg['Subject'] = f'Account Deletion - {patient_code}'
-            msg['From'] = 'kanchanloveuad@gmail.com'
-            msg['To'] = 'kanchan.g12@loveuad.com'
-            
-            smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-            smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-            
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                server.login(os.environ.get('SMTP_USER'), os.environ.get('SMTP_PASS'))
-                server.send_message(msg)
-        except:
-            pass
+        # Send admin notification (queued - the SMTP handshake happens off the request)
+        msg = MIMEText(f"Deletion Request\n\nCode: {patient_code}\nHash: {code_hash}\nTime: {requested_at}")
+        msg['Subject'] = f'Account Deletion - {patient_code}'
+        msg['From'] = 'kanchanloveuad@gmail.com'
+        msg['To'] = 'kanchan.g12@loveuad.com'
+        _mail_queue.put(msg)
         
         logger.info(f"✓ Deletion request: {patient_code}")
         return jsonify({'success': True}), 200
@@ -2842,6 +3467,12 @@ def request_account_deletion():
         logger.error(f"Deletion request error: {e}")
         return jsonify({'error': str(e)}), 500
 
+db_manager.register_prepared('survey_insert', """
+    INSERT INTO survey_responses (code_hash, completion_date, result_bucket, survey_day)
+    VALUES (%s, CURRENT_DATE, %s, %s)
+    ON CONFLICT (code_hash, survey_day) DO NOTHING
+""")
+
 @app.route('/api/survey/record-completion', methods=['POST'])
 def record_survey_completion():
     """
@@ -2863,11 +3494,7 @@ def record_survey_completion():
         # Store ONLY anonymous data
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO survey_responses (code_hash, completion_date, result_bucket, survey_day)
-                VALUES (%s, CURRENT_DATE, %s, %s)
-                ON CONFLICT (code_hash, survey_day) DO NOTHING
-            """, (code_hash, result_bucket, survey_day))
+            db_manager.execute_prepared(cur, 'survey_insert', (code_hash, result_bucket, survey_day))
             conn.commit()
         
         logger.info(f"Survey recorded: Day {survey_day}, Bucket: {result_bucket}")
@@ -2877,6 +3504,42 @@ def record_survey_completion():
         logger.error(f"Survey recording error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Counts by (day, bucket) from idx_survey_day_bucket, shaped into
+# {"success", "stats": {totalResponses, byDay: {"Day N": {Low, Medium, High}}, byBucket}}
+db_manager.register_prepared('survey_stats', """
+    WITH counts AS (
+        SELECT survey_day, result_bucket, COUNT(*) AS cnt
+        FROM survey_responses
+        GROUP BY survey_day, result_bucket
+    )
+    SELECT json_build_object(
+        'success', true,
+        'stats', json_build_object(
+            'totalResponses', (SELECT COALESCE(SUM(cnt), 0) FROM counts),
+            'byDay', COALESCE((
+                SELECT json_object_agg('Day ' || survey_day, buckets ORDER BY survey_day)
+                FROM (
+                    SELECT survey_day, json_build_object(
+                        'Low', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'Low'), 0),
+                        'Medium', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'Medium'), 0),
+                        'High', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'High'), 0)
+                    ) AS buckets
+                    FROM counts
+                    GROUP BY survey_day
+                ) days
+            ), '{}'::json),
+            'byBucket', (
+                SELECT json_build_object(
+                    'Low', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'Low'), 0),
+                    'Medium', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'Medium'), 0),
+                    'High', COALESCE(SUM(cnt) FILTER (WHERE result_bucket = 'High'), 0)
+                )
+                FROM counts
+            )
+        )
+    )::text AS body
+""")
+
 @app.route('/api/survey/aggregate-stats', methods=['GET'])
 def get_survey_aggregate_stats():
     """
@@ -2886,32 +3549,11 @@ def get_survey_aggregate_stats():
     try:
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            # Get aggregated stats by bucket and survey day
-            cur.execute("""
-                SELECT 
-                    survey_day,
-                    result_bucket,
-                    COUNT(*) as count
-                FROM survey_responses
-                GROUP BY survey_day, result_bucket
-                ORDER BY survey_day, result_bucket
-            """)
-            results = cur.fetchall()
-        
-        stats = {
-            'totalResponses': sum(r['count'] for r in results),
-            'byDay': {},
-            'byBucket': {'Low': 0, 'Medium': 0, 'High': 0}
-        }
-        
-        for row in results:
-            day = f"Day {row['survey_day']}"
-            if day not in stats['byDay']:
-                stats['byDay'][day] = {'Low': 0, 'Medium': 0, 'High': 0}
-            stats['byDay'][day][row['result_bucket']] = row['count']
-            stats['byBucket'][row['result_bucket']] += row['count']
+            # Whole response body built by Postgres, sent back as-is
+            db_manager.execute_prepared(cur, 'survey_stats')
+            body = cur.fetchone()['body']
         
-        return jsonify({'success': True, 'stats': stats}), 200
+        return Response(body, status=200, mimetype='application/json')
         
     except Exception as e:
         logger.error(f"Survey stats error: {e}")
@@ -2959,12 +3601,16 @@ def record_app_launch():
             """, (code_hash, today))
             
             # Increment the AGGREGATED hourly count (NO code stored here)
-            cur.execute("""
-                INSERT INTO daily_active_users (event_date, event_hour, launch_count)
-                VALUES (%s, %s, 1)
-                ON CONFLICT (event_date, event_hour) 
-                DO UPDATE SET launch_count = daily_active_users.launch_count + 1
-            """, (today, current_hour))
+            db_manager.execute_prepared(cur, 'dau_upsert', (today, current_hour))
+            
+            # Fold the code into today's HLL sketch (hashed, not recoverable)
+            if HLL_ENABLED:
+                cur.execute("""
+                    INSERT INTO daily_active_hll (launch_date, codes)
+                    VALUES (%s, hll_add(hll_empty(), hll_hash_text(%s)))
+                    ON CONFLICT (launch_date)
+                    DO UPDATE SET codes = daily_active_hll.codes || EXCLUDED.codes
+                """, (today, code_hash))
             
             # CRITICAL: Clean up old tracker data (keep only last 2 days)
             cur.execute("""
@@ -3010,23 +3656,23 @@ def get_dau_stats():
             # Get hourly distribution (last 7 days)
             cur.execute("""
                 SELECT 
-                    event_hour,
+                    event_date_hour as event_hour,
                     AVG(launch_count) as avg_launches
                 FROM daily_active_users
                 WHERE event_date >= %s
-                GROUP BY event_hour
-                ORDER BY event_hour
+                GROUP BY event_date_hour
+                ORDER BY event_date_hour
             """, (datetime.now().date() - timedelta(days=7),))
             hourly_stats = cur.fetchall()
         
         stats = {
             'disclaimer': 'Cumulative Daily Active Users are tracked by counting the total number of unique, daily App Launch events generated by anonymous codes. We do not track the identity of the user.',
-            'dailyTotals': [{'date': str(row['event_date']), 'count': row['daily_total']} for row in daily_stats],
+            'dailyTotals': [{'date': row['event_date'], 'count': row['daily_total']} for row in daily_stats],
             'hourlyAverage': [{'hour': row['event_hour'], 'avgCount': float(row['avg_launches'])} for row in hourly_stats],
             'totalDaysTracked': len(daily_stats)
         }
         
-        return jsonify({'success': True, 'stats': stats}), 200
+        return ojson({'success': True, 'stats': stats})
         
     except Exception as e:
         logger.error(f"DAU stats error: {e}")
@@ -3068,8 +3714,7 @@ def update_patient_tier_noapi():
         
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute("UPDATE patients SET encrypted_data = %s WHERE code_hash = %s;", 
-                       (encrypted_data, code_hash))
+            db_manager.execute_prepared(cur, 'patient_update', (encrypted_data, code_hash))
             conn.commit()
         
         return jsonify({'success': True, 'tier': tier}), 200
@@ -3108,19 +3753,65 @@ def admin_analytics_page():
     """
     return render_template('admin_analytics.html')
 
+# Hash of the admin password (from environment variable, set in Cloud Run),
+# computed once so requests only do a constant-time digest compare
+_ADMIN_PASSWORD_HASH = hashlib.sha256(
+    os.environ.get('ADMIN_PASSWORD', 'LoveUAD2025!Admin').encode()
+).digest()
+
+# Failed admin login attempts per client IP: {ip: (count, window_start)}
+# (bounded so a flood of distinct IPs can't grow it without limit)
+ADMIN_LOGIN_MAX_ATTEMPTS = 10
+ADMIN_LOGIN_WINDOW_SECONDS = 300
+_admin_login_attempts = TTLCache(maxsize=10_000, ttl=ADMIN_LOGIN_WINDOW_SECONDS)
+_admin_login_lock = threading.Lock()
+
+def _admin_client_ip():
+    """
+    Client IP as seen by our proxy. Only the last X-Forwarded-For entry is
+    appended by the Cloud Run front end; earlier ones are client-supplied.
+    """
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.rsplit(',', 1)[-1].strip()
+    return request.remote_addr or ''
+
+def _admin_login_blocked(ip):
+    """True if this IP has used up its failed attempts in the current window"""
+    now = time.monotonic()
+    with _admin_login_lock:
+        count, window_start = _admin_login_attempts.get(ip, (0, now))
+        if now - window_start > ADMIN_LOGIN_WINDOW_SECONDS:
+            _admin_login_attempts.pop(ip, None)
+            return False
+        return count >= ADMIN_LOGIN_MAX_ATTEMPTS
+
+def _record_admin_login_failure(ip):
+    now = time.monotonic()
+    with _admin_login_lock:
+        count, window_start = _admin_login_attempts.get(ip, (0, now))
+        if now - window_start > ADMIN_LOGIN_WINDOW_SECONDS:
+            count, window_start = 0, now
+        _admin_login_attempts[ip] = (count + 1, window_start)
+
 @app.route('/api/admin/verify-password', methods=['POST'])
 def verify_admin_password():
     """Verify admin password - stored in environment variable for security"""
     try:
-        data = request.json
-        password = data.get('password')
+        client_ip = _admin_client_ip()
+        if _admin_login_blocked(client_ip):
+            return jsonify({'success': False, 'error': 'Too many attempts, try again later'}), 429
         
-        # Admin password from environment variable (set in Cloud Run)
-        admin_password = os.environ.get('ADMIN_PASSWORD', 'LoveUAD2025!Admin')
+        data = request.json
+        password = data.get('password') or ''
         
-        if password == admin_password:
+        password_hash = hashlib.sha256(password.encode()).digest()
+        if hmac.compare_digest(_ADMIN_PASSWORD_HASH, password_hash):
+            with _admin_login_lock:
+                _admin_login_attempts.pop(client_ip, None)
             return jsonify({'success': True, 'token': 'authenticated'}), 200
         else:
+            _record_admin_login_failure(client_ip)
             return jsonify({'success': False, 'error': 'Invalid password'}), 401
             
     except Exception as e:
@@ -3136,104 +3827,120 @@ def get_admin_dashboard_stats():
     try:
         with db_manager.get_connection() as conn:
             cur = conn.cursor()
-            # Total patient accounts
-            cur.execute("SELECT COUNT(*) as count FROM patients")
-            total_patients = cur.fetchone()['count']
-            
-            # Total caregiver accounts
-            cur.execute("SELECT COUNT(*) as count FROM caregivers")
-            total_caregivers = cur.fetchone()['count']
-            
-            # Active users (logged in last 7 days) - from daily_launch_tracker
-            cur.execute("""
-                SELECT COUNT(DISTINCT code_hash) as count 
-                FROM daily_launch_tracker 
-                WHERE launch_date >= CURRENT_DATE - INTERVAL '7 days'
-            """)
-            active_last_7_days = cur.fetchone()
-            active_users = active_last_7_days['count'] if active_last_7_days else 0
-            
-            # Survey statistics
-            cur.execute("""
-                SELECT 
-                    COUNT(DISTINCT code_hash) as unique_respondents,
-                    COUNT(*) as total_responses,
-                    survey_day,
-                    result_bucket,
-                    COUNT(*) as count
-                FROM survey_responses
-                GROUP BY survey_day, result_bucket
-                ORDER BY survey_day, result_bucket
-            """)
-            survey_data = cur.fetchall()
-            
-            # DAU statistics (last 30 days)
-            cur.execute("""
-                SELECT 
-                    event_date,
-                    SUM(launch_count) as daily_total
-                FROM daily_active_users
-                WHERE event_date >= CURRENT_DATE - INTERVAL '30 days'
-                GROUP BY event_date
-                ORDER BY event_date DESC
-            """)
-            dau_daily = cur.fetchall()
-            
-            # DAU by hour (last 7 days)
-            cur.execute("""
-                SELECT 
-                    event_hour,
-                    AVG(launch_count) as avg_launches,
-                    MAX(launch_count) as peak_launches
-                FROM daily_active_users
-                WHERE event_date >= CURRENT_DATE - INTERVAL '7 days'
-                GROUP BY event_hour
-                ORDER BY event_hour
-            """)
-            dau_hourly = cur.fetchall()
-            
-            # Medication adherence statistics
-            cur.execute("""
-                SELECT 
-                    COUNT(*) as total_medications
-                FROM medications
-            """)
-            total_meds = cur.fetchone()['count']
-            
-            # Recent survey responses (aggregated)
-            cur.execute("""
-                SELECT 
-                    completion_date,
-                    COUNT(*) as responses_count,
-                    result_bucket
-                FROM survey_responses
-                WHERE completion_date >= CURRENT_DATE - INTERVAL '30 days'
-                GROUP BY completion_date, result_bucket
-                ORDER BY completion_date DESC
-                LIMIT 50
+            # All dashboard aggregates in a single round-trip: scalar counts as
+            # columns, row sets folded into JSON arrays
+            cur.execute(f"""
+                WITH dau AS (
+                    SELECT 
+                        event_date,
+                        SUM(launch_count) as daily_total
+                    FROM daily_active_users
+                    WHERE event_date >= CURRENT_DATE - INTERVAL '30 days'
+                    GROUP BY event_date
+                )
+                SELECT
+                    -- Total patient / caregiver accounts
+                    (SELECT COUNT(*) FROM patients) as total_patients,
+                    (SELECT COUNT(*) FROM caregivers) as total_caregivers,
+                    
+                    -- Active users (logged in last 7 days)
+                    ({ACTIVE_USERS_7D_SQL}) as active_users,
+                    
+                    -- Medication statistics
+                    (SELECT COUNT(*) FROM medications) as total_medications,
+                    
+                    -- Survey totals
+                    st.unique_respondents,
+                    st.total_responses,
+                    st.low,
+                    st.medium,
+                    st.high,
+                    
+                    -- Survey statistics - pivoted per survey day
+                    (SELECT COALESCE(json_agg(d ORDER BY d.survey_day), '[]'::json)
+                       FROM (
+                           SELECT 
+                               survey_day,
+                               COUNT(*) FILTER (WHERE result_bucket = 'Low') as low,
+                               COUNT(*) FILTER (WHERE result_bucket = 'Medium') as medium,
+                               COUNT(*) FILTER (WHERE result_bucket = 'High') as high,
+                               COUNT(*) as total
+                           FROM survey_responses
+                           GROUP BY survey_day
+                       ) d) as survey_by_day,
+                    
+                    -- DAU statistics (last 30 days)
+                    (SELECT COALESCE(json_agg(d ORDER BY d.event_date DESC), '[]'::json)
+                       FROM dau d) as dau_daily,
+                    (SELECT COUNT(*) FROM dau) as total_days_tracked,
+                    (SELECT COALESCE(ROUND(AVG(daily_total), 1), 0)::float8 FROM dau) as avg_daily_users,
+                    
+                    -- DAU by hour (last 7 days)
+                    (SELECT COALESCE(json_agg(d ORDER BY d.event_hour), '[]'::json)
+                       FROM (
+                           SELECT 
+                               event_date_hour as event_hour,
+                               AVG(launch_count) as avg_launches,
+                               MAX(launch_count) as peak_launches
+                           FROM daily_active_users
+                           WHERE event_date >= CURRENT_DATE - INTERVAL '7 days'
+                           GROUP BY event_date_hour
+                       ) d) as dau_hourly,
+                    
+                    -- Recent survey responses (aggregated)
+                    (SELECT COALESCE(json_agg(d ORDER BY d.completion_date DESC), '[]'::json)
+                       FROM (
+                           SELECT 
+                               completion_date,
+                               COUNT(*) as responses_count,
+                               result_bucket
+                           FROM survey_responses
+                           WHERE completion_date >= CURRENT_DATE - INTERVAL '30 days'
+                           GROUP BY completion_date, result_bucket
+                           ORDER BY completion_date DESC
+                           LIMIT 50
+                       ) d) as recent_surveys
+                FROM (
+                    SELECT 
+                        COUNT(DISTINCT code_hash) as unique_respondents,
+                        COUNT(*) as total_responses,
+                        COUNT(*) FILTER (WHERE result_bucket = 'Low') as low,
+                        COUNT(*) FILTER (WHERE result_bucket = 'Medium') as medium,
+                        COUNT(*) FILTER (WHERE result_bucket = 'High') as high
+                    FROM survey_responses
+                ) st
             """)
-            recent_surveys = cur.fetchall()
+            row = cur.fetchone()
         
-        # Process survey data
+        total_patients = row['total_patients']
+        total_caregivers = row['total_caregivers']
+        active_users = row['active_users']
+        total_meds = row['total_medications']
+        survey_totals = row
+        survey_by_day = row['survey_by_day']
+        dau_daily = row['dau_daily']
+        dau_hourly = row['dau_hourly']
+        recent_surveys = row['recent_surveys']
+        
+        # Serialize survey data (already aggregated in SQL)
         survey_stats = {
-            'unique_respondents': 0,
-            'total_responses': 0,
-            'by_day': {},
-            'by_bucket': {'Low': 0, 'Medium': 0, 'High': 0}
+            'unique_respondents': survey_totals['unique_respondents'],
+            'total_responses': survey_totals['total_responses'],
+            'by_day': {
+                f"Day {r['survey_day']}": {
+                    'Low': r['low'],
+                    'Medium': r['medium'],
+                    'High': r['high'],
+                    'total': r['total']
+                } for r in survey_by_day
+            },
+            'by_bucket': {
+                'Low': survey_totals['low'],
+                'Medium': survey_totals['medium'],
+                'High': survey_totals['high']
+            }
         }
         
-        if survey_data:
-            survey_stats['unique_respondents'] = survey_data[0].get('unique_respondents', 0) if survey_data else 0
-            survey_stats['total_responses'] = sum(r['count'] for r in survey_data)
-            
-            for row in survey_data:
-                day_key = f"Day {row['survey_day']}"
-                if day_key not in survey_stats['by_day']:
-                    survey_stats['by_day'][day_key] = {'Low': 0, 'Medium': 0, 'High': 0, 'total': 0}
-                survey_stats['by_day'][day_key][row['result_bucket']] = row['count']
-                survey_stats['by_day'][day_key]['total'] += row['count']
-                survey_stats['by_bucket'][row['result_bucket']] += row['count']
-        
         # Calculate survey improvement metric
         improvement_percentage = 0
         if 'Day 30' in survey_stats['by_day'] and 'Day 90' in survey_stats['by_day']:
@@ -3259,7 +3966,7 @@ def get_admin_dashboard_stats():
                 'improvement_percentage': round(improvement_percentage, 1),
                 'recent_responses': [
                     {
-                        'date': str(r['completion_date']),
+                        'date': r['completion_date'],
                         'count': r['responses_count'],
                         'bucket': r['result_bucket']
                     } for r in recent_surveys
@@ -3267,7 +3974,7 @@ def get_admin_dashboard_stats():
             },
             'dau': {
                 'daily_totals': [
-                    {'date': str(r['event_date']), 'count': r['daily_total']} 
+                    {'date': r['event_date'], 'count': r['daily_total']} 
                     for r in dau_daily
                 ],
                 'hourly_average': [
@@ -3278,12 +3985,12 @@ def get_admin_dashboard_stats():
                     } 
                     for r in dau_hourly
                 ],
-                'total_days_tracked': len(dau_daily),
-                'avg_daily_users': round(sum(r['daily_total'] for r in dau_daily) / len(dau_daily), 1) if dau_daily else 0
+                'total_days_tracked': row['total_days_tracked'],
+                'avg_daily_users': row['avg_daily_users']
             }
         }
         
-        return jsonify({'success': True, 'stats': stats}), 200
+        return ojson({'success': True, 'stats': stats})
         
     except Exception as e:
         logger.error(f"Admin dashboard stats error: {e}")
@@ -3295,12 +4002,13 @@ def health_check_noapi():
 
 # ==================== CONTACT FORM ====================
 
+# Max characters of the message echoed back in the Google Form redirect URL
+CONTACT_REDIRECT_MESSAGE_MAX = 1000
+
 @app.route('/api/contact', methods=['POST'])
 def contact_form():
     """Handle contact form submissions and forward to Google Forms"""
     try:
-        import requests
-        
         data = request.json
         name = data.get('name', '')
         email = data.get('email', '')
@@ -3334,10 +4042,17 @@ def contact_form():
         logger.info(f"Contact form submission from {email}")
         
         # Return the Google Form URL for client-side submission
+        # (full message is kept in the database; cap it in the URL)
+        redirect_query = urlencode({
+            'entry.NAME': name,
+            'entry.EMAIL': email,
+            'entry.SUBJECT': subject,
+            'entry.MESSAGE': message[:CONTACT_REDIRECT_MESSAGE_MAX]
+        })
         return jsonify({
             'success': True, 
             'message': 'Thank you for your interest!',
-            'redirect': f'https://docs.google.com/forms/d/e/1FAIpQLSdGvoST8Q_FbQMhx3Va9CViypuhfp8dnbCqmXPTkXraX27Ljw/formResponse?entry.NAME={name}&entry.EMAIL={email}&entry.SUBJECT={subject}&entry.MESSAGE={message}'
+            'redirect': f"{google_form_url}?{redirect_query}"
         }), 200
         
     except Exception as e:
@@ -3382,20 +4097,12 @@ def followup_call():
                 alarm_id, code_hash, med_name, time_str, phone = alarm
                 
                 try:
-                    from twilio.rest import Client
-                    
-                    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-                    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-                    twilio_phone = os.environ.get('TWILIO_PHONE_NUMBER')
-                    
-                    if account_sid and auth_token and twilio_phone:
-                        client = Client(account_sid, auth_token)
-                        
+                    if TWILIO_CLIENT:
                         twiml_url = f"https://loveuad.com/api/twilio/followup-voice?med={med_name}&time={time_str}&hash={code_hash}"
                         
-                        call = client.calls.create(
+                        call = TWILIO_CLIENT.calls.create(
                             to=phone,
-                            from_=twilio_phone,
+                            from_=TWILIO_FROM,
                             url=twiml_url,
                             method='POST'
                         )
@@ -3438,9 +4145,6 @@ def make_followup_call(phone, medication_name, time, code_hash):
 @app.route('/api/twilio/followup-voice', methods=['POST'])
 def followup_voice():
     """Handle follow-up call voice response"""
-    from flask import request
-    from twilio.twiml.voice_response import VoiceResponse, Gather
-    
     response = VoiceResponse()
     med_name = request.args.get('med')
     time_str = request.args.get('time')
@@ -3457,27 +4161,9 @@ def followup_voice():
     else:
         # Patient responded
         if 'yes' in speech_result:
-            # Mark as taken
-            with db_manager.get_connection() as conn:
-                cur = conn.cursor()
-                cur.execute("SELECT encrypted_data FROM patients WHERE code_hash = %s", (code_hash,))
-                patient = cur.fetchone()
-                
-                patient_data = decrypt_data(patient['encrypted_data'])
-                adherence = patient_data.get('medicationAdherence', [])
-                
-                adherence.append({
-                    'medication': med_name,
-                    'scheduledTime': time_str,
-                    'takenAt': datetime.now().isoformat(),
-                    'date': datetime.now().strftime('%Y-%m-%d'),
-                    'status': 'taken'
-                })
-                
-                patient_data['medicationAdherence'] = adherence[-100:]
-                encrypted = encrypt_data(patient_data)
-                cur.execute("UPDATE patients SET encrypted_data = %s WHERE code_hash = %s", (encrypted, code_hash))
-                conn.commit()
+            # Mark as taken - one append-only row, the patient blob is not rewritten
+            now = datetime.now()
+            db_manager.record_adherence(code_hash, med_name, time_str, now.astimezone(), now.strftime('%Y-%m-%d'))
             
             response.say("Thank you. Medication marked as taken.")
         else:
@@ -3508,31 +4194,12 @@ def followup_response():
                     VALUES (%s, %s, %s, %s, 'taken')
                 """, (code_hash, med_name, time, datetime.now(timezone.utc)))
                 
-                # ✅ ALSO update patient's encrypted_data with adherence record
-                cur.execute("SELECT encrypted_data FROM patients WHERE code_hash = %s", (code_hash,))
-                patient = cur.fetchone()
-                
-                if patient:
-                    patient_data = decrypt_data(patient['encrypted_data'])
-                    adherence_history = patient_data.get('medicationAdherence', [])
-                    
-                    adherence_record = {
-                        'medication': med_name,
-                        'scheduledTime': time,
-                        'takenAt': datetime.now(timezone.utc).isoformat(),
-                        'date': datetime.now().strftime('%Y-%m-%d'),
-                        'status': 'taken',
-                        'method': 'phone_followup'
-                    }
-                    
-                    adherence_history.append(adherence_record)
-                    patient_data['medicationAdherence'] = adherence_history[-270:]  # Keep last 90 days
-                    
-                    encrypted_data = encrypt_data(patient_data)
-                    cur.execute(
-                        "UPDATE patients SET encrypted_data = %s WHERE code_hash = %s",
-                        (encrypted_data, code_hash)
-                    )
+                # ✅ ALSO record adherence (append-only row, no patient blob rewrite)
+                now_utc = datetime.now(timezone.utc)
+                db_manager.record_adherence(
+                    code_hash, med_name, time, now_utc,
+                    now_utc.astimezone().strftime('%Y-%m-%d'), 'phone_followup'
+                )
                 
                 conn.commit()
                 logger.info(f"✓ Medication marked as taken via follow-up call: {med_name} at {time}")
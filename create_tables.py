@@ -52,9 +52,11 @@ def create_analytics_tables():
                     event_hour INTEGER NOT NULL CHECK (event_hour >= 0 AND event_hour < 24),
                     launch_count INTEGER NOT NULL DEFAULT 1,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    event_date_hour SMALLINT GENERATED ALWAYS AS (event_hour) STORED,
                     UNIQUE(event_date, event_hour)
                 );
                 CREATE INDEX idx_dau_event_date ON daily_active_users(event_date);
+                CREATE INDEX idx_dau_event_date_brin ON daily_active_users USING BRIN (event_date);
             """)
             print("✓ Created daily_active_users table")
             
@@ -1,183 +1,616 @@
 # db_manager.py - COMPLETE FILE WITH STATUS METHODS
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from contextlib import contextmanager
+from flask import g, has_request_context
 import logging
 import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Hot statements prepared server-side once per connection (see execute_prepared)
+PREPARED_STATEMENTS = {
+    'dau_upsert': """
+        INSERT INTO daily_active_users (event_date, event_hour, launch_count)
+        VALUES ($1, $2, 1)
+        ON CONFLICT (event_date, event_hour)
+        DO UPDATE SET launch_count = daily_active_users.launch_count + 1
+    """,
+    'patient_update': """
+        UPDATE patients SET encrypted_data = $1 WHERE code_hash = $2
+    """,
+}
+
+# Startup DDL / migrations, one transaction each, in dependency order (see ensure_schema)
+SCHEMA_STEPS = (
+    ('medication_reminders', """
+        CREATE TABLE IF NOT EXISTS medication_reminders (
+            id SERIAL PRIMARY KEY,
+            code_hash VARCHAR(64),
+            medication_name VARCHAR(200) NOT NULL,
+            time TIME NOT NULL,
+            followup_time TIME,
+            active BOOLEAN DEFAULT true,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            phone_number VARCHAR(20),
+            last_called TIMESTAMP,
+            daily_status VARCHAR(10) NOT NULL DEFAULT 'PENDING'
+        );
+        CREATE INDEX IF NOT EXISTS idx_reminders_active_time
+            ON medication_reminders (time) WHERE active;
+        CREATE INDEX IF NOT EXISTS idx_reminders_active_code_time
+            ON medication_reminders (code_hash, time) WHERE active;
+        CREATE INDEX IF NOT EXISTS idx_reminders_active_followup
+            ON medication_reminders (followup_time) WHERE active;
+        CREATE INDEX IF NOT EXISTS idx_reminders_time_id
+            ON medication_reminders (time, id);
+    """),
+    ('medications', """
+        CREATE INDEX IF NOT EXISTS idx_medications_codehash_active
+            ON medications (code_hash) WHERE active = true;
+        ALTER TABLE medications ADD COLUMN IF NOT EXISTS name_hash BYTEA;
+        CREATE INDEX IF NOT EXISTS idx_medications_code_name
+            ON medications (code_hash, name_hash);
+    """),
+    ('medication_adherence', """
+        CREATE TABLE IF NOT EXISTS medication_adherence (
+            id BIGSERIAL PRIMARY KEY,
+            code_hash VARCHAR(64) NOT NULL,
+            medication_name VARCHAR(200) NOT NULL,
+            scheduled_time VARCHAR(10),
+            taken_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            taken_date DATE NOT NULL DEFAULT CURRENT_DATE,
+            status VARCHAR(20) NOT NULL DEFAULT 'taken',
+            method VARCHAR(30)
+        );
+        CREATE INDEX IF NOT EXISTS idx_adherence_code_taken
+            ON medication_adherence (code_hash, taken_at DESC);
+    """),
+    ('push_subscriptions', """
+        CREATE TABLE IF NOT EXISTS push_subscriptions (
+            id SERIAL PRIMARY KEY,
+            code_hash VARCHAR(64) NOT NULL,
+            subscription_data TEXT NOT NULL,
+            active BOOLEAN DEFAULT true,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sub_hash BYTEA
+        );
+    """),
+    # Subscriptions are unique on a SHA-256 of the canonical (jsonb) JSON,
+    # not on the raw TEXT: 32-byte compares, key order doesn't matter
+    ('push_subscriptions sub_hash', """
+        ALTER TABLE push_subscriptions ADD COLUMN IF NOT EXISTS sub_hash BYTEA;
+        UPDATE push_subscriptions
+            SET sub_hash = sha256(convert_to(subscription_data::jsonb::text, 'UTF8'))
+            WHERE sub_hash IS NULL;
+        DELETE FROM push_subscriptions a
+            USING push_subscriptions b
+            WHERE a.code_hash = b.code_hash AND a.sub_hash = b.sub_hash AND a.id < b.id;
+        ALTER TABLE push_subscriptions
+            DROP CONSTRAINT IF EXISTS push_subscriptions_code_hash_subscription_data_key;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_push_subscriptions_code_sub
+            ON push_subscriptions (code_hash, sub_hash);
+    """),
+    ('deletion_requests', """
+        CREATE TABLE IF NOT EXISTS deletion_requests (
+            id SERIAL PRIMARY KEY,
+            code_hash VARCHAR(64) NOT NULL,
+            patient_code VARCHAR(21) NOT NULL,
+            requested_at TIMESTAMP NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(code_hash)
+        );
+    """),
+)
+
+# Pooled connections idle longer than this are pinged (SELECT 1) before reuse;
+# the server or a NAT may have dropped them without conn.closed noticing
+POOL_PING_IDLE_SECONDS = float(os.getenv('PG_POOL_PING_IDLE', '30'))
+POOL_CHECKOUT_ATTEMPTS = 3
+
+# ThreadedConnectionPool raises PoolError the moment it is empty; checkouts
+# wait up to this long for a free connection instead
+POOL_WAIT_SECONDS = float(os.getenv('PG_POOL_WAIT', '10'))
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that remembers which prepared statements it already holds"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.last_used = time.monotonic()
+
 class DatabaseManager:
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        self._slots = None  # one per pooled connection, see _checkout
         self.connect()
     
     def connect(self):
-        """Connect with auto-reconnect if dead"""
-        if self.conn is not None:
-            try:
-                with self.conn.cursor() as cur:
-                    cur.execute("SELECT 1")
-                return self.conn
-            except:
-                logger.warning("🔄 Reconnecting to database...")
-                try:
-                    self.conn.close()
-                except:
-                    pass
-                self.conn = None
+        """Create the connection pool (idempotent)"""
+        if self.pool is not None:
+            return self.pool
         
         try:
             database_url = os.getenv('DATABASE_URL')
             if not database_url:
                 raise Exception("DATABASE_URL not set")
-            self.conn = psycopg2.connect(database_url, cursor_factory=RealDictCursor)
-            self.conn.autocommit = False
-            logger.info("✓ Database connected")
-            return self.conn
+            maxconn = int(os.getenv('PG_POOL_MAX', '25'))
+            self.pool = ThreadedConnectionPool(
+                minconn=int(os.getenv('PG_POOL_MIN', '5')),
+                maxconn=maxconn,
+                dsn=database_url,
+                connection_factory=PreparingConnection,
+                cursor_factory=RealDictCursor
+            )
+            self._slots = threading.BoundedSemaphore(maxconn)
+            logger.info("✓ Database pool ready")
+            return self.pool
         except Exception as e:
             logger.error(f"❌ Database connection failed: {e}")
             raise
     
+    @staticmethod
+    def _is_alive(conn):
+        """Cheap liveness check: only connections idle past POOL_PING_IDLE_SECONDS are pinged"""
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used <= POOL_PING_IDLE_SECONDS:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def _checkout(self):
+        """Take a live connection from the pool, waiting up to POOL_WAIT_SECONDS for one"""
+        if not self._slots.acquire(timeout=POOL_WAIT_SECONDS):
+            raise PoolError(f"No database connection free after {POOL_WAIT_SECONDS}s")
+        try:
+            for _ in range(POOL_CHECKOUT_ATTEMPTS):
+                conn = self.pool.getconn()
+                if self._is_alive(conn):
+                    return conn
+                logger.warning("🔄 Replacing dead pooled connection...")
+                self.pool.putconn(conn, close=True)
+            return self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def _checkin(self, conn):
+        """Return a connection, dropping it if the server closed it"""
+        try:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            conn.last_used = time.monotonic()
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+    
+    def _acquire(self):
+        """
+        Inside a Flask request one connection is shared by every helper
+        (stashed on flask.g, returned in release_request_connection).
+        Background jobs get their own connection per block.
+        Returns (conn, owned_by_caller).
+        """
+        if has_request_context():
+            conn = g.get('_db_conn')
+            if conn is None or conn.closed:
+                if conn is not None:
+                    self._checkin(conn)
+                conn = self._checkout()
+                g._db_conn = conn
+            return conn, False
+        return self._checkout(), True
+    
+    def release_request_connection(self, exc=None):
+        """
+        Teardown hook: give the request's connection back to the pool.
+        Also called early by long-lived (streaming) responses; a later
+        get_connection() in the same request checks out a fresh one.
+        """
+        conn = g.pop('_db_conn', None)
+        if conn is not None:
+            self._checkin(conn)
+    
+    @staticmethod
+    def _in_transaction(conn):
+        return conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    
     @contextmanager
     def get_connection(self):
-        """Context manager that ensures connection is alive"""
-        conn = self.connect()
+        """
+        Context manager over a pooled connection; commits on success.
+        Inside a request only the outermost block commits / rolls back the
+        shared connection; a nested block runs in a SAVEPOINT, so its failure
+        undoes just its own writes and never ends the caller's transaction.
+        """
+        conn, owned = self._acquire()
+        depth = 0 if owned else g.get('_db_depth', 0)
+        savepoint = f"db_block_{depth}" if depth else None
+        if not owned:
+            g._db_depth = depth + 1
         try:
+            if savepoint:
+                with conn.cursor() as cur:
+                    cur.execute(f"SAVEPOINT {savepoint}")
             yield conn
-            conn.commit()
+            if not savepoint:
+                conn.commit()
+            elif self._in_transaction(conn):  # unless the block committed itself
+                with conn.cursor() as cur:
+                    cur.execute(f"RELEASE SAVEPOINT {savepoint}")
         except Exception as e:
-            conn.rollback()
+            if not conn.closed:
+                if savepoint and self._in_transaction(conn):
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                    except psycopg2.Error:  # savepoint gone (block committed mid-way)
+                        conn.rollback()
+                else:
+                    conn.rollback()
             logger.error(f"Transaction error: {e}")
             raise
+        finally:
+            if owned:
+                self._checkin(conn)
+            else:
+                g._db_depth = depth
+    
+    def ensure_schema(self):
+        """
+        Create tables that request handlers assume exist (run once at startup).
+        Each SCHEMA_STEPS entry commits on its own, so one failing step
+        doesn't roll back or hide the others.
+        """
+        failed = []
+        for step, sql in SCHEMA_STEPS:
+            try:
+                with self.get_connection() as conn, conn.cursor() as cur:
+                    cur.execute(sql)
+            except Exception as e:
+                failed.append(step)
+                logger.error(f"❌ Schema step '{step}' failed: {e}")
+        if failed:
+            logger.error(f"❌ Schema incomplete, failed steps: {', '.join(failed)}")
+        else:
+            logger.info("✓ Schema ensured")
+    
+    def register_prepared(self, name, sql):
+        """Add a statement written with %s placeholders to PREPARED_STATEMENTS"""
+        parts = sql.split('%s')
+        PREPARED_STATEMENTS[name] = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+    
+    def execute_prepared(self, cur, name, params=()):
+        """EXECUTE a statement from PREPARED_STATEMENTS, preparing it on first use per connection"""
+        conn = cur.connection
+        if name not in conn.prepared_statements:
+            cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+            conn.prepared_statements.add(name)
+        if params:
+            placeholders = ', '.join(['%s'] * len(params))
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
     
     def get_patient_data(self, code_hash):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("SELECT * FROM patients WHERE code_hash = %s;", (code_hash,))
                 result = cur.fetchone()
-                conn.commit()
                 return result
         except Exception as e:
             logger.error(f"Error fetching patient: {e}")
-            conn.rollback()
+            raise
+    
+    def load_turn_context(self, code_hash, summaries_sql):
+        """
+        Patient row plus recent chat summaries in one round-trip.
+        `summaries_sql` selects the summary rows for a code_hash (one %s);
+        they come back as a list of dicts under 'turn_context'.
+        """
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT
+                        p.*,
+                        (SELECT COALESCE(json_agg(ctx), '[]'::json)
+                         FROM ({summaries_sql}) ctx) as turn_context
+                    FROM patients p
+                    WHERE p.code_hash = %s;
+                """, (code_hash, code_hash))
+                return cur.fetchone()
+        except Exception as e:
+            logger.error(f"Error loading turn context: {e}")
             raise
     
     def insert_patient_data(self, code_hash, encrypted_data, phone_number=''):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO patients (code_hash, encrypted_data, phone_number)
                     VALUES (%s, %s, %s);
                 """, (code_hash, encrypted_data, phone_number))
-                conn.commit()
                 logger.info(f"✅ Patient saved: {code_hash[:8]}...")
         except Exception as e:
             logger.error(f"❌ Error saving patient: {e}")
-            conn.rollback()
             raise
     
     def get_medications(self, code_hash):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT * FROM medications 
                     WHERE code_hash = %s AND active = TRUE;
                 """, (code_hash,))
                 result = cur.fetchall()
-                conn.commit()
                 return result
         except Exception as e:
             logger.error(f"Error fetching medications: {e}")
-            conn.rollback()
             raise
     
-    def insert_medication(self, code_hash, encrypted_data):
-        conn = self.connect()
+    def insert_medication(self, code_hash, encrypted_data, name_hash=None):
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
-                    INSERT INTO medications (code_hash, encrypted_data, active)
-                    VALUES (%s, %s, true);
-                """, (code_hash, encrypted_data))
-                conn.commit()
+                    INSERT INTO medications (code_hash, encrypted_data, name_hash, active)
+                    VALUES (%s, %s, %s, true);
+                """, (code_hash, encrypted_data, name_hash))
                 logger.info(f"✅ Medication saved")
         except Exception as e:
             logger.error(f"❌ Error saving medication: {e}")
-            conn.rollback()
+            raise
+    
+    @staticmethod
+    def _insert_medications(cur, code_hash, rows):
+        """rows: [(encrypted_data, name_hash)] - one multi-row INSERT"""
+        execute_values(cur, """
+            INSERT INTO medications (code_hash, encrypted_data, name_hash, active)
+            VALUES %s
+        """, [(code_hash, encrypted_data, name_hash) for encrypted_data, name_hash in rows],
+            template="(%s, %s, %s, true)", page_size=100)
+    
+    def insert_medications_bulk(self, code_hash, rows):
+        """Insert several medications in one statement; rows: [(encrypted_data, name_hash)]"""
+        if not rows:
+            return
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                self._insert_medications(cur, code_hash, rows)
+                logger.info(f"✅ {len(rows)} medications saved")
+        except Exception as e:
+            logger.error(f"❌ Error saving medications: {e}")
+            raise
+    
+    def save_scan(self, code_hash, medication_rows, record_type, encrypted_metadata):
+        """Scanned medications and the scan's health record in one transaction"""
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                if medication_rows:
+                    self._insert_medications(cur, code_hash, medication_rows)
+                cur.execute("""
+                    INSERT INTO health_records (code_hash, record_type, encrypted_metadata, record_date)
+                    VALUES (%s, %s, %s, NULL);
+                """, (code_hash, record_type, encrypted_metadata))
+                logger.info(f"✅ Scan saved with {len(medication_rows)} medications")
+        except Exception as e:
+            logger.error(f"❌ Error saving scan: {e}")
             raise
     
     def get_health_records(self, code_hash):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT * FROM health_records 
                     WHERE code_hash = %s 
                     ORDER BY created_at DESC;
                 """, (code_hash,))
                 result = cur.fetchall()
-                conn.commit()
                 return result
         except Exception as e:
             logger.error(f"Error fetching health records: {e}")
-            conn.rollback()
             raise
     
+    def _rows_if_patient(self, table, code_hash):
+        """
+        Rows of `table` for a code_hash (newest first) and the patient check in
+        one round-trip. Returns None if the patient doesn't exist.
+        """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT p.patient_exists, t.*
+                FROM (SELECT EXISTS (SELECT 1 FROM patients WHERE code_hash = %s) AS patient_exists) p
+                LEFT JOIN {table} t ON p.patient_exists AND t.code_hash = %s
+                ORDER BY t.created_at DESC;
+            """, (code_hash, code_hash))
+            rows = cur.fetchall()
+        if not rows[0]['patient_exists']:
+            return None
+        # No matching rows still yields the one LEFT JOIN row, all NULL
+        return [row for row in rows if row['id'] is not None]
+    
+    def get_records_if_patient(self, code_hash):
+        try:
+            return self._rows_if_patient('health_records', code_hash)
+        except Exception as e:
+            logger.error(f"Error fetching health records: {e}")
+            raise
+    
+    def get_conversations_if_patient(self, code_hash, limit=50, before_id=None):
+        """
+        One page of a patient's conversations, newest first (keyset on id:
+        pass the last id seen as before_id for the next page).
+        Returns None if the patient doesn't exist.
+        """
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT p.patient_exists, c.*
+                    FROM (SELECT EXISTS (SELECT 1 FROM patients WHERE code_hash = %s) AS patient_exists) p
+                    LEFT JOIN LATERAL (
+                        SELECT * FROM conversations
+                        WHERE p.patient_exists AND code_hash = %s
+                          AND (%s::int IS NULL OR id < %s::int)
+                        ORDER BY id DESC
+                        LIMIT %s
+                    ) c ON true
+                    ORDER BY c.id DESC;
+                """, (code_hash, code_hash, before_id, before_id, limit))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error fetching conversations: {e}")
+            raise
+        if not rows[0]['patient_exists']:
+            return None
+        return [row for row in rows if row['id'] is not None]
+    
+    def record_adherence(self, code_hash, medication, scheduled_time, taken_at, taken_date, method=None):
+        """Append one medication_adherence row if the patient exists; returns its id or None"""
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO medication_adherence
+                        (code_hash, medication_name, scheduled_time, taken_at, taken_date, method)
+                    SELECT %s, %s, %s, %s::timestamptz, %s::date, %s
+                    WHERE EXISTS (SELECT 1 FROM patients WHERE code_hash = %s)
+                    RETURNING id;
+                """, (code_hash, medication, scheduled_time, taken_at, taken_date, method, code_hash))
+                row = cur.fetchone()
+                return row['id'] if row else None
+        except Exception as e:
+            logger.error(f"Error recording adherence: {e}")
+            raise
+    
+    def get_adherence_summary(self, code_hash, week_start, today, limit=50):
+        """
+        One round-trip for the adherence endpoint: the patient's encrypted_data,
+        total / last-7-days / today counts and the latest `limit` records
+        (oldest first, blob-shaped). None if the patient doesn't exist.
+        """
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT p.encrypted_data, s.total, s.last7, s.today,
+                           COALESCE(h.history, '[]'::json) AS history
+                    FROM patients p
+                    CROSS JOIN LATERAL (
+                        SELECT COUNT(*) AS total,
+                               COUNT(*) FILTER (WHERE taken_date BETWEEN %s::date AND %s::date) AS last7,
+                               COUNT(*) FILTER (WHERE taken_date = %s::date) AS today
+                        FROM medication_adherence
+                        WHERE code_hash = p.code_hash
+                    ) s
+                    CROSS JOIN LATERAL (
+                        SELECT json_agg(json_build_object(
+                                   'medication', medication_name,
+                                   'scheduledTime', scheduled_time,
+                                   'takenAt', taken_at,
+                                   'date', taken_date::text,
+                                   'status', status,
+                                   'method', method
+                               ) ORDER BY taken_at) AS history
+                        FROM (
+                            SELECT * FROM medication_adherence
+                            WHERE code_hash = p.code_hash
+                            ORDER BY taken_at DESC
+                            LIMIT %s
+                        ) recent
+                    ) h
+                    WHERE p.code_hash = %s;
+                """, (week_start, today, today, limit, code_hash))
+                row = cur.fetchone()
+        except Exception as e:
+            logger.error(f"Error fetching adherence summary: {e}")
+            raise
+        if row:
+            for record in row['history']:
+                if record['method'] is None:
+                    del record['method']
+        return row
+    
+    def get_adherence(self, code_hash, since_date=None):
+        """
+        medication_adherence rows for a patient, oldest first, shaped like the
+        legacy medicationAdherence entries of the patient blob.
+        since_date: 'YYYY-MM-DD', only records taken on or after that day.
+        """
+        try:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT medication_name AS medication,
+                           scheduled_time AS "scheduledTime",
+                           taken_at AS "takenAt",
+                           taken_date::text AS date,
+                           status,
+                           method
+                    FROM medication_adherence
+                    WHERE code_hash = %s
+                      AND (%s::date IS NULL OR taken_date >= %s::date)
+                    ORDER BY taken_at;
+                """, (code_hash, since_date, since_date))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error fetching adherence: {e}")
+            raise
+        for row in rows:
+            row['takenAt'] = row['takenAt'].isoformat()
+            if row['method'] is None:
+                del row['method']
+        return rows
+    
     def insert_health_record(self, code_hash, record_type, encrypted_metadata, record_date=None):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO health_records (code_hash, record_type, encrypted_metadata, record_date)
                     VALUES (%s, %s, %s, %s);
                 """, (code_hash, record_type, encrypted_metadata, record_date))
-                conn.commit()
                 logger.info(f"✅ Health record saved")
         except Exception as e:
             logger.error(f"❌ Error saving health record: {e}")
-            conn.rollback()
             raise
     
     def get_conversations(self, code_hash):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT * FROM conversations 
                     WHERE code_hash = %s 
                     ORDER BY created_at DESC;
                 """, (code_hash,))
                 result = cur.fetchall()
-                conn.commit()
                 return result
         except Exception as e:
             logger.error(f"Error fetching conversations: {e}")
-            conn.rollback()
             raise
     
     def insert_conversation(self, code_hash, encrypted_query, encrypted_response, sources):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO conversations (code_hash, encrypted_query, encrypted_response, sources)
                     VALUES (%s, %s, %s, %s);
                 """, (code_hash, encrypted_query, encrypted_response, sources))
-                conn.commit()
         except Exception as e:
             logger.error(f"Error inserting conversation: {e}")
-            conn.rollback()
             raise
     
     def fts_search(self, tsquery_string, top_k=5):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT 
                         c.chunk_text,
@@ -194,56 +627,45 @@ class DatabaseManager:
                     LIMIT %s;
                 """, (tsquery_string, tsquery_string, top_k))
                 result = cur.fetchall()
-                conn.commit()
                 return result
         except Exception as e:
             logger.error(f"FTS search error: {e}")
-            conn.rollback()
             return []
     
     def get_stats(self):
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("SELECT COUNT(*) as total_papers FROM research_papers;")
                 papers = cur.fetchone()['total_papers']
                 cur.execute("SELECT COUNT(*) as total_chunks FROM paper_chunks;")
                 chunks = cur.fetchone()['total_chunks']
-                conn.commit()
                 return {'total_papers': papers, 'total_chunks': chunks}
         except Exception as e:
             logger.error(f"Error fetching stats: {e}")
-            conn.rollback()
             raise
     
     def update_reminder_status(self, code_hash, medication_name, new_status):
         """Update medication reminder status"""
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     UPDATE medication_reminders 
                     SET daily_status = %s
                     WHERE code_hash = %s AND medication_name = %s
                 """, (new_status, code_hash, medication_name))
-                conn.commit()
                 logger.info(f"✅ Status: {medication_name} → {new_status}")
         except Exception as e:
             logger.error(f"❌ Status update error: {e}")
-            conn.rollback()
             raise
     
     def reset_all_reminder_statuses(self):
         """Reset all to PENDING at midnight"""
-        conn = self.connect()
         try:
-            with conn.cursor() as cur:
+            with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute("UPDATE medication_reminders SET daily_status = 'PENDING'")
                 affected = cur.rowcount
-                conn.commit()
                 logger.info(f"✅ Reset {affected} reminders to PENDING")
                 return affected
         except Exception as e:
             logger.error(f"❌ Reset error: {e}")
-            conn.rollback()
             raise
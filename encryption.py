@@ -1,35 +1,87 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from config import Config
-import json
+import orjson
 import base64
+import os
 import secrets
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
-# Initialize cipher
-cipher = Fernet(Config.ENCRYPTION_KEY.encode() if isinstance(Config.ENCRYPTION_KEY, str) else Config.ENCRYPTION_KEY)
+# Initialize cipher (Fernet: still used to read values written before AES-GCM)
+_key = Config.ENCRYPTION_KEY.encode() if isinstance(Config.ENCRYPTION_KEY, str) else Config.ENCRYPTION_KEY
+cipher = Fernet(_key)
+
+# AES-256-GCM for new values, key derived once from the configured Fernet key
+aesgcm = AESGCM(HKDF(
+    algorithm=hashes.SHA256(),
+    length=32,
+    salt=None,
+    info=b'loveuad-aesgcm-v1'
+).derive(base64.urlsafe_b64decode(_key)))
+
+# Keyed BLAKE2b for lookup columns: equal plaintexts match without decrypting,
+# and the digest cannot be brute-forced from a dictionary of names without the key
+_lookup_key = HKDF(
+    algorithm=hashes.SHA256(),
+    length=32,
+    salt=None,
+    info=b'loveuad-lookup-v1'
+).derive(base64.urlsafe_b64decode(_key))
+
+# decrypt_batch fans out over threads once a batch is this large
+PARALLEL_DECRYPT_MIN = 64
+DECRYPT_CHUNK_SIZE = 16
+_decrypt_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='decrypt')
+
+# First byte of the decoded token: Fernet tokens always start with 0x80
+_GCM_VERSION = b'\x01'
+_FERNET_VERSION = 0x80
 
 def encrypt_data(data):
     """Encrypt sensitive data"""
     if isinstance(data, dict):
-        data = json.dumps(data)
-    elif not isinstance(data, str):
-        data = str(data)
-    encrypted = cipher.encrypt(data.encode())
+        plaintext = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)  # UTF-8 bytes already
+    else:
+        plaintext = (data if isinstance(data, str) else str(data)).encode()
+    nonce = os.urandom(12)
+    encrypted = _GCM_VERSION + nonce + aesgcm.encrypt(nonce, plaintext, None)
     return base64.urlsafe_b64encode(encrypted).decode()
 
+def encrypt_batch(items):
+    """Encrypt several values with the shared cipher, returns a list in the same order"""
+    return [encrypt_data(item) for item in items]
+
 def decrypt_data(encrypted_data):
     """Decrypt data"""
     try:
         encrypted_bytes = base64.urlsafe_b64decode(encrypted_data.encode())
-        decrypted = cipher.decrypt(encrypted_bytes)
+        if encrypted_bytes[0] == _FERNET_VERSION:
+            decrypted = cipher.decrypt(encrypted_bytes)
+        else:
+            decrypted = aesgcm.decrypt(encrypted_bytes[1:13], encrypted_bytes[13:], None)
         try:
-            return json.loads(decrypted.decode())
-        except json.JSONDecodeError:
+            return orjson.loads(decrypted)
+        except orjson.JSONDecodeError:
             return decrypted.decode()
     except Exception as e:
         print(f"Decryption error: {e}")
         return None
 
+def _decrypt_chunk(items):
+    return [decrypt_data(item) for item in items]
+
+def decrypt_batch(items):
+    """Decrypt several values with the shared cipher, returns a list in the same order"""
+    items = list(items)
+    if len(items) < PARALLEL_DECRYPT_MIN:
+        return _decrypt_chunk(items)
+    # Large batches: chunks decrypted on the pool (OpenSSL AES runs without the GIL)
+    chunks = [items[i:i + DECRYPT_CHUNK_SIZE] for i in range(0, len(items), DECRYPT_CHUNK_SIZE)]
+    return [value for chunk in _decrypt_pool.map(_decrypt_chunk, chunks) for value in chunk]
+
 def generate_patient_code():
     """Generate 17-character patient code in XXXX-XXXX-XXXX-XXXX-X format"""
     chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
@@ -46,3 +98,7 @@ def hash_patient_code(code):
         raise ValueError(f"Invalid patient code length: {len(clean_code)} (expected 17)")
     
     return hashlib.sha256(clean_code.encode()).hexdigest()
+
+def hash_medication_name(name):
+    """Non-reversible 16-byte digest of a medication name (medications.name_hash)"""
+    return hashlib.blake2b((name or '').encode(), digest_size=16, key=_lookup_key).digest()
@@ -1,37 +1,43 @@
 import re
 
+# Compiled once at import, applied in this order (later patterns see earlier replacements)
+_PII_PATTERNS = (
+    # Remove phone numbers
+    (re.compile(r'\b\d{3}[-.\s]?\d{3}[-.\s]?\d{4}\b'), '[PHONE_REMOVED]'),
+    (re.compile(r'\(\d{3}\)\s?\d{3}[-.\s]?\d{4}'), '[PHONE_REMOVED]'),
+
+    # Remove emails
+    (re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'), '[EMAIL_REMOVED]'),
+
+    # Remove DOB
+    (re.compile(r'\bDOB[:\s]+\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', re.IGNORECASE), '[DOB_REMOVED]'),
+    (re.compile(r'\bDate of Birth[:\s]+\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', re.IGNORECASE), '[DOB_REMOVED]'),
+
+    # Remove SSN
+    (re.compile(r'\b\d{3}-\d{2}-\d{4}\b'), '[SSN_REMOVED]'),
+
+    # Remove MRN/Patient ID
+    (re.compile(r'\b(?:MRN|Patient ID|Medical Record)[:\s]+[\w\d-]+\b', re.IGNORECASE), '[ID_REMOVED]'),
+
+    # Remove addresses
+    (re.compile(r'\b\d+\s+[A-Za-z\s]+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct)\b', re.IGNORECASE), '[ADDRESS_REMOVED]'),
+
+    # Remove zip codes
+    (re.compile(r'\b\d{5}(?:-\d{4})?\b'), '[ZIP_REMOVED]'),
+
+    # Remove names
+    (re.compile(r'\b(?:Patient Name|Name|Patient)[:\s]+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\b'), '[NAME_REMOVED]'),
+)
+
 class PIIFilter:
     """Filter personally identifiable information from OCR text"""
-    
+
     @staticmethod
     def remove_pii(text):
         """Remove PII but keep medical information"""
         filtered_text = text
-        
-        # Remove phone numbers
-        filtered_text = re.sub(r'\b\d{3}[-.\s]?\d{3}[-.\s]?\d{4}\b', '[PHONE_REMOVED]', filtered_text)
-        filtered_text = re.sub(r'\(\d{3}\)\s?\d{3}[-.\s]?\d{4}', '[PHONE_REMOVED]', filtered_text)
-        
-        # Remove emails
-        filtered_text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL_REMOVED]', filtered_text)
-        
-        # Remove DOB
-        filtered_text = re.sub(r'\bDOB[:\s]+\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', '[DOB_REMOVED]', filtered_text, flags=re.IGNORECASE)
-        filtered_text = re.sub(r'\bDate of Birth[:\s]+\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', '[DOB_REMOVED]', filtered_text, flags=re.IGNORECASE)
-        
-        # Remove SSN
-        filtered_text = re.sub(r'\b\d{3}-\d{2}-\d{4}\b', '[SSN_REMOVED]', filtered_text)
-        
-        # Remove MRN/Patient ID
-        filtered_text = re.sub(r'\b(?:MRN|Patient ID|Medical Record)[:\s]+[\w\d-]+\b', '[ID_REMOVED]', filtered_text, flags=re.IGNORECASE)
-        
-        # Remove addresses
-        filtered_text = re.sub(r'\b\d+\s+[A-Za-z\s]+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct)\b', '[ADDRESS_REMOVED]', filtered_text, flags=re.IGNORECASE)
-        
-        # Remove zip codes
-        filtered_text = re.sub(r'\b\d{5}(?:-\d{4})?\b', '[ZIP_REMOVED]', filtered_text)
-        
-        # Remove names
-        filtered_text = re.sub(r'\b(?:Patient Name|Name|Patient)[:\s]+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\b', '[NAME_REMOVED]', filtered_text)
-        
+
+        for pattern, replacement in _PII_PATTERNS:
+            filtered_text = pattern.sub(replacement, filtered_text)
+
         return filtered_text
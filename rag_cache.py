@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# RESPONSE CACHE FOR THE CBT COACH
+# ============================================
+
+_PUNCT_RE = re.compile(r"[^\w\s']")
+_SPACE_RE = re.compile(r"\s+")
+
+_STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by',
+    'from', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do',
+    'does', 'did', 'will', 'would', 'should', 'could', 'may', 'might', 'can', 'i', 'me', 'my',
+    'you', 'your', 'it', 'its', 'this', 'that', 'so', 'just', 'really', 'please'
+})
+
+
+def normalize_query(query):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    query = _PUNCT_RE.sub(' ', query.lower())
+    return _SPACE_RE.sub(' ', query).strip()
+
+
+def question_terms(normalized):
+    """Meaningful words of a normalized question, as a frozenset"""
+    return frozenset(w for w in normalized.split() if w not in _STOP_WORDS and len(w) > 2)
+
+
+@dataclass(frozen=True)
+class QueryCtx:
+    """
+    A coach question prepared once and shared by safety check, cache, FAQ
+    and context selection. `normalized` is the answer-cache key; `terms`
+    plays the role a query embedding would: computed once, compared by FAQ
+    matching and context selection.
+    """
+    raw: str
+    lower: str
+    normalized: str
+    terms: frozenset
+
+    @classmethod
+    def build(cls, query):
+        if isinstance(query, QueryCtx):
+            return query
+        raw = (query or '').strip()
+        lower = raw.lower()
+        normalized = _SPACE_RE.sub(' ', _PUNCT_RE.sub(' ', lower)).strip()
+        terms = question_terms(normalized)
+        return cls(raw=raw, lower=lower, normalized=normalized, terms=terms)
+
+
+def _cache_key(code_hash, ctx):
+    """Exact match on the normalized question, per code_hash"""
+    return hashlib.sha1(f"{code_hash}\0{ctx.normalized}".encode()).hexdigest()
+
+
+class SmartRAGCache:
+    """
+    LRU cache of RAG answers, scoped per code_hash, keyed on the normalized
+    question (case, punctuation and whitespace differences still hit).
+    Word order is kept: "does mum hit dad" and "does dad hit mum" differ.
+    """
+
+    def __init__(self, ttl_seconds=3600, max_bytes=100 * 1024 * 1024):
+        self.ttl = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, response)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(response):
+        answer = response.get('answer') or ''
+        return len(answer) + 200 * len(response.get('sources') or []) + 64
+
+    def _get_key(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, response = entry
+        if expires_at < now:
+            del self._entries[key]
+            self._bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def get(self, code_hash, query):
+        """Return a cached response dict or None (query: str or QueryCtx)"""
+        ctx = QueryCtx.build(query)
+        now = time.monotonic()
+        with self._lock:
+            response = self._get_key(_cache_key(code_hash, ctx), now)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+
+    def put(self, code_hash, query, response):
+        """Store a response under the normalized question"""
+        ctx = QueryCtx.build(query)
+        size = self._size(response)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl
+        key = _cache_key(code_hash, ctx)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._entries[key] = (expires_at, size, response)
+            self._bytes += size
+
+            # Evict least recently used until under the byte cap
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+
+
+class FAQIndex:
+    """
+    Curated question -> answer pairs served without retrieval or generation.
+    A question matches when its meaningful words overlap an FAQ's by at
+    least `min_overlap` (Jaccard).
+    """
+
+    def __init__(self, min_overlap=0.8):
+        self.min_overlap = min_overlap
+        self._entries = []  # [(terms, answer)]
+        self.loaded_at = 0.0
+
+    def load(self, rows):
+        """rows: iterable of dicts with 'question' and 'answer'"""
+        entries = []
+        for row in rows:
+            terms = question_terms(normalize_query(row['question']))
+            if terms and row.get('answer'):
+                entries.append((terms, row['answer']))
+        self._entries = entries
+        self.loaded_at = time.monotonic()
+        return len(entries)
+
+    def match(self, query):
+        """Return the best FAQ answer or None (query: str or QueryCtx)"""
+        terms = QueryCtx.build(query).terms
+        if not terms:
+            return None
+        best_score, best_answer = 0.0, None
+        for faq_terms, answer in self._entries:
+            score = len(terms & faq_terms) / len(terms | faq_terms)
+            if score > best_score:
+                best_score, best_answer = score, answer
+        return best_answer if best_score >= self.min_overlap else None
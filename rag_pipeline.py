@@ -1,9 +1,21 @@
 import logging
+import re
 import google.generativeai as genai
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Diagnosis-request phrases, compiled once: one pass over the query instead
+# of a substring scan per phrase
+_DIAGNOSIS_RE = re.compile('|'.join(re.escape(kw) for kw in (
+    'diagnose', 'diagnosis', 'what does he have', 'what does she have',
+    'what condition', 'what disease', 'what is wrong', 'does he have',
+    'does she have', 'is this alzheimer', 'is it dementia', 'could this be',
+    'what type of dementia', 'which dementia', 'what stage',
+    'is this normal aging', 'medical opinion', 'can you tell if',
+    'symptom of what', 'caused by what'
+)))
+
 # ============================================
 # SYSTEM PROMPT - HUMAN-LIKE CBT COACH
 # ============================================
@@ -63,6 +75,23 @@ Say: "A lot of caregivers find that taking even 5 minutes for themselves helps r
 **Remember**: You're their ally, not their therapist or teacher. Be real, be kind, be practical."""
 
 
+class AnswerStream:
+    """
+    Answer text from stream_response, as it is produced.
+    `error` turns True when generation failed and the fallback text was
+    yielded instead (possibly after part of a real answer).
+    """
+    def __init__(self, chunks):
+        self.error = False
+        self._chunks = chunks(self) if callable(chunks) else iter(chunks)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self._chunks)
+
+
 class RAGPipeline:
     """RAG Pipeline with CBT support for caregivers"""
     
@@ -165,21 +194,11 @@ class RAGPipeline:
         context = "\n\n".join(context_parts)
         return context, sources
     
-    def generate_response(self, query, context=None, sources=None):
-        """Generate response using Gemini with optional context"""
+    def diagnosis_refusal(self, query):
+        """Return the fixed refusal response for diagnosis requests, else None"""
         
         # CRITICAL SAFETY CHECK: Detect diagnosis requests
-        query_lower = query.lower()
-        diagnosis_keywords = [
-            'diagnose', 'diagnosis', 'what does he have', 'what does she have',
-            'what condition', 'what disease', 'what is wrong', 'does he have',
-            'does she have', 'is this alzheimer', 'is it dementia', 'could this be',
-            'what type of dementia', 'which dementia', 'what stage',
-            'is this normal aging', 'medical opinion', 'can you tell if',
-            'symptom of what', 'caused by what'
-        ]
-        
-        if any(keyword in query_lower for keyword in diagnosis_keywords):
+        if _DIAGNOSIS_RE.search(query.lower()):
             return {
                 'answer': """⚠️ **I Cannot Provide Medical Diagnoses**
 
@@ -209,9 +228,19 @@ They can conduct proper medical assessments, order appropriate tests, and provid
                 'sources': []
             }
         
+        return None
+    
+    def build_prompt(self, query, context=None, prefix=None):
+        """Gemini prompt for one turn.
+        `prefix` (e.g. recent conversation summaries) goes right after the
+        system prompt so the start of the prompt stays identical across turns."""
+        
+        # Stable part first: system prompt + conversation history
+        stable_prefix = f"{SYSTEM_PROMPT}\n\n{prefix}" if prefix else SYSTEM_PROMPT
+        
         # Build prompt based on whether we have research context
         if context:
-            prompt = f"""{SYSTEM_PROMPT}
+            prompt = f"""{stable_prefix}
 
 **Background research** (use subtly, don't quote directly):
 {context}
@@ -222,7 +251,7 @@ They can conduct proper medical assessments, order appropriate tests, and provid
 **Your response** (2-3 sentences, warm and practical):"""
         else:
             # No research - but still respond empathetically
-            prompt = f"""{SYSTEM_PROMPT}
+            prompt = f"""{stable_prefix}
 
 **Note:** No specific research papers match this query, but provide empathetic support based on general CBT principles for caregivers.
 
@@ -230,7 +259,17 @@ They can conduct proper medical assessments, order appropriate tests, and provid
 {query}
 
 **Your response** (warm, empathetic, 2-3 sentences):"""
-
+        
+        return prompt
+    
+    def generate_response(self, query, context=None, sources=None, prefix=None):
+        """Generate response using Gemini with optional context"""
+        refusal = self.diagnosis_refusal(query)
+        if refusal:
+            return refusal
+        
+        prompt = self.build_prompt(query, context, prefix)
+        
         try:
             # Generate with Gemini
             response = self.llm.generate_content(
@@ -252,27 +291,71 @@ They can conduct proper medical assessments, order appropriate tests, and provid
             logger.error(f"Generation error: {e}")
             return {
                 'answer': "I hear you. That sounds really challenging. Can you tell me a bit more about what's going on?",
-                'sources': []
+                'sources': [],
+                'error': True
             }
     
-    def get_response(self, query):
-        """Main RAG pipeline: Always respond empathetically"""
+    def stream_response(self, query, prefix=None, retrieved=None):
+        """
+        Streaming variant of get_response.
+        Returns (sources, chunks) where `chunks` is an AnswerStream yielding
+        answer text as Gemini produces it.
+        """
+        refusal = self.diagnosis_refusal(query)
+        if refusal:
+            return refusal['sources'], AnswerStream([refusal['answer']])
+        
+        context, sources = retrieved if retrieved is not None else self.retrieve(query)
+        prompt = self.build_prompt(query, context, prefix)
+        
+        def chunks(stream):
+            try:
+                response = self.llm.generate_content(
+                    prompt,
+                    generation_config={
+                        'temperature': Config.TEMPERATURE,
+                        'max_output_tokens': Config.MAX_OUTPUT_TOKENS
+                    },
+                    stream=True
+                )
+                for chunk in response:
+                    if chunk.text:
+                        yield chunk.text
+            except Exception as e:
+                logger.error(f"Streaming generation error: {e}")
+                stream.error = True
+                yield "I hear you. That sounds really challenging. Can you tell me a bit more about what's going on?"
+        
+        return sources, AnswerStream(chunks)
+    
+    def retrieve(self, query):
+        """Search research papers and build context. Returns (context, sources)"""
         try:
-            # Check if this is emotional support query
-            is_emotional = self.is_emotional_support_query(query)
-            
-            # Step 1: Search research papers
             search_results = self.search_research(query)
             
-            # Step 2: Build context (even if empty)
             if search_results:
-                context, sources = self.build_context(search_results)
-            else:
-                context, sources = None, []
-                logger.info("No research found - will respond with general CBT support")
+                return self.build_context(search_results)
+            
+            logger.info("No research found - will respond with general CBT support")
+            return None, []
+        
+        except Exception as e:
+            logger.error(f"Retrieval error: {e}")
+            return None, []
+    
+    def get_response(self, query, prefix=None, retrieved=None):
+        """Main RAG pipeline: Always respond empathetically.
+        Only `query` is used for retrieval; `prefix` is passed through to the prompt.
+        `retrieved` is a (context, sources) pair from an earlier retrieve() call."""
+        try:
+            # Check if this is emotional support query
+            is_emotional = self.is_emotional_support_query(query)
+            
+            # Step 1 + 2: Search research papers and build context (even if empty)
+            context, sources = retrieved if retrieved is not None else self.retrieve(query)
             
             # Step 3: ALWAYS generate response (with or without research)
-            response = self.generate_response(query, context, sources)
+            response = self.generate_response(query, context, sources, prefix=prefix)
             
             return response
         
@@ -280,7 +363,8 @@ They can conduct proper medical assessments, order appropriate tests, and provid
             logger.error(f"RAG pipeline error: {e}")
             return {
                 'answer': "I hear you. That sounds really challenging. Can you tell me a bit more about what's going on?",
-                'sources': []
+                'sources': [],
+                'error': True
             }
 
 
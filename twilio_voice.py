@@ -7,7 +7,7 @@ from twilio.twiml.voice_response import VoiceResponse, Gather
 from flask import request, jsonify
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 import google.generativeai as genai
 
 logger = logging.getLogger(__name__)
@@ -192,34 +192,12 @@ def handle_medication_callback(speech_result, code_hash, medication, scheduled_t
         
         # Record in database
         try:
-            from encryption import encrypt_data, decrypt_data
-            
-            patient = db_manager.get_patient_data(code_hash)
-            if patient:
-                patient_data = decrypt_data(patient['encrypted_data'])
-                adherence_history = patient_data.get('medicationAdherence', [])
-                
-                adherence_record = {
-                    'medication': medication,
-                    'scheduledTime': scheduled_time,
-                    'takenAt': datetime.utcnow().isoformat(),
-                    'date': datetime.utcnow().strftime('%Y-%m-%d'),
-                    'status': 'taken',
-                    'takenVia': 'twilio_voice_call',
-                    'speechText': speech_text
-                }
-                
-                adherence_history.append(adherence_record)
-                patient_data['medicationAdherence'] = adherence_history[-270:]
-                
-                encrypted_data = encrypt_data(patient_data)
-                with db_manager.conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE patients SET encrypted_data = %s WHERE code_hash = %s",
-                        (encrypted_data, code_hash)
-                    )
-                    db_manager.conn.commit()
-                
+            # One append-only medication_adherence row (skipped if the patient doesn't exist)
+            now = datetime.now(timezone.utc)
+            record_id = db_manager.record_adherence(
+                code_hash, medication, scheduled_time, now, now.strftime('%Y-%m-%d'), 'twilio_voice_call'
+            )
+            if record_id is not None:
                 logger.info(f"✓ Medication recorded via voice: {medication}")
         except Exception as e:
             logger.error(f"Database error: {e}")
@@ -249,33 +227,11 @@ def handle_followup_callback(speech_result, code_hash, medication, scheduled_tim
         
         # Record it
         try:
-            from encryption import encrypt_data, decrypt_data
-            
-            patient = db_manager.get_patient_data(code_hash)
-            if patient:
-                patient_data = decrypt_data(patient['encrypted_data'])
-                adherence_history = patient_data.get('medicationAdherence', [])
-                
-                adherence_record = {
-                    'medication': medication,
-                    'scheduledTime': scheduled_time,
-                    'takenAt': datetime.utcnow().isoformat(),
-                    'date': datetime.utcnow().strftime('%Y-%m-%d'),
-                    'status': 'taken',
-                    'takenVia': 'twilio_followup_call',
-                    'speechText': speech_text
-                }
-                
-                adherence_history.append(adherence_record)
-                patient_data['medicationAdherence'] = adherence_history[-270:]
-                
-                encrypted_data = encrypt_data(patient_data)
-                with db_manager.conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE patients SET encrypted_data = %s WHERE code_hash = %s",
-                        (encrypted_data, code_hash)
-                    )
-                    db_manager.conn.commit()
+            # One append-only medication_adherence row (skipped if the patient doesn't exist)
+            now = datetime.now(timezone.utc)
+            db_manager.record_adherence(
+                code_hash, medication, scheduled_time, now, now.strftime('%Y-%m-%d'), 'twilio_followup_call'
+            )
         except Exception as e:
             logger.error(f"Database error: {e}")
     